@@ -0,0 +1,52 @@
+"""Compares memory usage and decoding/encoding throughput of Sample and CompactSample.
+
+Run from the repository root: python -m benchmarks.compact_sample [input.bin] [repetitions]
+"""
+import io
+import sys
+import timeit
+import tracemalloc
+
+from benchmarks.read_samples import DEFAULT_INPUT
+from bitflow.io import SampleChannel
+
+
+def decode(data, compact):
+    channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=io.BytesIO(),
+                            compact_samples=compact)
+    return list(iter(channel.read_sample, None))
+
+
+def encode(samples):
+    channel = SampleChannel(input_stream=io.BytesIO(), output_stream=io.BytesIO())
+    for sample in samples:
+        channel.output_sample(sample)
+
+
+def measure_memory(data, compact):
+    tracemalloc.start()
+    samples = decode(data, compact)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(samples)
+
+
+def main(input_file=DEFAULT_INPUT, repetitions=20):
+    with open(input_file, "rb") as f:
+        data = f.read()
+    num_samples = len(decode(data, False))
+    print("Input: {} ({} bytes, {} samples), {} repetitions".format(input_file, len(data), num_samples, repetitions))
+
+    for name, compact in [("Sample", False), ("CompactSample", True)]:
+        bytes_per_sample = measure_memory(data, compact)
+        decode_seconds = min(timeit.repeat(lambda: decode(data, compact), number=1, repeat=repetitions))
+        samples = decode(data, compact)
+        encode_seconds = min(timeit.repeat(lambda: encode(samples), number=1, repeat=repetitions))
+        print("{:>14}: {:7.0f} bytes/sample, decode {:9.0f} samples/s, encode {:9.0f} samples/s".format(
+            name, bytes_per_sample, num_samples / decode_seconds, num_samples / encode_seconds))
+
+
+if __name__ == '__main__':
+    input_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INPUT
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(input_file, repetitions)
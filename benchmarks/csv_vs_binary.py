@@ -0,0 +1,47 @@
+"""Compares decoding and encoding throughput of the binary and the CSV format for the same samples.
+
+Run from the repository root: python -m benchmarks.csv_vs_binary [input.bin] [repetitions]
+"""
+import io
+import sys
+import timeit
+
+from benchmarks.read_samples import DEFAULT_INPUT
+from bitflow.io import SampleChannel
+
+
+def convert(data, output_format):
+    output = io.BytesIO()
+    channel = SampleChannel(input_stream=io.BytesIO(data), output_stream=output, keep_raw_samples=False,
+                            output_format=output_format)
+    for sample in iter(channel.read_sample, None):
+        channel.output_sample(sample)
+    channel.close()
+    return output.getvalue()
+
+
+def decode(data):
+    channel = SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO())
+    return sum(1 for _ in iter(channel.read_sample, None))
+
+
+def main(input_file=DEFAULT_INPUT, repetitions=20):
+    with open(input_file, "rb") as f:
+        data = {"bin": f.read()}
+    data["csv"] = convert(data["bin"], "csv")
+    num_samples = decode(data["bin"])
+    print("Input: {} ({} samples), {} repetitions".format(input_file, num_samples, repetitions))
+
+    for data_format in ["bin", "csv"]:
+        size = len(data[data_format])
+        seconds = min(timeit.repeat(lambda: decode(data[data_format]), number=1, repeat=repetitions))
+        print("decode {}: {:9.0f} samples/s, {:7.1f} MB/s ({} bytes)".format(
+            data_format, num_samples / seconds, size / seconds / 1e6, size))
+        seconds = min(timeit.repeat(lambda: convert(data["bin"], data_format), number=1, repeat=repetitions))
+        print("encode {}: {:9.0f} samples/s".format(data_format, num_samples / seconds))
+
+
+if __name__ == '__main__':
+    input_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INPUT
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(input_file, repetitions)
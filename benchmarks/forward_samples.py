@@ -0,0 +1,40 @@
+"""Measures forwarding of unmodified samples (as done by NoopStep) with and without reusing the raw input bytes.
+
+Run from the repository root: python -m benchmarks.forward_samples [input.bin] [repetitions]
+"""
+import io
+import sys
+import timeit
+
+from benchmarks.read_samples import DEFAULT_INPUT
+from bitflow.io import SampleChannel
+
+
+def forward(data, keep_raw_samples):
+    output = io.BytesIO()
+    channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=output,
+                            keep_raw_samples=keep_raw_samples)
+    num_samples = 0
+    for sample in iter(channel.read_sample, None):
+        channel.output_sample(sample)
+        num_samples += 1
+    channel.close()
+    return num_samples
+
+
+def main(input_file=DEFAULT_INPUT, repetitions=20):
+    with open(input_file, "rb") as f:
+        data = f.read()
+    num_samples = forward(data, True)
+    print("Input: {} ({} bytes, {} samples), {} repetitions".format(input_file, len(data), num_samples, repetitions))
+
+    for name, keep_raw_samples in [("re-marshal", False), ("raw bytes", True)]:
+        seconds = min(timeit.repeat(lambda: forward(data, keep_raw_samples), number=1, repeat=repetitions))
+        print("{:>11}: {:9.0f} samples/s, {:7.1f} MB/s".format(
+            name, num_samples / seconds, len(data) / seconds / 1e6))
+
+
+if __name__ == '__main__':
+    input_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INPUT
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(input_file, repetitions)
@@ -0,0 +1,85 @@
+"""Compares the per-field and the vectorized decoding of sample metrics, and the chunked frame decoder.
+
+Run from the repository root: python -m benchmarks.read_samples [input.bin] [repetitions]
+"""
+import io
+import os
+import sys
+import timeit
+
+from bitflow.marshaller import BinaryMarshaller, StreamDecoder, METRIC_NUM_BYTES, SAMPLE_MARKER_BYTE, \
+    TIMESTAMP_NUM_BYTES
+from bitflow.sample import Sample
+
+DEFAULT_INPUT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "tests", "test_data", "in.bin")
+
+
+class PerFieldMarshaller(BinaryMarshaller):
+    """Previous implementation of read_sample(), unpacking every metric value separately"""
+
+    def read_sample(self, stream, header):
+        stream.read(len(SAMPLE_MARKER_BYTE))
+
+        num_fields = header.num_fields()
+        timeBytes = stream.read(TIMESTAMP_NUM_BYTES)
+        tagBytes = self.read_line(stream)
+        valueBytes = stream.read(num_fields * METRIC_NUM_BYTES)
+
+        timestamp = self.unpack_utc_nanos_timestamp(self.unpack_long(timeBytes))
+        tags = self.parse_tags(tagBytes)
+
+        metrics = []
+        for index in range(num_fields):
+            offset = index * METRIC_NUM_BYTES
+            metrics.append(self.unpack_double(valueBytes[offset: offset + METRIC_NUM_BYTES]))
+        return Sample(header=header, metrics=metrics, timestamp=timestamp, tags=tags)
+
+
+def read_all(marshaller, data):
+    stream = io.BufferedReader(io.BytesIO(data))
+    header = None
+    num_samples = 0
+    while True:
+        result = marshaller.read(stream, header)
+        if result is None:
+            break
+        if isinstance(result, Sample):
+            num_samples += 1
+        else:
+            header = result
+    return num_samples
+
+
+def decode_chunked(marshaller, data):
+    decoder = StreamDecoder(io.BytesIO(data), marshaller)
+    num_samples = 0
+    while True:
+        result = decoder.read()
+        if result is None:
+            break
+        if isinstance(result, Sample):
+            num_samples += 1
+    return num_samples
+
+
+def main(input_file=DEFAULT_INPUT, repetitions=20):
+    with open(input_file, "rb") as f:
+        data = f.read()
+    num_samples = read_all(BinaryMarshaller(), data)
+    print("Input: {} ({} bytes, {} samples), {} repetitions".format(input_file, len(data), num_samples, repetitions))
+
+    results = {}
+    for name, marshaller, decode in [("per-field", PerFieldMarshaller(), read_all),
+                                     ("vectorized", BinaryMarshaller(), read_all),
+                                     ("chunked", BinaryMarshaller(), decode_chunked)]:
+        seconds = min(timeit.repeat(lambda: decode(marshaller, data), number=1, repeat=repetitions))
+        results[name] = seconds
+        print("{:>12}: {:8.2f} ms per pass, {:10.0f} samples/s".format(name, seconds * 1000, num_samples / seconds))
+    print("Speedup vectorized: {:.2f}x, chunked: {:.2f}x".format(
+        results["per-field"] / results["vectorized"], results["per-field"] / results["chunked"]))
+
+
+if __name__ == '__main__':
+    input_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INPUT
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(input_file, repetitions)
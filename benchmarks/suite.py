@@ -0,0 +1,201 @@
+"""Benchmark suite for the marshalling, channel, runner and memory hot paths, based on synthetic sample streams.
+Every combination of the given field counts, tag cardinalities and header change intervals is measured.
+The results are printed as JSON and can be compared to the results of a previous run.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.suite -fields 10,100 -output results.json
+    python -m benchmarks.suite -fields 10,100 -compare results.json
+"""
+import argparse
+import datetime
+import io
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+from bitflow.io import SampleChannel
+from bitflow.marshaller import BinaryMarshaller
+from bitflow.runner import BitflowRunner
+from bitflow.sample import Sample, Header
+from bitflow.steps import NoopStep
+
+START_NANOS = 1586591392000000000
+
+
+def generate_samples(num_samples, num_fields, tag_cardinality, header_change_every, seed=0):
+    """Generate samples with random metric values. The tags take tag_cardinality different values, and a new header
+    (with a different last metric name) starts every header_change_every samples (never, if 0)."""
+    rnd = random.Random(seed)
+    tags = [{"host": "host-{}".format(i), "filter": "port_{}".format(1000 + i)} for i in range(tag_cardinality)]
+    header = None
+    samples = []
+    for i in range(num_samples):
+        if header is None or (header_change_every and i % header_change_every == 0):
+            names = ["metric_{}".format(f) for f in range(num_fields - 1)]
+            header = Header(names + ["variant_{}".format(i // header_change_every if header_change_every else 0)])
+        samples.append(Sample(header, [rnd.random() * 1000 for _ in range(num_fields)],
+                              timestamp=START_NANOS + i * 1000000, tags=dict(tags[i % tag_cardinality])))
+    return samples
+
+
+def marshal(samples):
+    output = io.BytesIO()
+    channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+    for sample in samples:
+        channel.output_sample(sample)
+    return output.getvalue()
+
+
+# ==========
+# Benchmarks
+# ==========
+
+def bench_marshaller_read(data, samples):
+    marshaller = BinaryMarshaller()
+    stream = io.BufferedReader(io.BytesIO(data))
+    header = None
+    while True:
+        result = marshaller.read(stream, header)
+        if result is None:
+            break
+        if isinstance(result, Header):
+            header = result
+
+
+def bench_marshaller_write(data, samples):
+    marshaller = BinaryMarshaller()
+    stream = io.BytesIO()
+    header = None
+    for sample in samples:
+        if sample.header is not header:
+            header = sample.header
+            marshaller.write_header(stream, header)
+        marshaller.write_sample(stream, sample)
+
+
+def bench_channel_round_trip(data, samples):
+    channel = SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO(), keep_raw_samples=False)
+    for sample in iter(channel.read_sample, None):
+        channel.output_sample(sample)
+    channel.close()
+
+
+def bench_runner_noop(data, samples):
+    channel = SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO())
+    BitflowRunner().run(NoopStep(), channel)
+
+
+BENCHMARKS = {
+    "marshaller_read": bench_marshaller_read,
+    "marshaller_write": bench_marshaller_write,
+    "channel_round_trip": bench_channel_round_trip,
+    "runner_noop": bench_runner_noop,
+}
+
+
+def measure_memory(data, compact_samples):
+    channel = SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO(),
+                            compact_samples=compact_samples, keep_raw_samples=False)
+    tracemalloc.start()
+    samples = list(iter(channel.read_sample, None))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(samples)
+
+
+def run_scenario(num_samples, num_fields, tag_cardinality, header_change_every, repetitions):
+    samples = generate_samples(num_samples, num_fields, tag_cardinality, header_change_every)
+    data = marshal(samples)
+    results = {}
+    for name, benchmark in BENCHMARKS.items():
+        seconds = min(timeit.repeat(lambda: benchmark(data, samples), number=1, repeat=repetitions))
+        results[name] = {
+            "seconds": seconds,
+            "samples_per_second": num_samples / seconds,
+            "bytes_per_second": len(data) / seconds,
+        }
+    results["memory"] = {
+        "bytes_per_sample": measure_memory(data, False),
+        "bytes_per_compact_sample": measure_memory(data, True),
+    }
+    return {
+        "samples": num_samples,
+        "fields": num_fields,
+        "tag_cardinality": tag_cardinality,
+        "header_change_every": header_change_every,
+        "stream_bytes": len(data),
+        "results": results,
+    }
+
+
+def scenario_key(scenario):
+    return "fields={fields},tags={tag_cardinality},header_every={header_change_every}".format(**scenario)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Print the throughput of every benchmark relative to the baseline report"""
+    baseline_scenarios = {scenario_key(s): s for s in baseline["scenarios"]}
+    for scenario in report["scenarios"]:
+        key = scenario_key(scenario)
+        if key not in baseline_scenarios:
+            continue
+        for name, result in scenario["results"].items():
+            old_result = baseline_scenarios[key]["results"].get(name)
+            if old_result is None or "samples_per_second" not in result:
+                continue
+            ratio = result["samples_per_second"] / old_result["samples_per_second"]
+            print("{} {:>20}: {:9.0f} samples/s ({:+.1%})".format(key, name, result["samples_per_second"], ratio - 1),
+                  file=sys.stderr)
+
+
+def int_list(string):
+    return [int(value) for value in string.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-samples", type=int, default=5000, help="number of samples per synthetic stream")
+    parser.add_argument("-fields", type=int_list, default=[10, 100], help="comma-separated metric counts")
+    parser.add_argument("-tags", type=int_list, default=[1, 100], help="comma-separated tag cardinalities")
+    parser.add_argument("-header-every", dest="header_every", type=int_list, default=[0],
+                        help="comma-separated header change intervals in samples (0: single header)")
+    parser.add_argument("-repetitions", type=int, default=5, help="repetitions per benchmark, the best is reported")
+    parser.add_argument("-output", type=str, help="write the JSON results to this file instead of standard output")
+    parser.add_argument("-compare", type=str, metavar="baseline.json", help="print the change relative to a "
+                                                                             "previous result file")
+    args = parser.parse_args()
+
+    report = {
+        "date": datetime.datetime.utcnow().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": [run_scenario(args.samples, fields, tags, header_every, args.repetitions)
+                      for fields, tags, header_every in itertools.product(args.fields, args.tags, args.header_every)],
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
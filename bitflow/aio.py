@@ -0,0 +1,192 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import stat
+import time
+
+from bitflow.io import SampleChannel
+from bitflow.marshaller import DEFAULT_CHUNK_SIZE
+from bitflow.runner import ProcessingStep, BitflowContext
+
+DEFAULT_CONCURRENCY = 100
+
+# Context receiving the output samples of the sample handled by the current task
+task_context = contextvars.ContextVar("task_context")
+
+
+def is_pipe(stream):
+    """Whether the stream can be read by the event loop without blocking: a pipe, socket or character device"""
+    try:
+        mode = os.fstat(stream.fileno()).st_mode
+    except (AttributeError, OSError, ValueError):
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode)
+
+
+class AsyncProcessingStep(ProcessingStep):
+    """Processing step with coroutines for handling samples, for steps that wait for external services.
+    The AsyncBitflowRunner runs handle_sample() for many samples concurrently, so the step must not rely on
+    receiving the next sample only after the previous one was handled. Samples can be output with output() at
+    any time before handle_sample() returns."""
+
+    @classmethod
+    def is_async(cls):
+        return True
+
+    async def handle_sample(self, sample):
+        """Handle a received sample"""
+        pass
+
+    async def cleanup(self):
+        """Clean up and prepare shutdown, after all samples were handled"""
+        pass
+
+
+class TaskContext:
+    """Context of a step run by the AsyncBitflowRunner. Forwards output samples to the context of the current task,
+    if one is set, otherwise to the given default context"""
+
+    def __init__(self, default):
+        self.default = default
+
+    def output_sample(self, sample):
+        task_context.get(self.default).output_sample(sample)
+
+
+class OrderedContext:
+    """Collects the output samples of one input sample until the outputs of all previous input samples were written"""
+
+    def __init__(self):
+        self.samples = []
+        self.done = False
+
+    def output_sample(self, sample):
+        self.samples.append(sample)
+
+
+class AsyncBitflowRunner:
+    """Runs an AsyncProcessingStep with an asyncio event loop. The input is read without blocking the loop, and up to
+    concurrency samples are handled concurrently. In ordered mode, the output samples are written in the order of
+    the input samples they were produced for. Otherwise they are written as soon as they are output.
+    Regular ProcessingSteps can be run as well, their handle_sample() is called directly.
+    If a bitflow.stats.Statistics object is given, the time from calling handle_sample() until it completes is
+    recorded as step latency, including the time the coroutine waits concurrently with other samples."""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, ordered=True, chunk_size=DEFAULT_CHUNK_SIZE, stats=None):
+        if concurrency < 1:
+            raise ValueError("Concurrency must be at least 1, got {}".format(concurrency))
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.running = True
+        self.error = None
+
+    def run(self, step, channel):
+        asyncio.run(self.run_async(step, channel))
+
+    async def run_async(self, step, channel):
+        logging.info("Initializing step {}".format(step))
+        context = BitflowContext(channel)
+        step.initialize(TaskContext(context))
+
+        logging.info("Starting to receive samples...")
+        read_sample, close_input = await self.open_input(channel)
+        try:
+            await self.process(step, channel, context, read_sample)
+        finally:
+            close_input()
+
+        result = step.cleanup()
+        if inspect.isawaitable(result):
+            await result
+        channel.close()
+
+    async def open_input(self, channel):
+        """Return a coroutine function reading the next input sample (None at the end of the input), and a function
+        closing the input. The input stream of a SampleChannel is read by the event loop and decoded directly.
+        Other channels (e.g. PipelinedSampleChannel, or channels with their own read_sample() like
+        MergedSampleChannel) are read with read_sample() in a thread."""
+        loop = asyncio.get_running_loop()
+        if not isinstance(channel, SampleChannel) or type(channel).read_sample is not SampleChannel.read_sample:
+            # Output is written by the event loop, so the reading thread must not flush it
+            channel.flush_on_idle_input = False
+            return lambda: loop.run_in_executor(None, channel.read_sample), lambda: None
+        decoder = channel.decoder
+        if decoder.readinto is None:
+            read_chunk = None  # Memory-mapped input, all data is available to the decoder already
+            close = lambda: None
+        elif not is_pipe(channel.reader):
+            # Regular files and in-memory streams are not supported by the event loop, read them in a thread
+            read = getattr(channel.reader, "read1", channel.reader.read)
+            read_chunk = lambda: loop.run_in_executor(None, read, self.chunk_size)
+            close = lambda: None
+        else:
+            reader = asyncio.StreamReader(limit=self.chunk_size)
+            transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), channel.reader)
+            read_chunk = lambda: reader.read(self.chunk_size)
+            close = transport.close
+        return functools.partial(self.read_decoded, channel, read_chunk), close
+
+    @staticmethod
+    async def read_decoded(channel, read_chunk):
+        decoder = channel.decoder
+        while True:
+            sample = channel.next_sample(decoder.decode_available)
+            if sample is not None:
+                return sample
+            if channel.end_of_input or decoder.finished():
+                return None
+            decoder.feed(await read_chunk())
+
+    async def process(self, step, channel, context, read_sample):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = collections.deque()
+        tasks = set()
+        while self.running and self.error is None:
+            sample = await read_sample()
+            if sample is None:
+                break
+            await semaphore.acquire()
+            if self.ordered:
+                sample_context = OrderedContext()
+                pending.append(sample_context)
+            else:
+                sample_context = context
+            task = asyncio.create_task(self.handle(step, sample, sample_context, semaphore, pending, channel))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        if self.error is not None:
+            raise self.error
+
+    async def handle(self, step, sample, context, semaphore, pending, channel):
+        # Every task runs in a copy of the contextvars context, so this only affects the current task
+        task_context.set(context)
+        start = time.perf_counter_ns()
+        try:
+            result = step.handle_sample(sample)
+            if inspect.isawaitable(result):
+                await result
+            if self.stats is not None:
+                self.stats.step.record(time.perf_counter_ns() - start)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+        finally:
+            if self.ordered:
+                context.done = True
+                while pending and pending[0].done:
+                    for output in pending.popleft().samples:
+                        channel.output_sample(output)
+                    semaphore.release()
+            else:
+                semaphore.release()
+
+    def shutdown(self):
+        self.running = False
@@ -0,0 +1,198 @@
+import logging
+import operator
+from array import array
+from collections import OrderedDict
+
+from bitflow.runner import ProcessingStep
+from bitflow.sample import Sample
+
+# Aggregation name -> (function reducing a column of values, function combining an aggregate with one value)
+AGGREGATIONS = {
+    "mean": (sum, operator.add),
+    "sum": (sum, operator.add),
+    "min": (min, min),
+    "max": (max, max),
+    "last": (operator.itemgetter(-1), lambda aggregate, value: value),
+}
+
+
+class TimeBucket:
+    """Aggregates the metric values of all samples with the same header in the time bucket starting at 'start'
+    (nanoseconds). The aggregate of every metric is kept in an array('d'). Samples can be added one by one, or as
+    a block of consecutive rows (like SampleBatch.values), reducing every column with a single call."""
+
+    def __init__(self, header, num_fields, start, aggregation):
+        if aggregation not in AGGREGATIONS:
+            raise ValueError("Unknown aggregation '{}', expected one of {}".format(
+                aggregation, ", ".join(AGGREGATIONS)))
+        self.header = header
+        self.num_fields = num_fields
+        self.start = start
+        self.aggregation = aggregation
+        self.reduce, self.combine = AGGREGATIONS[aggregation]
+        self.values = None
+        self.count = 0
+        self.tags = None  # Tags of the latest sample
+
+    def add(self, values, tags):
+        if self.values is None:
+            self.values = array('d', values)
+        else:
+            aggregate, combine = self.values, self.combine
+            for i, value in enumerate(values):
+                aggregate[i] = combine(aggregate[i], value)
+        self.count += 1
+        self.tags = tags
+
+    def add_rows(self, values, num_rows, tags):
+        """Add num_rows rows of num_fields values each, stored row by row in the array 'values'"""
+        num_fields = self.num_fields
+        columns = array('d', [self.reduce(values[i::num_fields]) for i in range(num_fields)])
+        if self.values is None:
+            self.values = columns
+        else:
+            aggregate, combine = self.values, self.combine
+            for i, value in enumerate(columns):
+                aggregate[i] = combine(aggregate[i], value)
+        self.count += num_rows
+        self.tags = tags
+
+    def result(self):
+        metrics = self.values.tolist()
+        if self.aggregation == "mean":
+            metrics = [value / self.count for value in metrics]
+        return Sample(self.header, metrics, timestamp=self.start, tags=dict(self.tags))
+
+
+def triangle_area(a, b, c):
+    """Twice the area of the triangle between the points a, b and c, given as (x, y) tuples"""
+    return abs((a[0] - c[0]) * (b[1] - a[1]) - (a[0] - b[0]) * (c[1] - a[1]))
+
+
+class LttbSelector:
+    """Streaming variant of the largest-triangle-three-buckets algorithm. The samples are split into buckets of
+    bucket_size consecutive samples. From every bucket, the sample forming the largest triangle with the previously
+    selected sample and the average point of the following bucket is selected. The first and last samples are always
+    selected. The x coordinate of every point is the timestamp, the y coordinate is the metric with the given index.
+    At most two buckets of samples are buffered."""
+
+    def __init__(self, bucket_size, metric_index):
+        if bucket_size < 1:
+            raise ValueError("LTTB bucket size must be at least 1, got {}".format(bucket_size))
+        self.bucket_size = bucket_size
+        self.metric_index = metric_index
+        self.previous = None  # Point of the latest selected sample
+        self.pending = []  # Buffered samples, at most two buckets
+
+    def point(self, sample):
+        return sample.get_timestamp_nanos(), sample.get_metrics()[self.metric_index]
+
+    def add(self, sample):
+        """Add a sample, return the list of selected samples"""
+        if self.previous is None:
+            self.previous = self.point(sample)
+            return [sample]
+        self.pending.append(sample)
+        if len(self.pending) < 2 * self.bucket_size:
+            return []
+        bucket, following = self.pending[:self.bucket_size], self.pending[self.bucket_size:]
+        self.pending = following
+        return [self.select(bucket, self.average(following))]
+
+    def finish(self):
+        """Select the remaining samples, including the last sample"""
+        if not self.pending:
+            return []
+        pending, last = self.pending[:-1], self.pending[-1]
+        self.pending = []
+        buckets = [pending[i:i + self.bucket_size] for i in range(0, len(pending), self.bucket_size)]
+        selected = []
+        for i, bucket in enumerate(buckets):
+            following = self.average(buckets[i + 1]) if i + 1 < len(buckets) else self.point(last)
+            selected.append(self.select(bucket, following))
+        selected.append(last)
+        self.previous = None
+        return selected
+
+    def average(self, samples):
+        points = [self.point(sample) for sample in samples]
+        return sum(x for x, _ in points) / len(points), sum(y for _, y in points) / len(points)
+
+    def select(self, bucket, following):
+        # Use coordinates relative to the previous point to avoid losing precision with large timestamps
+        x0, y0 = self.previous
+        previous = (0, 0.0)
+        following = (following[0] - x0, following[1] - y0)
+        best, best_area, best_point = None, -1.0, None
+        for sample in bucket:
+            x, y = self.point(sample)
+            area = triangle_area(previous, (x - x0, y - y0), following)
+            if area > best_area:
+                best, best_area, best_point = sample, area, (x, y)
+        self.previous = best_point
+        return best
+
+
+class PerTagStep(ProcessingStep):
+    """Base class for steps keeping a state for every value of 'tag' (a single state without 'tag').
+    Like in WindowStep, the states are bounded by max_keys (removing the least recently used state when a new tag
+    value arrives) and idle_seconds (removing states without samples for that long, in sample time). A removed
+    state is passed to finish_state(), like all remaining states in cleanup(). A later sample with a removed tag
+    value starts a new state."""
+
+    def __init__(self, tag="", max_keys=0, idle_seconds=0):
+        super().__init__()
+        self.tag = tag
+        self.max_keys = max_keys
+        self.idle_nanos = int(idle_seconds * 1e9)
+        self.states = OrderedDict()  # Key -> [state, timestamp of the latest sample], least recently used first
+        self.newest_timestamp = None
+        self.evicted = 0
+
+    def key(self, sample):
+        return sample.get_tag(self.tag) if self.tag else None
+
+    def lookup(self, key, timestamp):
+        """Return the state of the key for a sample with the given timestamp, None if the key has no state.
+        Removes idle states, and the least recently used state if a new key would exceed max_keys."""
+        if self.newest_timestamp is None or timestamp > self.newest_timestamp:
+            self.newest_timestamp = timestamp
+        if self.idle_nanos > 0:
+            self.evict_idle()
+        entry = self.states.get(key)
+        if entry is None:
+            if 0 < self.max_keys <= len(self.states):
+                self.evict(next(iter(self.states)))
+            return None
+        self.states.move_to_end(key)
+        entry[1] = timestamp
+        return entry[0]
+
+    def store(self, key, state, timestamp):
+        """Set the state of the key, after lookup() was called for the same sample"""
+        self.states[key] = [state, timestamp]
+
+    def evict_idle(self):
+        limit = self.newest_timestamp - self.idle_nanos
+        while self.states:
+            key, (_, timestamp) = next(iter(self.states.items()))
+            if timestamp > limit:
+                break
+            self.evict(key)
+
+    def evict(self, key):
+        self.finish_state(key, self.states.pop(key)[0])
+        self.evicted += 1
+        logging.debug("{}: removed state of key '{}'".format(self.get_step_name(), key))
+
+    def finish_state(self, key, state):
+        """Called when the state of the key is removed, e.g. to output buffered samples"""
+        pass
+
+    def cleanup(self):
+        if self.evicted > 0:
+            logging.info("{}: removed {} idle state(s)".format(self.get_step_name(), self.evicted))
+        states, self.states = self.states, OrderedDict()
+        for key, (state, _) in states.items():
+            self.finish_state(key, state)
+        super().cleanup()
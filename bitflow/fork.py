@@ -0,0 +1,191 @@
+import collections
+import copy
+import logging
+import multiprocessing
+import zlib
+
+from bitflow.io import SampleChannel
+from bitflow.parallel import BatchBuffer, ParallelRunner, DEFAULT_BATCH_SIZE, RESULT_POLL_SECONDS, run_worker
+from bitflow.parameters import parse_step_chain, find_step_class, instantiate_step_class
+from bitflow.runner import ProcessingStep, StepChain
+
+
+def find_imported_step_class(name):
+    return find_step_class(name, ProcessingStep)
+
+
+class ForkStep(ProcessingStep):
+    """Base class for steps partitioning the samples by a key. Every partition is handled by its own instance of the
+    sub-step 'step', which can also be a chain like "a(x=1) -> b". The instance is created through
+    instantiate_step_class() when the first sample of a key arrives, and its output goes to the output of the fork.
+    To bound the memory used for high-cardinality keys, the instance of a key is cleaned up and removed when
+    max_keys instances exist and a new key arrives (least recently used first), or when no sample with the key
+    arrived for idle_seconds, measured in sample time. A later sample with the same key creates a new instance.
+    With workers > 0, the partitions are spread across that many worker processes by hashing the key, and every
+    worker process creates the instances for its keys. Samples are then sent to the workers in batches of
+    batch_size, and the order of samples with different keys is not preserved."""
+
+    def __init__(self, step, max_keys=0, idle_seconds=0.0, workers=0, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__()
+        self.step = step
+        self.chain = parse_step_chain(step)
+        self.stages = None  # Step classes and arguments of the chain, see resolve_steps()
+        self.find_class = None
+        self.max_keys = max_keys
+        self.idle_nanos = int(idle_seconds * 1e9)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.partitions = collections.OrderedDict()  # Key -> [step, timestamp of latest sample], least recent first
+        self.newest_timestamp = None
+        self.created = 0
+        self.evicted = 0
+
+    def __str__(self):
+        return "{}(step='{}', max_keys={}, idle_seconds={}, workers={})".format(
+            self.get_step_name(), self.step, self.max_keys, self.idle_nanos / 1e9, self.workers)
+
+    def partition_key(self, sample):
+        raise NotImplementedError()
+
+    def resolve_steps(self, find_class):
+        """Resolve the step names of the sub-step chain with find_class (e.g. StepRegistry.find_step_class), which
+        is also used for forks nested in the chain. Without calling this, only the steps defined in already imported
+        modules are found when the fork is initialized."""
+        # Resolve the step classes once, instead of for every new key
+        stages = [(find_class(name), args) for name, args in self.chain]
+        for step_class, _ in stages:
+            if step_class.is_async():
+                raise ValueError("{} cannot run the asynchronous step {}".format(
+                    self.get_step_name(), step_class.get_step_name()))
+        self.stages = stages
+        self.find_class = find_class
+
+    def initialize(self, context):
+        if self.stages is None:
+            self.resolve_steps(find_imported_step_class)
+        if self.workers > 0:
+            self.start_workers()
+        super().initialize(context)
+
+    def handle_sample(self, sample):
+        key = self.partition_key(sample)
+        if self.workers > 0:
+            self.send_to_worker(key, sample)
+            return
+        timestamp = sample.get_timestamp_nanos()
+        partition = self.partitions.get(key)
+        if partition is None:
+            if 0 < self.max_keys <= len(self.partitions):
+                self.evict(next(iter(self.partitions)))
+            partition = self.partitions[key] = [self.create_step(key), timestamp]
+        else:
+            self.partitions.move_to_end(key)
+            partition[1] = timestamp
+        partition[0].handle_sample(sample)
+        if self.newest_timestamp is None or timestamp > self.newest_timestamp:
+            self.newest_timestamp = timestamp
+        if self.idle_nanos > 0:
+            self.evict_idle()
+
+    def create_step(self, key):
+        steps = [instantiate_step_class(step_class, args) for step_class, args in self.stages]
+        for step in steps:
+            if isinstance(step, ForkStep):
+                step.resolve_steps(self.find_class)
+        step = steps[0] if len(steps) == 1 else StepChain(steps)
+        step.initialize(self.context)
+        self.created += 1
+        logging.debug("Created step {} for key '{}'".format(step, key))
+        return step
+
+    def evict_idle(self):
+        limit = self.newest_timestamp - self.idle_nanos
+        while self.partitions:
+            key, (_, timestamp) = next(iter(self.partitions.items()))
+            if timestamp > limit:
+                break
+            self.evict(key)
+
+    def evict(self, key):
+        step = self.remove_partition(key)
+        self.evicted += 1
+        logging.debug("Removed step {} of key '{}'".format(step, key))
+
+    def remove_partition(self, key):
+        step = self.partitions.pop(key)[0]
+        # Samples output while cleaning up are forwarded normally
+        step.cleanup()
+        return step
+
+    def cleanup(self):
+        if self.workers > 0:
+            self.stop_workers()
+            return
+        logging.info("{}: created {} step instance(s), removed {} before shutdown".format(
+            self.get_step_name(), self.created, self.evicted))
+        while self.partitions:
+            self.remove_partition(next(iter(self.partitions)))
+
+    # ================
+    # Worker processes
+    # ================
+
+    def start_workers(self):
+        # Every worker runs a copy of this step handling its partitions in-process. Copy before setting the context.
+        worker_step = copy.copy(self)
+        worker_step.workers = 0
+        worker_step.partitions = collections.OrderedDict()
+        mp_context = multiprocessing.get_context()
+        self.runner = ParallelRunner(self.workers, ordered=False, batch_size=self.batch_size)
+        self.results = mp_context.Queue()
+        self.tasks = [mp_context.Queue(maxsize=2) for _ in range(self.workers)]
+        self.buffers = [BatchBuffer() for _ in range(self.workers)]
+        self.buffered = [0] * self.workers
+        self.processes = [mp_context.Process(target=run_worker, args=(worker_step, 1, tasks, self.results),
+                                             name="bitflow-fork-{}".format(i), daemon=True)
+                          for i, tasks in enumerate(self.tasks)]
+        logging.info("Starting {} worker processes for {}".format(self.workers, self))
+        for process in self.processes:
+            process.start()
+
+    def send_to_worker(self, key, sample):
+        # zlib.crc32 is stable across processes, unlike hash() of strings
+        worker = zlib.crc32(str(key).encode()) % self.workers
+        self.buffers[worker].output_sample(sample)
+        self.buffered[worker] += 1
+        if self.buffered[worker] >= self.batch_size:
+            self.flush_worker(worker)
+
+    def flush_worker(self, worker):
+        self.runner.put(self.tasks[worker], (worker, self.buffers[worker].take()[0]), self.processes)
+        self.buffered[worker] = 0
+        while True:
+            result = self.runner.receive(self.results, self.processes, block=False)
+            if result is None:
+                break
+            self.output_results(*result[1:])
+
+    def output_results(self, data, num_samples):
+        channel = getattr(self.context, "channel", None)
+        # Write the marshalled results directly, if the fork outputs to a SampleChannel
+        self.runner.output(channel if isinstance(channel, SampleChannel) else self.context, data, num_samples)
+
+    def stop_workers(self):
+        try:
+            # Flush all workers before stopping any, flush_worker() must not receive the final results of a worker
+            for worker in range(self.workers):
+                if self.buffered[worker] > 0:
+                    self.flush_worker(worker)
+            for tasks in self.tasks:
+                self.runner.put(tasks, None, self.processes)
+            finished_workers = 0
+            while finished_workers < self.workers:
+                index, data, num_samples = self.runner.receive(self.results, self.processes)
+                if index is None:
+                    finished_workers += 1
+                self.output_results(data, num_samples)
+        finally:
+            for process in self.processes:
+                process.join(RESULT_POLL_SECONDS)
+                if process.is_alive():
+                    process.terminate()
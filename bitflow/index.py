@@ -0,0 +1,230 @@
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from bitflow.marshaller import BinaryMarshaller, BitflowProtocolError, FrameDecoder, detect_format, \
+    SAMPLE_MARKER_BYTE, SEPARATOR_BYTE, HEADER_END, TIMESTAMP_NUM_BYTES, METRIC_NUM_BYTES, LONG_STRUCT
+from bitflow.sample import BaseSample, datetime_to_nanos
+
+INDEX_SUFFIX = ".idx"
+DEFAULT_INDEX_INTERVAL = 1000
+INDEX_MAGIC = b"bitflow-index 1\n"
+# Index interval, size and modification time (ns) of the indexed file, number of entries
+INDEX_HEADER_STRUCT = struct.Struct(">qqqq")
+
+
+def parse_time(string):
+    """Parse a time bound given as integer nanoseconds since the epoch, or as UTC date and time
+    (e.g. "2020-04-11 07:49:52.828602"). Times with a UTC offset (e.g. "2020-04-11 09:49:52+02:00") are
+    converted to UTC."""
+    if string.isdigit():
+        return int(string)
+    try:
+        timestamp = datetime.datetime.fromisoformat(string)
+    except ValueError:
+        raise ValueError("Failed to parse time '{}', expected nanoseconds or 'YYYY-MM-DD HH:MM:SS[.ffffff][+HH:MM]'"
+                         .format(string))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return datetime_to_nanos(timestamp)
+
+
+class SampleIndex:
+    """Random-access index of a binary marshalled file. For every interval-th sample, the index stores the sample
+    number, the timestamp, the byte offset of the sample and the byte offset of the header it belongs to.
+    The index is stored in a sidecar file next to the data file (data file name + ".idx") and is rebuilt when the
+    size or modification time of the data file changes.
+    Seeking by time assumes that the timestamps in the file do not decrease."""
+
+    def __init__(self, interval=DEFAULT_INDEX_INTERVAL, data_size=0, data_mtime=0):
+        self.interval = interval
+        self.data_size = data_size
+        self.data_mtime = data_mtime
+        self.num_samples = 0
+        self.sample_numbers = array('q')
+        self.timestamps = array('q')
+        self.offsets = array('q')
+        self.header_offsets = array('q')
+
+    def __str__(self):
+        return "SampleIndex({} samples, {} entries, interval {})".format(
+            self.num_samples, len(self.offsets), self.interval)
+
+    @classmethod
+    def build(cls, data, interval=DEFAULT_INDEX_INTERVAL, data_size=None, data_mtime=0):
+        """Scan the binary marshalled data (e.g. a memory-mapped file) and index it. Only the frame boundaries are
+        decoded, the metric values and tags of the samples are skipped."""
+        index = cls(interval, len(data) if data_size is None else data_size, data_mtime)
+        marshaller = BinaryMarshaller()
+        end = len(data)
+        pos = 0
+        header_offset = -1
+        values_size = 0
+        num_samples = 0
+        while pos < end:
+            if header_offset >= 0 and data[pos] == SAMPLE_MARKER_BYTE[0]:
+                tags_start = pos + len(SAMPLE_MARKER_BYTE) + TIMESTAMP_NUM_BYTES
+                tags_end = data.find(SEPARATOR_BYTE, tags_start) if tags_start <= end else -1
+                frame_end = tags_end + len(SEPARATOR_BYTE) + values_size
+                if tags_end < 0 or frame_end > end:
+                    raise BitflowProtocolError("incomplete sample at offset {}".format(pos))
+                if num_samples % interval == 0:
+                    index.add(num_samples, LONG_STRUCT.unpack_from(data, pos + len(SAMPLE_MARKER_BYTE))[0],
+                              pos, header_offset)
+                num_samples += 1
+                pos = frame_end
+            else:
+                header_end = data.find(HEADER_END, pos)
+                frame_end = header_end + len(HEADER_END) if header_end >= 0 else end
+                if header_end < 0:
+                    header_end = end
+                lines = data[pos:header_end].decode("UTF-8").split("\n")
+                values_size = marshaller.parse_header_lines(lines).num_fields() * METRIC_NUM_BYTES
+                header_offset = pos
+                pos = frame_end
+        index.num_samples = num_samples
+        return index
+
+    def add(self, sample_number, timestamp, offset, header_offset):
+        self.sample_numbers.append(sample_number)
+        self.timestamps.append(timestamp)
+        self.offsets.append(offset)
+        self.header_offsets.append(header_offset)
+
+    # =======
+    # Seeking
+    # =======
+
+    def locate_sample(self, sample_number):
+        """Return the closest indexed position before the given sample as (sample number, offset, header offset),
+        or None if the sample lies before the first indexed sample"""
+        return self.entry(bisect.bisect_right(self.sample_numbers, sample_number) - 1)
+
+    def locate_time(self, timestamp):
+        """Return the indexed position of the last sample known to be older than the given timestamp (nanoseconds)
+        as (sample number, offset, header offset). Later samples might still be older."""
+        return self.entry(bisect.bisect_left(self.timestamps, timestamp) - 1)
+
+    def entry(self, i):
+        if i < 0:
+            return None
+        return self.sample_numbers[i], self.offsets[i], self.header_offsets[i]
+
+    # ===========
+    # Persistence
+    # ===========
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(INDEX_HEADER_STRUCT.pack(self.interval, self.data_size, self.data_mtime, len(self.offsets)))
+            f.write(LONG_STRUCT.pack(self.num_samples))
+            for column in (self.sample_numbers, self.timestamps, self.offsets, self.header_offsets):
+                if sys.byteorder == "little":
+                    column = array('q', column)
+                    column.byteswap()  # Store in network byte order, like the marshalled data
+                f.write(column.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(INDEX_MAGIC):
+            raise BitflowProtocolError("not a bitflow index file: {}".format(path))
+        pos = len(INDEX_MAGIC)
+        interval, data_size, data_mtime, num_entries = INDEX_HEADER_STRUCT.unpack_from(data, pos)
+        pos += INDEX_HEADER_STRUCT.size
+        index = cls(interval, data_size, data_mtime)
+        index.num_samples = LONG_STRUCT.unpack_from(data, pos)[0]
+        pos += LONG_STRUCT.size
+        column_size = num_entries * LONG_STRUCT.size
+        if len(data) != pos + 4 * column_size:
+            raise BitflowProtocolError("truncated bitflow index file: {}".format(path))
+        for column in (index.sample_numbers, index.timestamps, index.offsets, index.header_offsets):
+            column.frombytes(data[pos:pos + column_size])
+            if sys.byteorder == "little":
+                column.byteswap()
+            pos += column_size
+        return index
+
+    @classmethod
+    def load_or_build(cls, data_path, interval=DEFAULT_INDEX_INTERVAL):
+        """Load the sidecar index of the given binary file, or build and save it if it is missing or outdated.
+        Returns None if the file is not in the binary format."""
+        stat = os.stat(data_path)
+        index_path = data_path + INDEX_SUFFIX
+        try:
+            index = cls.load(index_path)
+            if index.data_size == stat.st_size and index.data_mtime == stat.st_mtime_ns and index.interval == interval:
+                return index
+        except (OSError, BitflowProtocolError, struct.error):
+            pass
+        if stat.st_size == 0:
+            return cls(interval, 0, stat.st_mtime_ns)
+        with open(data_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if detect_format(data) != "bin":
+                return None
+            index = cls.build(data, interval, stat.st_size, stat.st_mtime_ns)
+        logging.info("Indexed {}: {}".format(data_path, index))
+        try:
+            index.save(index_path)
+        except OSError as e:
+            logging.warning("Failed to store index file {}: {}".format(index_path, e))
+        return index
+
+
+class IndexedFile:
+    """Random access to the samples of a binary marshalled file through its SampleIndex.
+    The file is memory-mapped, samples are decoded starting from the closest indexed position."""
+
+    def __init__(self, path, index=None, compact_samples=False):
+        self.path = path
+        self.index = index if index is not None else SampleIndex.load_or_build(path)
+        if self.index is None:
+            raise BitflowProtocolError("not a binary marshalled file: {}".format(path))
+        self.marshaller = BinaryMarshaller(compact_samples=compact_samples)
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.index.data_size > 0 else b""
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def num_samples(self):
+        return self.index.num_samples
+
+    def decoder_at(self, position):
+        decoder = FrameDecoder(self.marshaller)
+        decoder.map(self.data)
+        if position is not None:
+            _, offset, header_offset = position
+            decoder.seek(offset, header_offset)
+        return decoder
+
+    def samples(self, start=0, stop=None):
+        """Iterate the samples with sample numbers from start (inclusive) to stop (exclusive)"""
+        position = self.index.locate_sample(start)
+        sample_number = position[0] if position is not None else 0
+        for result in iter(self.decoder_at(position).decode, None):
+            if stop is not None and sample_number >= stop:
+                return
+            if isinstance(result, BaseSample):
+                if sample_number >= start:
+                    yield result
+                sample_number += 1
+
+    def samples_between(self, from_nanos=None, to_nanos=None):
+        """Iterate the samples with timestamps from from_nanos (inclusive) to to_nanos (exclusive)"""
+        position = self.index.locate_time(from_nanos) if from_nanos is not None else None
+        for result in iter(self.decoder_at(position).decode, None):
+            if isinstance(result, BaseSample):
+                timestamp = result.get_timestamp_nanos()
+                if to_nanos is not None and timestamp >= to_nanos:
+                    return
+                if from_nanos is None or timestamp >= from_nanos:
+                    yield result
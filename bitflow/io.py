@@ -1,28 +1,257 @@
+import io
+import logging
+import mmap
+import os
+import queue
+import socket
+import stat
 import sys
+import threading
+import time
 
-from bitflow.marshaller import BinaryMarshaller, BitflowProtocolError
-from bitflow.sample import Sample, Header
+from bitflow.marshaller import BinaryMarshaller, CsvMarshaller, BitflowProtocolError, StreamDecoder, \
+    DEFAULT_CHUNK_SIZE, HEADER_START, HEADER_END, TAGS_FIELD
+from bitflow.parameters import parse_string_dict, ParameterParseException
+from bitflow.sample import BaseSample, Header
 
 
 # TODO necessary to close std in/out streams?
-# TODO correct/efficient use of buffered IO?
+
+class FlushPolicy:
+    """Decides when buffered output samples are flushed to the output stream.
+    Output is flushed after max_samples samples, when max_millis milliseconds passed since the last flush,
+    when no more input data is immediately available, and when the channel is closed."""
+
+    def __init__(self, max_samples=1, max_millis=None):
+        if max_samples is not None and max_samples < 1:
+            raise ValueError("Flush policy needs max_samples >= 1, got {}".format(max_samples))
+        if max_millis is not None and max_millis < 0:
+            raise ValueError("Flush policy needs max_millis >= 0, got {}".format(max_millis))
+        self.max_samples = max_samples
+        self.max_millis = max_millis
+
+    def __str__(self):
+        return "FlushPolicy(max_samples={}, max_millis={})".format(self.max_samples, self.max_millis)
+
+    @classmethod
+    def parse(cls, string):
+        # Format: "sample", or a combination of "samples=<N>" and "millis=<T>", e.g. "samples=100,millis=50"
+        if string == "sample":
+            return cls()
+        args = parse_string_dict(string.split(","))
+        unknown = set(args.keys()) - {"samples", "millis"}
+        if unknown or not args:
+            raise ParameterParseException("Failed to parse flush policy '{}', expected 'sample' or "
+                                          "'samples=<N>,millis=<T>'".format(string))
+        try:
+            max_samples = int(args["samples"]) if "samples" in args else None
+            max_millis = float(args["millis"]) if "millis" in args else None
+            return cls(max_samples=max_samples, max_millis=max_millis)
+        except ValueError as e:
+            raise ParameterParseException("Failed to parse flush policy '{}': {}".format(string, e))
+
+
+STD_ENDPOINT = "-"
+TCP_PREFIX = "tcp://"
+
+
+def parse_tcp_endpoint(endpoint):
+    # Format: tcp://host:port to connect to host, tcp://:port to listen on port
+    host, sep, port = endpoint[len(TCP_PREFIX):].rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError("Failed to parse TCP endpoint '{}', expected tcp://host:port or tcp://:port".format(endpoint))
+    return host, int(port)
+
+
+def open_tcp(endpoint, mode):
+    """Open a buffered binary stream for the given TCP endpoint. With an empty host, listen on the port and accept
+    a single connection, otherwise connect to the given host."""
+    host, port = parse_tcp_endpoint(endpoint)
+    if host:
+        sock = socket.create_connection((host, port))
+    else:
+        with socket.create_server(("", port)) as server:
+            logging.info("Waiting for connection on port {}".format(port))
+            sock, address = server.accept()
+            logging.info("Accepted connection from {}".format(address))
+    with sock:
+        # The returned stream keeps the connection open until it is closed
+        return sock.makefile(mode)
+
+
+def open_input(endpoint):
+    """Open an input endpoint: "-" for standard input, tcp://host:port or tcp://:port, or a file name.
+    Regular files are memory-mapped, so the data is decoded directly from the mapping. Other files (named pipes,
+    /dev/stdin, process substitution) are read as a buffered stream."""
+    if endpoint == STD_ENDPOINT:
+        return sys.stdin.buffer
+    if endpoint.startswith(TCP_PREFIX):
+        return open_tcp(endpoint, "rb")
+    f = open(endpoint, "rb")
+    status = os.fstat(f.fileno())
+    if not stat.S_ISREG(status.st_mode):
+        return f
+    with f:
+        if status.st_size == 0:
+            return io.BytesIO()  # Empty files cannot be mapped
+        # The mapping stays valid after closing the file
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_output(endpoint):
+    """Open an output endpoint: "-" for standard output, tcp://host:port or tcp://:port, or a file name"""
+    if endpoint == STD_ENDPOINT:
+        return sys.stdout.buffer
+    if endpoint.startswith(TCP_PREFIX):
+        return open_tcp(endpoint, "wb")
+    return open(endpoint, "wb")
+
+
+DATA_FORMATS = ("bin", "csv")
+AUTO_FORMAT = "auto"
+# The first lines of every header in the binary format
+HEADER_PREFIX = "{}\n{}\n".format(HEADER_START, TAGS_FIELD).encode("UTF-8")
+
+
+def create_marshaller(data_format, compact_samples=False, keep_raw_samples=True):
+    if data_format == "bin":
+        return BinaryMarshaller(compact_samples=compact_samples, keep_raw_samples=keep_raw_samples)
+    elif data_format == "csv":
+        return CsvMarshaller(compact_samples=compact_samples)
+    raise ValueError("Unknown data format '{}', expected one of {}".format(data_format, ", ".join(DATA_FORMATS)))
+
 
 class SampleChannel:
+    """Reads samples from the input stream and writes samples to the output stream.
+    The input format is detected automatically by default ("auto"), or can be fixed to "bin" or "csv".
+    Output is written in the binary format by default.
+    Only input samples with timestamps between from_time (inclusive) and to_time (exclusive, both in nanoseconds)
+    are read, if given. For a memory-mapped input file with a bitflow.index.SampleIndex, reading starts at the
+    indexed position closest to from_time instead of scanning all preceding samples."""
 
-    def __init__(self, input_stream=None, output_stream=None):
+    def __init__(self, input_stream=None, output_stream=None, flush_policy=None, compact_samples=False,
+                 keep_raw_samples=True, chunk_size=DEFAULT_CHUNK_SIZE, input_format=AUTO_FORMAT, output_format="bin",
+                 from_time=None, to_time=None, input_index=None):
         if input_stream is None:
             input_stream = sys.stdin.buffer
         if output_stream is None:
             output_stream = sys.stdout.buffer
-        self.marshaller = BinaryMarshaller()
+        if flush_policy is None:
+            flush_policy = FlushPolicy()
+        self.output_format = output_format
+        self.marshaller = create_marshaller(output_format, compact_samples, keep_raw_samples)
         self.out_header = None
         self.in_header = None
-        self.writer = self.FlushingWriter(output_stream)
+        self.writer = self.FlushingWriter(output_stream, flush_policy)
         self.reader = input_stream
+        if input_format == AUTO_FORMAT:
+            formats = {data_format: self.input_marshaller(data_format, compact_samples, keep_raw_samples)
+                       for data_format in DATA_FORMATS}
+            self.decoder = StreamDecoder(input_stream, chunk_size=chunk_size, before_read=self.input_idle,
+                                         formats=formats)
+        else:
+            marshaller = self.input_marshaller(input_format, compact_samples, keep_raw_samples)
+            self.decoder = StreamDecoder(input_stream, marshaller, chunk_size=chunk_size, before_read=self.input_idle)
+        self.from_time = from_time
+        self.to_time = to_time
+        self.end_of_input = False
+        if input_index is not None and from_time is not None:
+            position = input_index.locate_time(from_time)
+            if position is not None:
+                _, offset, header_offset = position
+                self.in_header = self.decoder.seek(offset, header_offset)
+        # Flush buffered output when the input runs dry. Disabled when reading and writing happen in different threads.
+        self.flush_on_idle_input = True
+
+    def enable_statistics(self, stats):
+        """Record input and output counters and the decode and encode latencies in the given
+        bitflow.stats.Statistics. The time spent waiting for input and flushing output is not counted as decode
+        or encode time. Without calling this, reading and writing are not instrumented at all."""
+        clock = time.perf_counter_ns
+        decoder = self.decoder
+        writer = self.writer
+        # Time spent in input and output stream operations, excluded from the decode and encode latencies.
+        # Separate counters, because reading and writing can happen in different threads.
+        input_io_nanos = [0]
+        output_io_nanos = [0]
+        mapped = decoder.readinto is None
+
+        def timed_io(func, count_bytes, io_nanos):
+            def timed_func(*args):
+                start = clock()
+                result = func(*args)
+                io_nanos[0] += clock() - start
+                if count_bytes:
+                    count_bytes(args, result)
+                return result
+            return timed_func
+
+        def count_bytes_in(args, num_bytes):
+            stats.bytes_in += num_bytes or 0
+
+        def count_bytes_out(args, result):
+            stats.bytes_out += len(args[0])
+
+        def read():
+            io_before = input_io_nanos[0]
+            if mapped:
+                position = decoder.decoder.start
+            start = clock()
+            result = decoder_read()
+            stats.decode.record(clock() - start - (input_io_nanos[0] - io_before))
+            if mapped:
+                # Count the consumed part of the memory-mapped input, which might be skipped or left early
+                stats.bytes_in += max(0, decoder.decoder.start - position)
+            if isinstance(result, BaseSample):
+                stats.samples_in += 1
+            elif isinstance(result, Header):
+                stats.header_changes += 1
+            return result
+
+        def output_sample(sample):
+            io_before = output_io_nanos[0]
+            start = clock()
+            channel_output_sample(sample)
+            stats.encode.record(clock() - start - (output_io_nanos[0] - io_before))
+            stats.samples_out += 1
+
+        def output_marshalled(data, num_samples):
+            io_before = output_io_nanos[0]
+            start = clock()
+            channel_output_marshalled(data, num_samples)
+            if num_samples > 0:
+                # Spread the time spent on the block evenly over its samples
+                elapsed = clock() - start - (output_io_nanos[0] - io_before)
+                stats.encode.record(elapsed // num_samples, num_samples)
+                stats.samples_out += num_samples
+
+        if not mapped:
+            decoder.readinto = timed_io(decoder.readinto, count_bytes_in, input_io_nanos)
+        if decoder.before_read is not None:
+            decoder.before_read = timed_io(decoder.before_read, None, input_io_nanos)
+        decoder_read = decoder.read
+        decoder.read = read
+        writer.write = timed_io(writer.write, count_bytes_out, output_io_nanos)
+        writer.flush = timed_io(writer.flush, None, output_io_nanos)
+        channel_output_sample = self.output_sample
+        self.output_sample = output_sample
+        if self.output_format == "bin":
+            # In other formats, the block is converted and written through the instrumented output_sample
+            channel_output_marshalled = self.output_marshalled
+            self.output_marshalled = output_marshalled
+        if self.in_header is not None:
+            # The header was decoded while seeking to from_time, outside of the instrumented read
+            stats.header_changes += 1
+
+    def input_marshaller(self, data_format, compact_samples, keep_raw_samples):
+        if data_format == self.output_format:
+            # Share the marshaller and its tag caches between input and output
+            return self.marshaller
+        return create_marshaller(data_format, compact_samples, keep_raw_samples)
 
     def close(self):
-        # We do not explicitely close the std in/out streams
-        pass
+        # We do not explicitely close the std in/out streams, but make sure all buffered output is written
+        self.writer.flush()
 
     # ===============================
     # Writing samples to standard out
@@ -33,6 +262,30 @@ class SampleChannel:
             self.out_header = sample.header
             self.marshaller.write_header(stream=self.writer, header=self.out_header)
         self.marshaller.write_sample(stream=self.writer, sample=sample)
+        self.writer.sample_written()
+
+    def output_marshalled(self, data, num_samples):
+        """Write a block of num_samples samples that was already marshalled in the binary format. The block must
+        start with a header. It is counted as one sample by the flush policy."""
+        if self.output_format != "bin":
+            # Convert the block to the output format
+            decoder = BinaryMarshaller(keep_raw_samples=False).create_decoder()
+            decoder.feed(data)
+            decoder.finish()
+            for sampleOrHeader in iter(decoder.decode, None):
+                if isinstance(sampleOrHeader, BaseSample):
+                    self.output_sample(sampleOrHeader)
+            return
+        header_end = data.find(HEADER_END)
+        header = self.marshaller.parse_header_lines(data[:header_end].decode("UTF-8").split("\n"))
+        # Might also match inside a sample, which only causes the header to be written again unnecessarily
+        header_changes = data.find(HEADER_PREFIX, header_end) >= 0
+        if not self.out_header_changed(header):
+            data = memoryview(data)[header_end + len(HEADER_END):]  # Skip the header, it was already written
+        self.writer.write(data)
+        # Write the header again before the next sample, if the block might have changed it
+        self.out_header = None if header_changes else header
+        self.writer.sample_written()
 
     def out_header_changed(self, new_header):
         if self.out_header is None:
@@ -40,26 +293,145 @@ class SampleChannel:
         return self.out_header.has_changed(new_header)
 
     class FlushingWriter:
-        def __init__(self, stream):
+        def __init__(self, stream, policy):
             self.stream = stream
+            self.max_samples = policy.max_samples
+            self.max_seconds = policy.max_millis / 1000 if policy.max_millis is not None else None
+            self.pending_samples = 0
+            self.last_flush = time.monotonic()
 
         def write(self, data):
             self.stream.write(data)
+
+        def sample_written(self):
+            self.pending_samples += 1
+            if self.max_samples is not None and self.pending_samples >= self.max_samples:
+                self.flush()
+            elif self.max_seconds is not None and time.monotonic() - self.last_flush >= self.max_seconds:
+                self.flush()
+
+        def flush(self):
             self.stream.flush()
+            self.pending_samples = 0
+            if self.max_seconds is not None:
+                self.last_flush = time.monotonic()
 
     # ================================
     # Reading samples from standard in
     # ================================
 
     def read_sample(self):
+        return self.next_sample(self.decoder.read)
+
+    def next_sample(self, read):
+        """Return the next input sample, using the read function to obtain decoded Headers and Samples.
+        Returns None when read() returns None, or when the end of the time range was reached (see end_of_input)."""
         while True:
-            sampleOrHeader = self.marshaller.read(self.reader, self.in_header)
+            if self.end_of_input:
+                return None
+            sampleOrHeader = read()
             if sampleOrHeader is None:
+                self.input_idle()
                 return None  # Possible EOF
-            if isinstance(sampleOrHeader, Sample):
-                return sampleOrHeader
+            if isinstance(sampleOrHeader, BaseSample):
+                if self.from_time is None and self.to_time is None:
+                    return sampleOrHeader
+                timestamp = sampleOrHeader.get_timestamp_nanos()
+                if self.to_time is not None and timestamp >= self.to_time:
+                    self.input_idle()
+                    self.end_of_input = True  # The input is assumed to be ordered by time, skip the rest
+                    return None
+                if self.from_time is None or timestamp >= self.from_time:
+                    return sampleOrHeader
             elif isinstance(sampleOrHeader, Header):
                 # Wait for the next received sample
                 self.in_header = sampleOrHeader
             else:
                 raise BitflowProtocolError("wrong unmarshalled object", "Header or Sample", sampleOrHeader)
+
+    def input_idle(self):
+        # Called before reading more input, which might block. Do not hold back buffered output in the meantime.
+        if self.flush_on_idle_input and self.writer.pending_samples > 0:
+            self.writer.flush()
+
+
+DEFAULT_QUEUE_DEPTH = 1000
+DEFAULT_IDLE_FLUSH_SECONDS = 0.01
+_CLOSE = object()
+
+
+class PipelinedSampleChannel:
+    """Wraps a SampleChannel and moves reading and decoding of input samples, as well as encoding and writing of
+    output samples, to two background threads. The threads exchange samples with the processing step through
+    queues of queue_depth samples. A full queue blocks the producing side to limit memory usage.
+    Buffered output is flushed according to the flush policy of the wrapped channel, and additionally when no
+    output sample arrived for the flush interval of the policy (or 10 milliseconds)."""
+
+    def __init__(self, channel, queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.channel = channel
+        self.channel.flush_on_idle_input = False
+        self.input_queue = queue.Queue(maxsize=queue_depth)
+        self.output_queue = queue.Queue(maxsize=queue_depth)
+        self.idle_flush_seconds = channel.writer.max_seconds or DEFAULT_IDLE_FLUSH_SECONDS
+        self.input_finished = False
+        self.write_error = None
+        self.reader_thread = threading.Thread(target=self.read_loop, name="bitflow-reader", daemon=True)
+        self.writer_thread = threading.Thread(target=self.write_loop, name="bitflow-writer", daemon=True)
+        self.reader_thread.start()
+        self.writer_thread.start()
+
+    def read_sample(self):
+        if self.input_finished:
+            return None
+        sample = self.input_queue.get()
+        if isinstance(sample, Exception):
+            self.input_finished = True
+            raise sample
+        if sample is None:
+            self.input_finished = True
+        return sample
+
+    def output_sample(self, sample):
+        if self.write_error is not None:
+            raise self.write_error
+        self.output_queue.put(sample)
+
+    def close(self):
+        self.output_queue.put(_CLOSE)
+        self.writer_thread.join()
+        self.channel.close()
+        if self.write_error is not None:
+            raise self.write_error
+
+    def read_loop(self):
+        try:
+            while True:
+                sample = self.channel.read_sample()
+                self.input_queue.put(sample)
+                if sample is None:
+                    break
+        except Exception as e:
+            self.input_queue.put(e)
+
+    def write_loop(self):
+        while True:
+            try:
+                sample = self.output_queue.get(timeout=self.idle_flush_seconds)
+            except queue.Empty:
+                if self.channel.writer.pending_samples > 0:
+                    self.flush()
+                sample = self.output_queue.get()
+            if sample is _CLOSE:
+                break
+            if self.write_error is not None:
+                continue  # Keep consuming to avoid blocking the processing step, the error is reported there
+            try:
+                self.channel.output_sample(sample)
+            except Exception as e:
+                self.write_error = e
+
+    def flush(self):
+        try:
+            self.channel.writer.flush()
+        except Exception as e:
+            self.write_error = e
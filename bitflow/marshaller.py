@@ -1,7 +1,11 @@
 import datetime
+import mmap
 import struct
+import sys
+from array import array
+from collections import OrderedDict, deque
 
-from bitflow.sample import Sample, Header
+from bitflow.sample import Sample, CompactSample, Header, nanos_to_datetime, datetime_to_nanos, EPOCH
 
 
 class BitflowProtocolError(Exception):
@@ -24,9 +28,34 @@ SEPARATOR_BYTE = b'\n'
 TAGS_SEPARATOR = " "
 TAGS_EQ = "="
 
+CSV_TIME_FIELD = "time"
+CSV_SEPARATOR = ","
+CSV_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+HEADER_END = SEPARATOR_BYTE + SEPARATOR_BYTE
+LONG_STRUCT = struct.Struct('>Q')
+TAG_CACHE_SIZE = 1024
+
 
 class BinaryMarshaller:
 
+    def __init__(self, compact_samples=False, keep_raw_samples=True):
+        """If compact_samples is set, samples are decoded to CompactSample objects instead of Sample.
+        If keep_raw_samples is set, decoded samples keep their marshalled bytes, which are written out again
+        without re-marshalling as long as the sample is not modified."""
+        self.compact_samples = compact_samples
+        self.keep_raw_samples = keep_raw_samples
+        # Most streams repeat the same few tag sets, cache the parsed and formatted versions of the most recent ones
+        self.parsed_tags_cache = OrderedDict()
+        self.formatted_tags_cache = OrderedDict()
+        # Precompiled struct objects for unpacking all metric values of a sample at once, keyed by the number of fields
+        self.metric_structs = {}
+
+    def create_decoder(self):
+        return FrameDecoder(self)
+
     # ===============
     # General helpers
     # ===============
@@ -43,6 +72,13 @@ class BinaryMarshaller:
     def unpack_double(self, data):
         return struct.unpack('>d', data)[0]
 
+    def metrics_struct(self, num_fields):
+        metrics_struct = self.metric_structs.get(num_fields)
+        if metrics_struct is None:
+            metrics_struct = struct.Struct('>{}d'.format(num_fields))
+            self.metric_structs[num_fields] = metrics_struct
+        return metrics_struct
+
     def pack_string(self, string):
         return bytes(string, "UTF-8")
 
@@ -90,27 +126,53 @@ class BinaryMarshaller:
                 break  # Empty line terminates the header
             fields.append(fieldName)
 
-        return Header(fields)
+        return Header.intern(fields)
 
     def read_sample(self, stream, header):
-        stream.read(len(SAMPLE_MARKER_BYTE))  # Result ignored, was already peeked
+        markerBytes = stream.read(len(SAMPLE_MARKER_BYTE))  # Was already peeked
 
-        num_fields = header.num_fields()
+        metrics_struct = self.metrics_struct(header.num_fields())
         timeBytes = stream.read(TIMESTAMP_NUM_BYTES)
-        tagBytes = self.read_line(stream)  # New line terminates the tags
-        valueBytes = stream.read(num_fields * METRIC_NUM_BYTES)
-
-        timestamp = self.unpack_utc_nanos_timestamp(self.unpack_long(timeBytes))
-        tags = self.parse_tags(tagBytes)
-
-        metrics = []
-        for index in range(num_fields):
-            offset = index * METRIC_NUM_BYTES
-            metricBytes = valueBytes[offset: offset + METRIC_NUM_BYTES]
-            metric = self.unpack_double(metricBytes)
-            metrics.append(metric)
+        tagLine = stream.readline()  # New line terminates the tags
+        valueBytes = stream.read(metrics_struct.size)
+
+        # The timestamp is passed on as integer nanoseconds, a datetime object is only created on demand
+        timestamp = self.unpack_long(timeBytes)
+        tagBytes = tagLine[:-1]
+        sample = self.make_sample(header, timestamp, self.parse_tags_cached(tagBytes), valueBytes, 0, metrics_struct)
+        if self.keep_raw_samples:
+            sample.set_raw_bytes(b"".join((markerBytes, timeBytes, tagLine, valueBytes)))
+        return sample
+
+    def make_sample(self, header, timestamp, tags, data, values_offset, metrics_struct):
+        if self.compact_samples:
+            values = data[values_offset:values_offset + metrics_struct.size]
+            return CompactSample(header=header, metrics=self.unpack_double_array(values, metrics_struct.size),
+                                 timestamp=timestamp, tags=tags)
+        # Decode all metric values in one call instead of unpacking every value separately
+        metrics = list(metrics_struct.unpack_from(data, values_offset))
         return Sample(header=header, metrics=metrics, timestamp=timestamp, tags=tags)
 
+    def unpack_double_array(self, data, expected_size):
+        if len(data) != expected_size:
+            raise struct.error("unpack requires a buffer of {} bytes".format(expected_size))
+        values = array('d', data)
+        if sys.byteorder == "little":
+            values.byteswap()  # Network byte order (big endian) to native byte order
+        return values
+
+    def parse_tags_cached(self, data):
+        # The tags can be given as raw bytes or as already decoded string
+        tags = self.parsed_tags_cache.get(data)
+        if tags is None:
+            tags = self.parse_tags(data if isinstance(data, str) else self.unpack_string(data))
+            self.parsed_tags_cache[data] = tags
+            if len(self.parsed_tags_cache) > TAG_CACHE_SIZE:
+                self.parsed_tags_cache.popitem(last=False)
+        else:
+            self.parsed_tags_cache.move_to_end(data)
+        return dict(tags)  # Every sample gets its own modifiable copy
+
     def parse_tags(self, tags_string):
         tags_dict = {}
         if tags_string == "":
@@ -127,27 +189,66 @@ class BinaryMarshaller:
     def read_line(self, stream):
         return self.unpack_string(stream.readline())[:-1]
 
+    def parse_header_lines(self, lines):
+        if lines[0] != HEADER_START:
+            raise BitflowProtocolError("unexpected line", HEADER_START, lines[0])
+        if len(lines) < 2 or lines[1] != TAGS_FIELD:
+            raise BitflowProtocolError("unexpected line", TAGS_FIELD, lines[1] if len(lines) > 1 else "")
+        return Header.intern(lines[2:])
+
     # ==========================================
     # Formatting and sending samples and headers
     # ==========================================
 
     def write_sample(self, stream, sample):
-        stream.write(SAMPLE_MARKER_BYTE)
-        stream.write(self.pack_long(self.pack_utc_nanos_timestamp(sample)))
-        stream.write(self.pack_string(self.format_tags(sample)))
-        stream.write(SEPARATOR_BYTE)
-        for val in sample.metrics:
-            stream.write(self.pack_double(val))
+        data = sample.get_raw_bytes()
+        if data is None:
+            data = self.format_sample(sample)
+        stream.write(data)
 
     def write_header(self, stream, header):
-        for field in [HEADER_START, TAGS_FIELD] + header.metric_names:
-            stream.write(self.pack_string(field))
-            stream.write(SEPARATOR_BYTE)
-        stream.write(SEPARATOR_BYTE)
+        stream.write(self.format_header(header))
+
+    # Assemble the complete binary representation of a sample, so that it can be written with a single call
+    def format_sample(self, sample):
+        return b"".join((
+            SAMPLE_MARKER_BYTE,
+            self.pack_long(self.pack_utc_nanos_timestamp(sample)),
+            self.format_tags_bytes(sample),
+            SEPARATOR_BYTE,
+            self.pack_metrics(sample._metrics)))
+
+    def pack_metrics(self, metrics):
+        if isinstance(metrics, array) and metrics.typecode == 'd':
+            if sys.byteorder == "little":
+                metrics = array('d', metrics)
+                metrics.byteswap()
+            return metrics.tobytes()
+        return self.metrics_struct(len(metrics)).pack(*metrics)
+
+    def format_header(self, header):
+        fields = [HEADER_START, TAGS_FIELD] + header.metric_names
+        return self.pack_string("\n".join(fields)) + SEPARATOR_BYTE + SEPARATOR_BYTE
+
+    def format_tags_bytes(self, sample):
+        # Keyed on the current contents of the tags dictionary, so that tags modified in place are never stale
+        key = tuple(sample._tags.items())
+        try:
+            data = self.formatted_tags_cache.get(key)
+        except TypeError:
+            return self.pack_string(self.format_tags(sample))  # Tag values that are not hashable cannot be cached
+        if data is None:
+            data = self.pack_string(self.format_tags(sample))
+            self.formatted_tags_cache[key] = data
+            if len(self.formatted_tags_cache) > TAG_CACHE_SIZE:
+                self.formatted_tags_cache.popitem(last=False)
+        else:
+            self.formatted_tags_cache.move_to_end(key)
+        return data
 
     def format_tags(self, sample):
         s = ""
-        pairs = ["{}={}".format(key, value) for key, value in sample.get_tags().items()]
+        pairs = ["{}={}".format(key, value) for key, value in sample._tags.items()]
         pairs.sort()
         return " ".join(pairs)
 
@@ -158,14 +259,366 @@ class BinaryMarshaller:
     # Printing the timestamps as-is might result in a time that deviates from the local time.
     # Especially, UTC timetamps differ from what is printed by the Go-based bitflow-pipeline tool, which converts to local time.
 
-    epoch = datetime.datetime.utcfromtimestamp(0)
-
     def unpack_utc_nanos_timestamp(self, timestamp):
-        seconds = timestamp // 1000000000
-        micros = (timestamp // 1000) % 1000000
-        return datetime.datetime.utcfromtimestamp(seconds) + datetime.timedelta(microseconds=micros)
+        return nanos_to_datetime(timestamp)
 
     def pack_utc_nanos_timestamp(self, sample):
-        time = sample.get_timestamp()
-        delta = time - self.epoch
-        return int(delta.total_seconds() * 1000000000)  # Nanoseconds, rounded to microseconds
+        return sample.get_timestamp_nanos()
+
+
+class CsvMarshaller(BinaryMarshaller):
+    """Reads and writes the Bitflow CSV format. The first column holds the timestamp, the optional second column
+    the tags, the remaining columns the metric values. A line starting with the "time" column starts a new header.
+    Timestamps are interpreted as UTC, with up to nanosecond precision.
+    Tag parsing and formatting, including the caches, are shared with the binary format."""
+
+    def __init__(self, compact_samples=False):
+        # The marshalled bytes of CSV samples cannot be reused for the binary format
+        super().__init__(compact_samples=compact_samples, keep_raw_samples=False)
+        self.header = None  # Header of the CSV data read most recently
+        self.has_tags = True
+        self.last_seconds = None
+        self.last_seconds_nanos = 0
+        self.last_formatted_second = None
+        self.last_formatted_seconds = ""
+
+    def create_decoder(self):
+        return CsvDecoder(self)
+
+    # =======================================
+    # Reading and parsing samples and headers
+    # =======================================
+
+    # Read either a Header or a Sample from the stream, one line at a time.
+    def read(self, stream, previousHeader):
+        while True:
+            line = stream.readline()
+            if len(line) == 0:
+                return None  # Possible EOF
+            line = self.unpack_string(line).rstrip("\r\n")
+            if line:
+                try:
+                    return self.parse_line(line, previousHeader)
+                except (ValueError, UnicodeDecodeError) as e:
+                    raise BitflowProtocolError("failed to parse CSV line '{}': {}".format(line, e))
+
+    def parse_line(self, line, header=None):
+        fields = line.split(CSV_SEPARATOR)
+        if fields[0] == CSV_TIME_FIELD:
+            self.has_tags = len(fields) > 1 and fields[1] == TAGS_FIELD
+            self.header = Header.intern(fields[2:] if self.has_tags else fields[1:])
+            return self.header
+        if header is None:
+            header = self.header
+        if header is None:
+            raise BitflowProtocolError("unexpected line", "CSV header starting with " + CSV_TIME_FIELD, line)
+        values_start = 2 if self.has_tags else 1
+        if len(fields) - values_start != header.num_fields():
+            raise BitflowProtocolError("unexpected number of CSV fields", header.num_fields() + values_start,
+                                       len(fields))
+        timestamp = self.parse_timestamp(fields[0])
+        tags = self.parse_tags_cached(fields[1]) if self.has_tags else {}
+        # Convert all metric values of the row in one pass
+        values = map(float, fields[values_start:])
+        if self.compact_samples:
+            return CompactSample(header=header, metrics=array('d', values), timestamp=timestamp, tags=tags)
+        return Sample(header=header, metrics=list(values), timestamp=timestamp, tags=tags)
+
+    def parse_timestamp(self, string):
+        # Format: 2006-01-02 15:04:05.999999999, consecutive samples mostly share the seconds part
+        seconds, _, fraction = string.partition(".")
+        if seconds != self.last_seconds:
+            self.last_seconds_nanos = datetime_to_nanos(datetime.datetime.strptime(seconds, CSV_TIME_FORMAT))
+            self.last_seconds = seconds
+        if not fraction:
+            return self.last_seconds_nanos
+        return self.last_seconds_nanos + int(fraction[:9].ljust(9, "0"))
+
+    # ==========================================
+    # Formatting and sending samples and headers
+    # ==========================================
+
+    def write_sample(self, stream, sample):
+        stream.write(self.format_sample(sample))
+
+    def format_sample(self, sample):
+        return b"".join((
+            self.pack_string(self.format_timestamp(sample.get_timestamp_nanos())),
+            b",",
+            self.format_tags_bytes(sample),
+            b",",
+            self.pack_string(CSV_SEPARATOR.join(map(str, sample._metrics))),
+            SEPARATOR_BYTE))
+
+    def format_header(self, header):
+        return self.pack_string(CSV_SEPARATOR.join([CSV_TIME_FIELD, TAGS_FIELD] + header.metric_names)) + SEPARATOR_BYTE
+
+    def format_timestamp(self, nanos):
+        seconds, fraction = divmod(nanos, 1000000000)
+        if seconds != self.last_formatted_second:
+            self.last_formatted_seconds = (EPOCH + datetime.timedelta(seconds=seconds)).strftime(CSV_TIME_FORMAT)
+            self.last_formatted_second = seconds
+        if fraction == 0:
+            return self.last_formatted_seconds
+        return "{}.{}".format(self.last_formatted_seconds, str(fraction).rjust(9, "0").rstrip("0"))
+
+
+class ChunkDecoder:
+    """Collects data that arrives in chunks of arbitrary size in a reusable buffer. Subclasses implement decode()
+    for a specific data format. Frames that are incomplete at the end of a chunk are kept in the buffer
+    until the following chunks complete them."""
+
+    def __init__(self, marshaller):
+        self.marshaller = marshaller
+        self.buffer = bytearray()
+        self.start = 0  # Start of the data that was not decoded yet
+        self.end = 0  # End of the valid data in the buffer
+        self.header = None
+        self.finished = False
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def fill(self, readinto, min_space):
+        """Read directly into the free space of the buffer with the given readinto function.
+        Returns the number of bytes read, 0 signals the end of the input."""
+        self.reserve(min_space)
+        with memoryview(self.buffer) as view, view[self.end:] as free_space:
+            num_bytes = readinto(free_space) or 0
+        self.end += num_bytes
+        return num_bytes
+
+    def map(self, data):
+        """Decode the complete input from the given buffer (e.g. a memory-mapped file) without copying it.
+        The buffer replaces the internal buffer, feed() and fill() must not be used afterwards."""
+        self.buffer = data
+        self.start = 0
+        self.end = len(data)
+        self.finish()
+
+    def finish(self):
+        """Signal that no more data will be fed. Remaining incomplete frames are reported as errors by decode()."""
+        self.finished = True
+
+    def reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+        # Move the data that was not decoded yet to the front of the buffer, then grow the buffer if necessary
+        pending = self.end - self.start
+        if self.start > 0:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        missing = size - (len(self.buffer) - self.end)
+        if missing > 0:
+            self.buffer.extend(bytes(max(missing, len(self.buffer))))
+
+    def available(self):
+        return self.end - self.start
+
+    def take_over(self, decoder):
+        """Continue decoding the data collected by another decoder"""
+        self.buffer, self.start, self.end, self.finished = decoder.buffer, decoder.start, decoder.end, decoder.finished
+        return self
+
+    def decode(self):
+        """Return the next complete Header or Sample, or None if more data is required"""
+        return None
+
+
+class FrameDecoder(ChunkDecoder):
+    """Decodes headers and samples from binary marshalled data that arrives in chunks of arbitrary size"""
+
+    def __init__(self, marshaller=None):
+        super().__init__(marshaller if marshaller is not None else BinaryMarshaller())
+
+    def decode(self):
+        if self.start >= self.end:
+            return None
+        try:
+            if self.header is not None and self.buffer[self.start] == SAMPLE_MARKER_BYTE[0]:
+                return self.decode_sample()
+            return self.decode_header()
+        except (struct.error, UnicodeDecodeError) as e:
+            raise BitflowProtocolError("failed to parse data: {}".format(str(e)))
+
+    def decode_header(self):
+        buffer = self.buffer
+        header_end = buffer.find(HEADER_END, self.start, self.end)
+        if header_end >= 0:
+            frame_end = header_end + len(HEADER_END)
+        elif self.finished:
+            # Accept a header that is not terminated by an empty line at the end of the input
+            header_end = frame_end = self.end
+        else:
+            # Fail early instead of waiting for more data if this is not a header
+            first_line_end = buffer.find(SEPARATOR_BYTE, self.start, self.end)
+            if first_line_end >= 0 and buffer[self.start:first_line_end] != HEADER_START.encode("UTF-8"):
+                raise BitflowProtocolError("unexpected line", HEADER_START,
+                                           buffer[self.start:first_line_end].decode("UTF-8", "replace"))
+            return None
+        lines = buffer[self.start:header_end].decode("UTF-8").split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        self.header = self.marshaller.parse_header_lines(lines)
+        self.start = frame_end
+        return self.header
+
+    def decode_sample(self):
+        buffer = self.buffer
+        start = self.start
+        metrics_struct = self.marshaller.metrics_struct(self.header.num_fields())
+        tags_start = start + len(SAMPLE_MARKER_BYTE) + TIMESTAMP_NUM_BYTES
+        tags_end = buffer.find(SEPARATOR_BYTE, tags_start, self.end) if tags_start <= self.end else -1
+        if tags_end < 0:
+            return self.incomplete_sample()
+        values_start = tags_end + len(SEPARATOR_BYTE)
+        frame_end = values_start + metrics_struct.size
+        if frame_end > self.end:
+            return self.incomplete_sample()
+
+        timestamp = LONG_STRUCT.unpack_from(buffer, start + len(SAMPLE_MARKER_BYTE))[0]
+        tags_bytes = bytes(buffer[tags_start:tags_end])
+        tags = self.marshaller.parse_tags_cached(tags_bytes)
+        sample = self.marshaller.make_sample(self.header, timestamp, tags, buffer, values_start, metrics_struct)
+        if self.marshaller.keep_raw_samples:
+            sample.set_raw_bytes(bytes(buffer[start:frame_end]))
+        self.start = frame_end
+        return sample
+
+    def seek(self, offset, header_offset):
+        """Continue decoding mapped input at the given offset, using the header located at header_offset.
+        Returns that header."""
+        self.start = header_offset
+        self.header = None
+        header = self.decode()
+        if not isinstance(header, Header):
+            raise BitflowProtocolError("no header at offset {}".format(header_offset))
+        self.start = offset
+        return header
+
+    def incomplete_sample(self):
+        if self.finished:
+            raise BitflowProtocolError("incomplete sample at the end of the input ({} bytes)".format(
+                self.end - self.start))
+        return None
+
+
+class CsvDecoder(ChunkDecoder):
+    """Decodes headers and samples from CSV data that arrives in chunks of arbitrary size.
+    All complete lines of a chunk are decoded and split at once, then converted to samples one by one."""
+
+    def __init__(self, marshaller=None):
+        super().__init__(marshaller if marshaller is not None else CsvMarshaller())
+        self.lines = deque()
+
+    def decode(self):
+        while True:
+            if not self.lines and not self.split_lines():
+                return None
+            line = self.lines.popleft()
+            if line:
+                try:
+                    return self.marshaller.parse_line(line)
+                except ValueError as e:
+                    raise BitflowProtocolError("failed to parse CSV line '{}': {}".format(line, e))
+
+    def split_lines(self):
+        last_line_end = self.buffer.rfind(SEPARATOR_BYTE, self.start, self.end)
+        if last_line_end >= 0:
+            data_end = next_start = last_line_end + len(SEPARATOR_BYTE)
+        elif self.finished and self.start < self.end:
+            data_end = next_start = self.end  # Last line without terminating newline
+        else:
+            return False
+        try:
+            text = self.buffer[self.start:data_end].decode("UTF-8")
+        except UnicodeDecodeError as e:
+            raise BitflowProtocolError("failed to parse data: {}".format(str(e)))
+        self.start = next_start
+        self.lines.extend(line[:-1] if line.endswith("\r") else line for line in text.split("\n"))
+        return True
+
+
+FORMAT_DETECTION_BYTES = len(HEADER_START)
+
+
+def detect_format(data):
+    """Return the name of the data format ("bin" or "csv") based on the first bytes of the data"""
+    if bytes(data[:FORMAT_DETECTION_BYTES]) == HEADER_START.encode("UTF-8"):
+        return "bin"
+    return "csv"
+
+
+class StreamDecoder:
+    """Reads marshalled data from a stream in large chunks and decodes it with the decoder of the marshaller.
+    If formats is given instead of a marshaller, the data format is detected from the first bytes of the stream
+    and formats maps the detected format name to the marshaller to use. By default, the binary format is decoded.
+    Streams providing readinto1() (like sys.stdin.buffer) are read without waiting for a full chunk.
+    Instead of a stream, a memory-mapped file can be given, which is decoded directly from the mapping.
+    The optional before_read function is called before every read from the stream, which might block."""
+
+    def __init__(self, stream, marshaller=None, chunk_size=DEFAULT_CHUNK_SIZE, before_read=None, formats=None):
+        self.formats = formats
+        if formats is not None:
+            self.decoder = ChunkDecoder(None)  # Only collects data until the format is known
+        elif marshaller is None:
+            self.decoder = FrameDecoder()
+        else:
+            self.decoder = marshaller.create_decoder()
+        if isinstance(stream, mmap.mmap):
+            self.decoder.map(stream)
+            self.readinto = None
+        else:
+            self.readinto = getattr(stream, "readinto1", None) or stream.readinto
+        self.chunk_size = chunk_size
+        self.before_read = before_read
+
+    def read(self):
+        """Return the next Header or Sample, or None at the end of the stream"""
+        while True:
+            result = self.decode_available()
+            if result is not None or self.decoder.finished:
+                return result
+            if self.before_read is not None:
+                self.before_read()
+            if self.decoder.fill(self.readinto, self.chunk_size) == 0:
+                self.decoder.finish()
+
+    def decode_available(self):
+        """Return the next Header or Sample from the data received so far, or None if more data is required or the
+        end of the input was reached. Does not read from the stream, see feed()."""
+        if self.formats is not None:
+            self.detect_format()
+        return self.decoder.decode()
+
+    def feed(self, data):
+        """Add data that was read elsewhere (e.g. from an asyncio stream), empty data signals the end of the input"""
+        if data:
+            self.decoder.feed(data)
+        else:
+            self.decoder.finish()
+
+    def finished(self):
+        return self.decoder.finished
+
+    def detect_format(self):
+        decoder = self.decoder
+        if decoder.available() >= FORMAT_DETECTION_BYTES or decoder.finished:
+            marshaller = self.formats[detect_format(decoder.buffer[decoder.start:decoder.end])]
+            self.decoder = marshaller.create_decoder().take_over(decoder)
+            self.formats = None
+
+    def seek(self, offset, header_offset):
+        """Continue decoding a memory-mapped binary file at the sample at the given offset, which belongs to the
+        header at header_offset. The offsets are obtained from a bitflow.index.SampleIndex. Returns the header."""
+        if self.formats is not None:
+            self.detect_format()
+        if not isinstance(self.decoder, FrameDecoder):
+            raise BitflowProtocolError("seeking is only supported for the binary format")
+        return self.decoder.seek(offset, header_offset)
+
+    def marshaller(self):
+        """Return the marshaller used for decoding, None if the data format was not detected yet"""
+        return self.decoder.marshaller
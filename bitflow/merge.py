@@ -0,0 +1,149 @@
+import heapq
+import io
+import logging
+import queue
+import threading
+
+from bitflow.io import SampleChannel, DEFAULT_QUEUE_DEPTH
+from bitflow.sample import Sample, CompactSample, Header
+
+
+class MergedSampleChannel(SampleChannel):
+    """Reads samples from several input channels and returns them merged in timestamp order. Writing works like in
+    SampleChannel. Every input is a SampleChannel reading one stream (with its own input format, in_header and
+    time bounds), the output streams of the inputs are not used. Every input is read and decoded in a background
+    thread, exchanging samples through a queue of queue_depth samples. The samples of every single input are
+    expected to be ordered by time. A k-way merge over the next sample of every input then keeps the merged samples
+    ordered, samples with equal timestamps are returned in the order of the inputs.
+    With join_tolerance (in nanoseconds), the merged samples are joined instead: a sample is combined with the
+    latest samples of all other inputs that are at most join_tolerance nanoseconds older, and one sample containing
+    the metrics of all inputs is returned. The metric names of every input are prefixed with its entry in prefixes
+    (default "in<index>/"), the tags are combined (later inputs overwriting earlier ones), and the timestamp is that
+    of the newest joined sample. Samples without a partner from every input within the tolerance are dropped."""
+
+    def __init__(self, inputs, output_stream=None, flush_policy=None, compact_samples=False, keep_raw_samples=True,
+                 output_format="bin", join_tolerance=None, prefixes=None, queue_depth=DEFAULT_QUEUE_DEPTH):
+        if not inputs:
+            raise ValueError("MergedSampleChannel needs at least one input")
+        if prefixes is None:
+            prefixes = ["in{}/".format(i) for i in range(len(inputs))]
+        if len(prefixes) != len(inputs):
+            raise ValueError("Need one metric name prefix for each of the {} inputs, got {}".format(
+                len(inputs), len(prefixes)))
+        super().__init__(input_stream=io.BytesIO(), output_stream=output_stream, flush_policy=flush_policy,
+                         compact_samples=compact_samples, keep_raw_samples=keep_raw_samples, input_format="bin",
+                         output_format=output_format)
+        self.inputs = inputs
+        self.queues = [queue.Queue(maxsize=queue_depth) for _ in inputs]
+        self.threads = None
+        self.heap = []  # (timestamp, input index, sample) of the next sample of every input
+        self.missing = list(range(len(inputs)))  # Inputs without an entry in the heap
+        self.join_tolerance = join_tolerance
+        self.prefixes = prefixes
+        self.sample_type = CompactSample if compact_samples else Sample
+        self.pending = [None] * len(inputs)  # Latest sample of every input that was not joined yet
+        self.joined_headers = {}
+        self.dropped_samples = 0
+
+    @property
+    def in_headers(self):
+        """The current input header of every input"""
+        return [channel.in_header for channel in self.inputs]
+
+    def enable_statistics(self, stats):
+        super().enable_statistics(stats)
+        for channel in self.inputs:
+            channel.enable_statistics(stats)
+
+    def close(self):
+        if self.dropped_samples > 0:
+            logging.info("Dropped {} sample(s) without matching samples from all inputs".format(self.dropped_samples))
+        super().close()
+
+    def read_sample(self):
+        return self.next_sample(self.read_merged if self.join_tolerance is None else self.read_joined)
+
+    def read_merged(self):
+        return self.pop_next()[1]
+
+    def pop_next(self):
+        """Return the index of the input and the oldest sample of all inputs, or (None, None) after the end of input"""
+        if self.threads is None:
+            self.start_readers()
+        heap = self.heap
+        while self.missing:
+            index = self.missing.pop()
+            sample = self.take(index)
+            if sample is not None:
+                heapq.heappush(heap, (sample.get_timestamp_nanos(), index, sample))
+        if not heap:
+            return None, None
+        _, index, sample = heapq.heappop(heap)
+        self.missing.append(index)
+        return index, sample
+
+    def read_joined(self):
+        pending = self.pending
+        while True:
+            index, sample = self.pop_next()
+            if sample is None:
+                return None
+            oldest = sample.get_timestamp_nanos() - self.join_tolerance
+            for i, pending_sample in enumerate(pending):
+                if pending_sample is not None and (i == index or pending_sample.get_timestamp_nanos() < oldest):
+                    pending[i] = None
+                    self.dropped_samples += 1
+            pending[index] = sample
+            if all(pending_sample is not None for pending_sample in pending):
+                self.pending = [None] * len(pending)
+                return self.join(pending, sample.get_timestamp_nanos())
+
+    def join(self, samples, timestamp):
+        headers = tuple(sample.header for sample in samples)
+        header = self.joined_headers.get(headers)
+        if header is None:
+            header = Header.intern([prefix + name for prefix, input_header in zip(self.prefixes, headers)
+                                    for name in input_header.metric_names])
+            self.joined_headers[headers] = header
+        metrics = []
+        tags = {}
+        for sample in samples:
+            metrics.extend(sample.get_metrics())
+            tags.update(sample.get_tags())
+        return self.sample_type(header, metrics, timestamp=timestamp, tags=tags)
+
+    # ==================
+    # Background reading
+    # ==================
+
+    def start_readers(self):
+        self.threads = [threading.Thread(target=self.read_loop, args=(channel, input_queue),
+                                         name="bitflow-reader-{}".format(i), daemon=True)
+                        for i, (channel, input_queue) in enumerate(zip(self.inputs, self.queues))]
+        for thread in self.threads:
+            thread.start()
+
+    def read_loop(self, channel, input_queue):
+        try:
+            while True:
+                sample = channel.read_sample()
+                input_queue.put(sample)
+                if sample is None:
+                    break
+        except Exception as e:
+            input_queue.put(e)
+
+    def take(self, index):
+        """Return the next sample of the given input, or None if the input is finished"""
+        input_queue = self.queues[index]
+        if input_queue is None:
+            return None
+        if input_queue.empty():
+            self.input_idle()
+        sample = input_queue.get()
+        if isinstance(sample, Exception):
+            self.queues[index] = None
+            raise sample
+        if sample is None:
+            self.queues[index] = None
+        return sample
@@ -0,0 +1,210 @@
+import io
+import logging
+import multiprocessing
+import queue
+import signal
+import traceback
+
+from bitflow.io import SampleChannel
+from bitflow.runner import BitflowContext, BitflowRunner, check_synchronous, DEFAULT_BATCH_SIZE
+from bitflow.stats import Statistics
+
+RESULT_POLL_SECONDS = 1
+
+
+class ParallelStepError(Exception):
+    pass
+
+
+class BatchBuffer(SampleChannel):
+    """Channel reading samples from a block of marshalled bytes and collecting output samples in memory.
+    Batches of samples are exchanged with the worker processes in this form, so only flat bytes objects
+    are transferred between processes instead of pickled Sample objects."""
+
+    def __init__(self, data=b""):
+        self.buffer = io.BytesIO()
+        super().__init__(input_stream=io.BytesIO(data), output_stream=self.buffer, chunk_size=len(data) + 1,
+                         input_format="bin")
+        self.num_samples = 0
+
+    def output_sample(self, sample):
+        super().output_sample(sample)
+        self.num_samples += 1
+
+    def output_marshalled(self, data, num_samples):
+        super().output_marshalled(data, num_samples)
+        self.num_samples += num_samples
+
+    def take(self):
+        """Return the marshalled samples and their number, and clear the buffer"""
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.out_header = None  # Every block of marshalled data starts with a header
+        num_samples = self.num_samples
+        self.num_samples = 0
+        return data, num_samples
+
+
+class ParallelRunner:
+    """Runs independent copies of a stateless processing step in multiple worker processes.
+    The calling process decodes the input, sends batches of batch_size samples to the workers and writes
+    the results. In ordered mode, the results are written in the order of the input batches. Otherwise they are
+    written as soon as they are available.
+    Every worker uses its own copy of the step object, which therefore must be picklable if the multiprocessing
+    start method is not 'fork'. Samples output by the step in cleanup() are written after all other samples.
+    If a bitflow.stats.Statistics object is given, the workers record the duration of every call to the step and
+    send their histograms with their final results."""
+
+    def __init__(self, workers, ordered=True, batch_size=DEFAULT_BATCH_SIZE, step_batch_size=1, stats=None):
+        if workers < 1:
+            raise ValueError("ParallelRunner needs at least one worker, got {}".format(workers))
+        self.running = True
+        self.workers = workers
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.step_batch_size = step_batch_size
+        self.max_pending_batches = 2 * workers
+        self.stats = stats
+        self.context = multiprocessing.get_context()
+
+    def run(self, step, channel):
+        check_synchronous(step)
+        tasks = self.context.Queue(maxsize=self.max_pending_batches)
+        results = self.context.Queue()
+        worker_args = (step, self.step_batch_size, tasks, results, self.stats is not None)
+        processes = [self.context.Process(target=run_worker, args=worker_args,
+                                          name="bitflow-worker-{}".format(i), daemon=True)
+                     for i in range(self.workers)]
+        logging.info("Starting {} worker processes for step {}".format(self.workers, step))
+        for process in processes:
+            process.start()
+        try:
+            self.distribute(channel, tasks, results, processes)
+        finally:
+            for process in processes:
+                process.join(RESULT_POLL_SECONDS)
+                if process.is_alive():
+                    process.terminate()
+            channel.close()
+
+    def distribute(self, channel, tasks, results, processes):
+        self.pending = 0
+        self.next_output = 0
+        self.finished_results = {}
+        next_batch = 0
+        batch = BatchBuffer()
+        batch_samples = 0
+        while self.running:
+            sample = channel.read_sample()
+            if sample is None:
+                break
+            batch.output_sample(sample)
+            batch_samples += 1
+            if batch_samples >= self.batch_size:
+                self.send(channel, tasks, results, processes, (next_batch, batch.take()[0]))
+                next_batch += 1
+                batch_samples = 0
+        if batch_samples > 0:
+            self.send(channel, tasks, results, processes, (next_batch, batch.take()[0]))
+
+        # Let the workers clean up and collect the remaining results, including the output of cleanup()
+        for _ in processes:
+            self.put(tasks, None, processes)
+        finished_workers = 0
+        cleanup_results = []
+        while finished_workers < len(processes):
+            index, data, num_samples = self.receive(results, processes)
+            if index is None:
+                finished_workers += 1
+                cleanup_results.append((data, num_samples))
+            else:
+                self.write_result(channel, index, data, num_samples)
+        for data, num_samples in cleanup_results:
+            self.output(channel, data, num_samples)
+
+    def send(self, channel, tasks, results, processes, task):
+        # Limit the number of batches in flight, process available results in the meantime
+        while self.pending >= self.max_pending_batches:
+            self.write_result(channel, *self.receive(results, processes))
+        while True:
+            result = self.receive(results, processes, block=False)
+            if result is None:
+                break
+            self.write_result(channel, *result)
+        self.put(tasks, task, processes)
+        self.pending += 1
+
+    def put(self, tasks, task, processes):
+        while True:
+            try:
+                tasks.put(task, timeout=RESULT_POLL_SECONDS)
+                return
+            except queue.Full:
+                self.check_workers(processes)
+
+    def receive(self, results, processes, block=True):
+        while True:
+            try:
+                index, data, num_samples, error, step_latency = results.get(block=block, timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                if not block:
+                    return None
+                self.check_workers(processes)
+                continue
+            if error is not None:
+                raise ParallelStepError("Processing step failed in worker process:\n{}".format(error))
+            if step_latency is not None and self.stats is not None:
+                self.stats.step.merge(step_latency)
+            return index, data, num_samples
+
+    def check_workers(self, processes):
+        # Workers exit normally (with exit code 0) after their cleanup results were sent
+        dead = [p.name for p in processes if not p.is_alive() and p.exitcode != 0]
+        if dead:
+            raise ParallelStepError("Worker process(es) terminated unexpectedly: {}".format(dead))
+
+    def write_result(self, channel, index, data, num_samples):
+        self.pending -= 1
+        if not self.ordered:
+            self.output(channel, data, num_samples)
+            return
+        self.finished_results[index] = (data, num_samples)
+        while self.next_output in self.finished_results:
+            self.output(channel, *self.finished_results.pop(self.next_output))
+            self.next_output += 1
+
+    def output(self, channel, data, num_samples):
+        if len(data) == 0:
+            return
+        if isinstance(channel, SampleChannel):
+            channel.output_marshalled(data, num_samples)
+        else:
+            for sample in iter(BatchBuffer(data).read_sample, None):
+                channel.output_sample(sample)
+
+    def shutdown(self):
+        self.running = False
+
+
+def run_worker(step, step_batch_size, tasks, results, record_stats=False):
+    # The parent process coordinates the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    index = None
+    try:
+        output = BatchBuffer()
+        stats = Statistics() if record_stats else None
+        runner = BitflowRunner(batch_size=step_batch_size, stats=stats)
+        step.initialize(BitflowContext(output))
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, data = task
+            runner.process(step, BatchBuffer(data))
+            results.put((index, *output.take(), None, None))
+        index = None
+        step.cleanup()
+        results.put((None, *output.take(), None, stats.step if stats is not None else None))
+    except Exception:
+        results.put((index, None, 0, traceback.format_exc(), None))
@@ -26,7 +26,7 @@ def instantiate_step_class(step_class, args_list):
 
 def find_step_class(name, root_class):
     step_classes = collect_subclasses(root_class)
-    logging.info("Found {} subclass(es) of {}: {}".format(len(step_classes), root_class,
+    logging.debug("Found {} subclass(es) of {}: {}".format(len(step_classes), root_class,
                                                           [s.get_step_name() for s in step_classes]))
     for ps in step_classes:
         if ps.get_step_name().lower() == name.lower():
@@ -42,6 +42,64 @@ def collect_subclasses(cls):
     return all_subclasses
 
 
+def parse_step_chain(string):
+    """Parse a chain of steps with optional arguments, e.g. "a(x=1, y='u v') -> b -> c()".
+    Returns a list of (step name, list of "key=value" argument strings)."""
+    stages = []
+    for stage in split_outside_quotes(string, "->", nested=False):
+        stage = stage.strip()
+        name, sep, args = stage.partition("(")
+        name = name.strip()
+        if sep:
+            if not args.rstrip().endswith(")"):
+                raise ParameterParseException("Missing closing parenthesis in step '{}'".format(stage))
+            args = [unquote(arg.strip()) for arg in split_outside_quotes(args.rstrip()[:-1], ",") if arg.strip()]
+        else:
+            args = []
+        if not name:
+            raise ParameterParseException("Missing step name in step chain '{}'".format(string))
+        stages.append((name, args))
+    return stages
+
+
+def split_outside_quotes(string, separator, nested=True):
+    # Split at the separator, except inside single or double quotes (and parentheses, if not nested)
+    parts = []
+    quote = None
+    depth = 0
+    start = 0
+    i = 0
+    while i < len(string):
+        c = string[i]
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == "(" and not nested:
+            depth += 1
+        elif c == ")" and not nested:
+            depth -= 1
+        elif depth == 0 and string.startswith(separator, i):
+            parts.append(string[start:i])
+            i += len(separator)
+            start = i
+            continue
+        i += 1
+    if quote is not None:
+        raise ParameterParseException("Unterminated quote in '{}'".format(string))
+    parts.append(string[start:])
+    return parts
+
+
+def unquote(arg):
+    # Remove quotes around the value of "key='value'"
+    key, sep, value = arg.partition("=")
+    if sep and len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return key.strip() + sep + value[1:-1]
+    return arg
+
+
 def parse_string_dict(string_list):
     # Format:[ "a=b", "c=d" ]
     result = {}
@@ -49,7 +107,7 @@ def parse_string_dict(string_list):
         part = part.strip()
         if len(part) == 0:
             continue
-        keyVal = part.split("=", 2)
+        keyVal = part.split("=", 1)  # Values can contain "=", e.g. the arguments of a nested step
         if len(keyVal) != 2:
             raise ParameterParseException("Failed to parse as list of key-value pairs: {}".format(string_list))
         result[keyVal[0]] = keyVal[1]
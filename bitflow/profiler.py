@@ -0,0 +1,124 @@
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+
+from bitflow.io import SampleChannel, PipelinedSampleChannel
+from bitflow.marshaller import StreamDecoder
+from bitflow.merge import MergedSampleChannel
+
+DEFAULT_PROFILE_INTERVAL = 0.005
+
+# Functions marking the phase of the pipeline that a stack belongs to, identified by their code objects. The innermost
+# marker on a stack wins, e.g. a step outputting a sample is encoding. The asyncio runner is not imported here
+# to keep the import cheap, it decodes through StreamDecoder.feed() and SampleChannel.next_sample().
+PHASE_FUNCTIONS = {function.__code__: phase for function, phase in [
+    (StreamDecoder.read, "decode"),
+    (StreamDecoder.decode_available, "decode"),
+    (StreamDecoder.feed, "decode"),
+    (SampleChannel.read_sample, "decode"),
+    (SampleChannel.next_sample, "decode"),
+    (PipelinedSampleChannel.read_loop, "decode"),
+    (MergedSampleChannel.read_sample, "decode"),
+    (MergedSampleChannel.read_loop, "decode"),
+    (SampleChannel.output_sample, "encode"),
+    (SampleChannel.output_marshalled, "encode"),
+    (SampleChannel.FlushingWriter.flush, "encode"),
+    (PipelinedSampleChannel.write_loop, "encode"),
+    (PipelinedSampleChannel.flush, "encode"),
+    (threading.Condition.wait, "wait"),
+]}
+STEP_FUNCTIONS = {"handle_sample", "handle_batch"}
+
+
+class SamplingProfiler:
+    """Statistical profiler that records the stacks of all threads every interval seconds of consumed CPU time.
+    The program is not traced, so the overhead is small and does not distort the relation between the phases.
+    Where available, the samples are taken by a SIGPROF timer signal handler, which interrupts the main thread at
+    arbitrary points. Otherwise, or when not started from the main thread, a background thread samples
+    in wall-clock intervals, which is biased towards points where the main thread releases the GIL (mostly I/O).
+    Every stack is attributed to a phase: decode (reading and decoding input), step (handle_sample/handle_batch),
+    encode (encoding and writing output), wait (blocked in a queue or lock) or other.
+    The result is written in the collapsed stack format ("frame;frame;frame count" lines, with the phase as root)
+    that is understood by flamegraph tools like flamegraph.pl or speedscope."""
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.phases = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.signal_timer = False
+        self.previous_handler = None
+
+    def start(self):
+        if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+            self.previous_handler = signal.signal(signal.SIGPROF, self.handle_signal)
+            self.signal_timer = True
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self.thread = threading.Thread(target=self.sample_loop, name="bitflow-profiler", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.signal_timer:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler)
+            self.signal_timer = False
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def handle_signal(self, signum, frame):
+        # Runs in the main thread, the given frame is the interrupted main thread frame
+        main_id = threading.get_ident()
+        self.record(frame)
+        for thread_id, thread_frame in sys._current_frames().items():
+            if thread_id != main_id:
+                self.record(thread_frame)
+
+    def sample_loop(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.record(frame)
+
+    def record(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack.reverse()
+        phase = "other"
+        for code in stack:
+            if code.co_name in STEP_FUNCTIONS:
+                phase = "step"
+            else:
+                phase = PHASE_FUNCTIONS.get(code, phase)
+        self.phases[phase] += 1
+        self.stacks[(phase,) + tuple(stack)] += 1
+
+    def num_samples(self):
+        return sum(self.phases.values())
+
+    def summary(self):
+        total = self.num_samples() or 1
+        return ", ".join("{} {:.1%}".format(phase, count / total) for phase, count in self.phases.most_common())
+
+    @staticmethod
+    def format_frame(code):
+        return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+    def write_collapsed(self, stream):
+        for (phase, *stack), count in self.stacks.most_common():
+            stream.write("{};{} {}\n".format(phase, ";".join(map(self.format_frame, stack)), count))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            self.write_collapsed(f)
+        logging.info("Wrote {} profile samples to {}. Time per phase: {}".format(
+            self.num_samples(), path, self.summary()))
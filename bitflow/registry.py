@@ -0,0 +1,202 @@
+import importlib
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import sys
+
+from bitflow.parameters import UnknownProcessingStep
+from bitflow.runner import ProcessingStep
+
+BUILTIN_STEPS_MODULE = "bitflow.steps"
+MANIFEST_VERSION = 2
+MANIFEST_ENV_VARIABLE = "BITFLOW_STEP_MANIFEST"
+FILE_PREFIX = "file:"
+
+
+def default_manifest_path():
+    path = os.environ.get(MANIFEST_ENV_VARIABLE)
+    if path:
+        return path
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "bitflow", "steps.json")
+
+
+def describe_step(step_class):
+    """Return the manifest entry of a step class: name, location, description and constructor parameters"""
+    parameters = []
+    for i, (name, param) in enumerate(inspect.signature(step_class.__init__).parameters.items()):
+        if i == 0 and param.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD:
+            continue  # Skip the 'self' parameter
+        if param.kind in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD):
+            continue
+        typ = param.annotation if param.annotation is not inspect.Parameter.empty else str
+        description = {"name": name, "type": getattr(typ, "__name__", str(typ)),
+                       "required": param.default is inspect.Parameter.empty}
+        if param.default is not inspect.Parameter.empty:
+            description["default"] = repr(param.default)
+        parameters.append(description)
+    return {
+        "name": step_class.get_step_name(),
+        "class": step_class.__qualname__,
+        "description": step_class.__description__,
+        "parameters": parameters,
+    }
+
+
+def class_source_files(step_class):
+    """Return the source files of the modules defining the step class and its base classes"""
+    files = set()
+    for cls in step_class.__mro__:
+        path = getattr(sys.modules.get(cls.__module__), "__file__", None)
+        if path is not None and os.path.isfile(path):
+            files.add(os.path.abspath(path))
+    return files
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+class StepRegistry:
+    """Finds processing steps in a list of modules (given by name, or as "file:<path>" for .py files) without
+    importing all of them. The steps of every module are listed in a manifest file, which is reused as long as the
+    source files it was created from are unchanged (same size and modification time): the source file of the module,
+    and the files defining the steps and all their base classes, e.g. the submodules of a package or the modules of
+    inherited constructors. Only the module containing the selected step is imported. Modules that are missing from
+    the manifest or changed are imported and described again."""
+
+    def __init__(self, manifest_path=None, modules=(BUILTIN_STEPS_MODULE,)):
+        self.manifest_path = manifest_path if manifest_path is not None else default_manifest_path()
+        self.modules = list(modules)
+        self.loaded_modules = {}
+        self.manifest = self.load_manifest()
+        self.manifest_changed = False
+
+    def add_module(self, module_name):
+        self.modules.append(module_name)
+
+    def add_file(self, file_path):
+        self.modules.append(FILE_PREFIX + os.path.abspath(file_path))
+
+    # ========
+    # Manifest
+    # ========
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                return manifest
+        except (OSError, ValueError) as e:
+            logging.debug("Not using step manifest {}: {}".format(self.manifest_path, e))
+        return {"version": MANIFEST_VERSION, "modules": {}}
+
+    def save_manifest(self):
+        if not self.manifest_changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(self.manifest, f, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+            self.manifest_changed = False
+        except OSError as e:
+            logging.warning("Failed to store step manifest {}: {}".format(self.manifest_path, e))
+
+    def source_file(self, module):
+        if module.startswith(FILE_PREFIX):
+            return module[len(FILE_PREFIX):]
+        spec = importlib.util.find_spec(module)
+        if spec is None or spec.origin is None or not os.path.isfile(spec.origin):
+            return None
+        return spec.origin
+
+    def module_steps(self, module):
+        """Return the manifest entries of all steps defined in the module, describing it again if necessary"""
+        source = self.source_file(module)
+        entry = self.manifest["modules"].get(module)
+        if entry is not None and source is not None and entry["sources"][0][0] == source \
+                and self.unchanged(entry["sources"]):
+            return entry["steps"]
+        steps = []
+        files = set()
+        for name, step_class in self.step_classes(self.import_module(module)):
+            step = describe_step(step_class)
+            step["class"] = name  # Re-exported classes are looked up by the name they are bound to in the module
+            steps.append(step)
+            files.update(class_source_files(step_class))
+        logging.debug("Found {} step(s) in {}: {}".format(len(steps), module, [s["name"] for s in steps]))
+        if source is not None:
+            files.discard(source)
+            self.manifest["modules"][module] = {"sources": [file_signature(path) for path in [source] + sorted(files)],
+                                                "steps": steps}
+            self.manifest_changed = True
+        return steps
+
+    @staticmethod
+    def unchanged(signatures):
+        for path, mtime_ns, size in signatures:
+            try:
+                if file_signature(path) != [path, mtime_ns, size]:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    # =======
+    # Lookup
+    # =======
+
+    def import_module(self, module):
+        if module not in self.loaded_modules:
+            if module.startswith(FILE_PREFIX):
+                spec = importlib.util.spec_from_file_location('*', module[len(FILE_PREFIX):])
+                loaded = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(loaded)
+            else:
+                loaded = importlib.import_module(module)
+            self.loaded_modules[module] = loaded
+        return self.loaded_modules[module]
+
+    @staticmethod
+    def step_classes(module):
+        """Return (name, class) pairs of the steps of a module: the steps defined in the module, listed in its __all__,
+        or, for packages, defined in its submodules. Other imported steps are not included. Every class is returned
+        once, with the first name it is bound to."""
+        exported = set(getattr(module, "__all__", ()))
+        package_prefix = module.__name__ + "." if hasattr(module, "__path__") else None
+        result = {}
+        for name, cls in vars(module).items():
+            if not inspect.isclass(cls) or not issubclass(cls, ProcessingStep) or cls is ProcessingStep:
+                continue
+            if cls.__module__ == module.__name__ or name in exported \
+                    or (package_prefix is not None and cls.__module__.startswith(package_prefix)):
+                result.setdefault(cls, name)
+        return [(name, cls) for cls, name in result.items()]
+
+    def capabilities(self):
+        """Return the manifest entries of all available steps, with the module they are defined in"""
+        result = []
+        for module in self.modules:
+            for step in self.module_steps(module):
+                result.append(dict(step, module=module))
+        self.save_manifest()
+        return result
+
+    def find_step_class(self, name):
+        """Import the module defining the step with the given name (case-insensitive) and return the step class"""
+        for module in self.modules:
+            for step in self.module_steps(module):
+                if step["name"].lower() == name.lower():
+                    self.save_manifest()
+                    step_class = self.import_module(module)
+                    for attribute in step["class"].split("."):
+                        step_class = getattr(step_class, attribute)
+                    return step_class
+        self.save_manifest()
+        raise UnknownProcessingStep("Unknown processing step '{}'".format(name))
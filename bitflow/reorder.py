@@ -0,0 +1,51 @@
+import heapq
+import itertools
+
+
+class ReorderBuffer:
+    """Heap of samples ordered by their timestamps (integer nanoseconds). A sample is released once a sample at
+    least 'lateness' nanoseconds newer was pushed, or when more than max_samples samples are buffered (oldest first).
+    The released timestamps are therefore non-decreasing. Samples with the same timestamp are released in the order
+    they were pushed. A sample older than the latest released sample is too late and is not buffered."""
+
+    def __init__(self, lateness, max_samples=0):
+        if lateness < 0:
+            raise ValueError("Lateness must not be negative, got {}".format(lateness))
+        self.lateness = lateness
+        self.max_samples = max_samples
+        self.heap = []
+        self.sequence = itertools.count()
+        self.newest = None  # Newest timestamp pushed so far
+        self.released = None  # Timestamp of the latest released sample
+
+    def __len__(self):
+        return len(self.heap)
+
+    def is_late(self, timestamp):
+        return self.released is not None and timestamp < self.released
+
+    def push(self, timestamp, sample):
+        """Buffer the sample and return the list of released samples. Returns None if the sample is too late."""
+        if self.is_late(timestamp):
+            return None
+        heapq.heappush(self.heap, (timestamp, next(self.sequence), sample))
+        if self.newest is None or timestamp > self.newest:
+            self.newest = timestamp
+        limit = self.newest - self.lateness
+        released = []
+        heap = self.heap
+        while heap and (heap[0][0] <= limit or 0 < self.max_samples < len(heap)):
+            released.append(self.pop())
+        return released
+
+    def pop(self):
+        timestamp, _, sample = heapq.heappop(self.heap)
+        self.released = timestamp
+        return sample
+
+    def drain(self):
+        """Release all buffered samples"""
+        released = []
+        while self.heap:
+            released.append(self.pop())
+        return released
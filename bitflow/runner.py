@@ -1,5 +1,10 @@
 import logging
 
+from bitflow.sample import SampleBatch
+
+# Number of samples sent to a worker process at once by the ParallelRunner and forks with workers
+DEFAULT_BATCH_SIZE = 100
+
 
 class ProcessingStep:
     """Abstract interface class for implementing processing steps"""
@@ -19,6 +24,13 @@ class ProcessingStep:
         """Handle a received sample"""
         pass
 
+    def handle_batch(self, batch):
+        """Handle a SampleBatch of consecutive samples sharing the same header. Only called when the runner
+        is configured with a batch size > 1. Override this to process all samples of the batch at once,
+        the default implementation passes every sample to handle_sample()."""
+        for sample in batch.samples():
+            self.handle_sample(sample)
+
     def cleanup(self):
         """Clean up and prepare shutdown. The process will terminate shortly afterwards.
         Any parallel tasks or processes must be stopped before returning from this method."""
@@ -27,6 +39,19 @@ class ProcessingStep:
     def output(self, sample):
         self.context.output_sample(sample)
 
+    def output_batch(self, batch):
+        for sample in batch.samples():
+            self.context.output_sample(sample)
+
+    @classmethod
+    def handles_batches(cls):
+        return cls.handle_batch is not ProcessingStep.handle_batch
+
+    @classmethod
+    def is_async(cls):
+        """Whether handle_sample() and cleanup() return coroutines, which only the AsyncBitflowRunner awaits"""
+        return False
+
     @classmethod
     def get_step_name(cls):
         if hasattr(cls, "step_name"):
@@ -34,6 +59,72 @@ class ProcessingStep:
         return cls.__name__
 
 
+class StepChain(ProcessingStep):
+    """Runs several steps in one process. Every sample output by a step is passed directly to handle_sample() of
+    the next step, without marshalling it. The output of the last step goes to the context of the chain.
+    Only the first step can be asynchronous, its coroutines are returned to the runner. The following steps are
+    called synchronously when it outputs a sample."""
+    __description__ = "Chain of processing steps"
+
+    def __init__(self, steps):
+        super().__init__()
+        if not steps:
+            raise ValueError("A step chain needs at least one step")
+        for step in steps[1:]:
+            if step.is_async():
+                raise ValueError("Asynchronous step {} can only be the first step of a chain".format(step))
+        self.steps = steps
+
+    def __str__(self):
+        return " -> ".join(str(step) for step in self.steps)
+
+    def initialize(self, context):
+        super().initialize(context)
+        for step, next_step in zip(self.steps, self.steps[1:]):
+            step.initialize(StepContext(next_step))
+        self.steps[-1].initialize(context)
+
+    def handle_sample(self, sample):
+        return self.steps[0].handle_sample(sample)
+
+    def handle_batch(self, batch):
+        self.steps[0].handle_batch(batch)
+
+    def handles_batches(self):
+        return self.steps[0].handles_batches()
+
+    def is_async(self):
+        return self.steps[0].is_async()
+
+    def cleanup(self):
+        # Samples output while cleaning up a step are still processed by the following steps
+        if self.is_async():
+            return self.cleanup_async()
+        for step in self.steps:
+            step.cleanup()
+
+    async def cleanup_async(self):
+        await self.steps[0].cleanup()
+        for step in self.steps[1:]:
+            step.cleanup()
+
+
+def check_synchronous(step):
+    if step.is_async():
+        raise ValueError("Step {} is asynchronous and can only be run by the AsyncBitflowRunner (-concurrency)"
+                         .format(step))
+
+
+class StepContext:
+    """Context passing the output samples of a step to the next step of a StepChain"""
+
+    def __init__(self, step):
+        self.step = step
+
+    def output_sample(self, sample):
+        self.step.handle_sample(sample)
+
+
 class BitflowContext:
 
     def __init__(self, channel):
@@ -45,23 +136,62 @@ class BitflowContext:
 
 class BitflowRunner:
 
-    def __init__(self):
+    def __init__(self, batch_size=1, stats=None):
+        """With batch_size > 1, steps that implement handle_batch() receive up to batch_size consecutive samples
+        with the same header at once. This increases the latency until samples are processed.
+        If a bitflow.stats.Statistics object is given, the duration of every call to the step is recorded."""
         self.running = True
+        self.batch_size = batch_size
+        self.stats = stats
 
     def run(self, step, channel):
+        check_synchronous(step)
         logging.info("Initializing step {}".format(step))
         step.initialize(BitflowContext(channel))
 
         logging.info("Starting to receive samples...")
-        while self.running:
-            sample = channel.read_sample()
-            if sample is None:  # Signifies end of the input stream
-                break
-            step.handle_sample(sample)
+        self.process(step, channel)
 
         # We are shutting down. Last thing to do: let the processing step clean up.
         step.cleanup()
         channel.close()
 
+    def process(self, step, channel):
+        """Pass all samples from the channel to the already initialized step"""
+        if self.batch_size > 1 and step.handles_batches():
+            self.run_batches(step, channel)
+        else:
+            handle_sample = self.instrument(step.handle_sample)
+            while self.running:
+                sample = channel.read_sample()
+                if sample is None:  # Signifies end of the input stream
+                    break
+                handle_sample(sample)
+
+    def instrument(self, handle):
+        if self.stats is None:
+            return handle
+        return self.stats.timed(handle, self.stats.step)
+
+    def run_batches(self, step, channel):
+        handle_batch = self.instrument(step.handle_batch)
+        batch = None
+        while self.running:
+            sample = channel.read_sample()
+            if sample is None:
+                break
+            if batch is not None and (sample.header is not batch.header or sample.num_metrics() != batch.num_fields):
+                # Header changed, deliver the samples collected so far
+                handle_batch(batch)
+                batch = None
+            if batch is None:
+                batch = SampleBatch(sample.header, sample.num_metrics())
+            batch.append(sample)
+            if batch.num_samples() >= self.batch_size:
+                handle_batch(batch)
+                batch = None
+        if batch is not None:
+            handle_batch(batch)
+
     def shutdown(self):
         self.running = False
@@ -1,13 +1,39 @@
 import datetime
+import weakref
+from array import array
 
+NANOS_PER_SECOND = 1000000000
+EPOCH = datetime.datetime.utcfromtimestamp(0)
 
-class Sample:
+
+def nanos_to_datetime(nanos):
+    # Datetime objects only have microsecond precision, the remaining nanoseconds are truncated
+    return EPOCH + datetime.timedelta(microseconds=nanos // 1000)
+
+
+def datetime_to_nanos(timestamp):
+    delta = timestamp - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds) * 1000
+
+
+class BaseSample:
+    """Accessor methods shared by Sample and CompactSample.
+    A sample can remember the binary marshalled bytes it was decoded from. These bytes are forwarded as-is when
+    the sample is output again, unless the sample was modified in the meantime. Modifications through a setter or
+    a modifying method (set_metric(), extend(), set_tag(), remove_tag(), ...) drop the bytes right away. Changes
+    made in place (e.g. sample.metrics[0] = 1.0 or sample.get_tags()["key"] = "value") are detected when the bytes
+    are requested, by comparing the metrics and tags with a snapshot taken when the bytes were remembered."""
+    __slots__ = ()
     time_format = "%Y-%m-%d %H:%M:%S.%f"
 
     def __init__(self, header, metrics, timestamp=None, tags=None):
         self.header = header
+        self._raw = None
         self.metrics = metrics
-        self.timestamp = None
+        # The timestamp is kept in the representation it was given in (integer nanoseconds since the epoch
+        # or datetime), the other representation is computed on demand
+        self.timestamp_nanos = None
+        self._timestamp = None
         self.set_timestamp(timestamp)
         if tags:
             self.tags = tags
@@ -19,48 +45,98 @@ class Sample:
             "bitflow.sample",
             str(self.header),
             self.get_timestamp_string(),
-            self.get_tags(),
-            self.metrics)
+            self._tags,
+            list(self._metrics))
 
     # METRICS
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        self._raw = None
+        self._metrics = metrics
+
     def get_metrics(self):
         return self.metrics
 
+    def num_metrics(self):
+        return len(self._metrics)
+
+    def set_metric(self, index, value):
+        self._raw = None
+        self._metrics[index] = value
+
     def extend(self, metric):
-        self.metrics.append(metric)
+        self._raw = None
+        self._metrics.append(metric)
 
     def get_metricsindex_by_name(self, metric_name):
-        index = self.header.metric_names.index(metric_name)
+        index = self.header.index(metric_name)
         return index
 
     def get_metricvalue_by_name(self, metric_name):
-        index = self.header.metric_names.index(metric_name)
-        m = self.metrics[index]
+        index = self.header.index(metric_name)
+        m = self._metrics[index]
         return m
 
     def remove_metrics(self, index):
         self.header.metric_names.remove(index)
-        self.metrics = self.metrics[:index:]
+        self.header.changed()
+        self.metrics = self._metrics[:index:]
 
     # TIMESTAMP
+    @property
+    def timestamp(self):
+        return self.get_timestamp()
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self.set_timestamp(timestamp)
+
     def get_timestamp(self):
-        return self.timestamp
+        if self._timestamp is None:
+            self._timestamp = nanos_to_datetime(self.timestamp_nanos)
+        return self._timestamp
 
     def get_timestamp_string(self):
-        return self.timestamp.strftime(self.time_format)
+        return self.get_timestamp().strftime(self.time_format)
+
+    def get_timestamp_nanos(self):
+        if self.timestamp_nanos is None:
+            self.timestamp_nanos = datetime_to_nanos(self._timestamp)
+        return self.timestamp_nanos
 
     def set_timestamp(self, timestamp):
+        """Set the timestamp from a datetime, a string in time_format, or integer nanoseconds since the epoch.
+        Any integer, including 0 (the epoch), is taken as nanoseconds. None or an empty string means the current
+        time (before integer timestamps were supported, 0 also meant the current time)."""
+        self._raw = None
+        if isinstance(timestamp, int):
+            self.timestamp_nanos = timestamp
+            self._timestamp = None
+            return
         if not timestamp:
-            self.timestamp = datetime.datetime.utcnow()
-        elif isinstance(timestamp, datetime.datetime):
-            self.timestamp = timestamp
-        else:
-            self.timestamp = datetime.datetime.strptime(timestamp, self.time_format)
+            timestamp = datetime.datetime.utcnow()
+        elif not isinstance(timestamp, datetime.datetime):
+            timestamp = datetime.datetime.strptime(timestamp, self.time_format)
+        self._timestamp = timestamp
+        self.timestamp_nanos = None
 
     # TAGS
+    @property
+    def tags(self):
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._raw = None
+        self._tags = tags
+
     def get_tag(self, tag):
-        if tag in self.tags:
-            return self.tags[tag]
+        if tag in self._tags:
+            return self._tags[tag]
         else:
             return None
 
@@ -68,13 +144,18 @@ class Sample:
         return self.tags
 
     def set_tag(self, tag_key, tag_value):
-        self.tags[tag_key] = tag_value
+        self._raw = None
+        self._tags[tag_key] = tag_value
+
+    def remove_tag(self, tag_key):
+        self._raw = None
+        self._tags.pop(tag_key, None)
 
     def has_tag(self, key):
-        if self.tags is None or len(self.tags) == 0:
+        if self._tags is None or len(self._tags) == 0:
             return False
         else:
-            return key in self.tags
+            return key in self._tags
 
     # HEADER
     def header_changed(self, value):
@@ -86,33 +167,184 @@ class Sample:
             raise ValueError("Cannot perform comparison of headers {} and {} since latter is of type {}"
                              .format(str(self.header.metric_names), str(value), type(value)))
 
+    # MARSHALLED DATA
+    def set_raw_bytes(self, data):
+        """Remember the binary marshalled representation of this sample"""
+        self._raw = data
+        self._raw_header = self.header
+        self._raw_num_fields = self.header.num_fields()
+        metrics = self._metrics
+        self._raw_metrics = metrics.tobytes() if isinstance(metrics, array) else tuple(metrics)
+        self._raw_tags = dict(self._tags)
+
+    def get_raw_bytes(self):
+        """Return the binary marshalled representation of this sample, if it is still valid"""
+        if self._raw is not None and self.header is self._raw_header \
+                and self.header.num_fields() == self._raw_num_fields and self.unmodified():
+            return self._raw
+        self._raw = None
+        return None
+
+    def unmodified(self):
+        """Check whether the metrics and tags still match the snapshot taken by set_raw_bytes()"""
+        # Compares values, so only replacing 0.0 with -0.0 (or vice versa) goes unnoticed
+        metrics = self._metrics
+        if isinstance(metrics, array):
+            if metrics.tobytes() != self._raw_metrics:
+                return False
+        elif tuple(metrics) != self._raw_metrics:
+            return False
+        return self._tags == self._raw_tags
+
     def equals(self, sample):
-        c1 = self.timestamp == sample.timestamp  # Compare timestamps
-        c2 = self.tags == sample.tags  # Compare tag dictionaries
+        c1 = self.get_timestamp_nanos() == sample.get_timestamp_nanos()  # Compare timestamps
+        c2 = self._tags == sample._tags  # Compare tag dictionaries
         c3 = not self.header_changed(sample.header)  # Compare header fields, i.e. metric names
-        c4 = self.metrics == sample.metrics  # Compare metric values
+        c4 = list(self._metrics) == list(sample._metrics)  # Compare metric values, also between lists and arrays
         return c1 and c2 and c3 and c4
 
 
+class Sample(BaseSample):
+    """Default sample type, storing the metrics in a list"""
+
+
+class CompactSample(BaseSample):
+    """Memory-efficient alternative to Sample with the same accessor methods.
+    Uses __slots__ instead of a per-instance __dict__, stores the metrics in a contiguous array('d')
+    and the timestamp as integer nanoseconds since the epoch. The datetime object is only created on demand.
+    Note that the metrics array does not support all list operations (e.g. concatenation with lists)."""
+    __slots__ = ("header", "_metrics", "timestamp_nanos", "_tags", "_timestamp",
+                 "_raw", "_raw_header", "_raw_num_fields", "_raw_metrics", "_raw_tags")
+
+    def _set_metrics(self, metrics):
+        self._raw = None
+        self._metrics = metrics if isinstance(metrics, array) else array('d', metrics)
+
+    metrics = property(BaseSample.metrics.fget, _set_metrics)
+
+    def set_timestamp(self, timestamp):
+        super().set_timestamp(timestamp)
+        if self.timestamp_nanos is None:
+            # Only keep the compact representation
+            self.timestamp_nanos = datetime_to_nanos(self._timestamp)
+            self._timestamp = None
+
+
 class Header:
+    """List of metric names. The name-to-index mapping and the hash of the names are computed once and cached.
+    After modifying metric_names directly (instead of through extend()), changed() must be called."""
+
+    # Headers created through Header.intern(), shared as long as they are in use
+    interned_headers = weakref.WeakValueDictionary()
 
     def __init__(self, metric_names: list):
         self.metric_names = metric_names
+        self.interned_key = None
+        self.indices = None
+        self.names_hash = None
 
     def __str__(self):
         return str(self.metric_names)
 
+    @classmethod
+    def intern(cls, metric_names):
+        """Return a shared Header object for the given metric names, so that equal headers can be compared by identity"""
+        key = tuple(metric_names)
+        header = cls.interned_headers.get(key)
+        if header is None:
+            header = cls(list(metric_names))
+            header.interned_key = key
+            cls.interned_headers[key] = header
+        return header
+
     def extend(self, metric_name):
         self.metric_names.append(metric_name)
+        self.changed()
+
+    def changed(self):
+        """Drop all cached information about the metric names"""
+        if self.interned_key is not None:
+            # The names do not match the key anymore, future calls to intern() create a new Header
+            if self.interned_headers.get(self.interned_key) is self:
+                del self.interned_headers[self.interned_key]
+            self.interned_key = None
+        self.indices = None
+        self.names_hash = None
 
     def num_fields(self):
         return len(self.metric_names)
 
+    def index(self, metric_name):
+        if self.indices is None:
+            # Map every name to its first occurrence, like list.index()
+            self.indices = {}
+            for i, name in enumerate(self.metric_names):
+                self.indices.setdefault(name, i)
+        try:
+            return self.indices[metric_name]
+        except KeyError:
+            raise ValueError("{} is not in header".format(metric_name))
+
+    def get_hash(self):
+        if self.names_hash is None:
+            self.names_hash = hash(tuple(self.metric_names))
+        return self.names_hash
+
     def has_changed(self, header):
-        if self.num_fields() != header.num_fields():
+        if self is header:
+            return False
+        if self.num_fields() != header.num_fields() or self.get_hash() != header.get_hash():
             return True
-        else:
-            for i in range(0, len(self.metric_names)):
-                if self.metric_names[i] != header.metric_names[i]:
-                    return True
-        return False
+        return self.metric_names != header.metric_names
+
+
+class SampleBatch:
+    """Columnar block of consecutive samples that share the same header.
+    The metrics of all samples are stored row by row in the contiguous float64 array 'values'
+    (num_samples x num_fields), which supports the buffer protocol and can be wrapped without copying,
+    e.g. numpy.frombuffer(batch.values).reshape(batch.shape()).
+    The timestamps array holds the integer nanosecond timestamp of every row, the tags list the tags of every row."""
+
+    def __init__(self, header, num_fields=None):
+        self.header = header
+        if num_fields is None:
+            num_fields = header.num_fields()
+        self.num_fields = num_fields
+        self.values = array('d')
+        self.timestamps = array('q')
+        self.tags = []
+
+    def __str__(self):
+        return "{}:{}, {} samples".format("bitflow.batch", str(self.header), self.num_samples())
+
+    @classmethod
+    def from_samples(cls, samples):
+        batch = cls(samples[0].header, len(samples[0].metrics))
+        for sample in samples:
+            batch.append(sample)
+        return batch
+
+    def append(self, sample):
+        if sample.num_metrics() != self.num_fields:
+            raise ValueError("Cannot add sample with {} metrics to batch with {} fields"
+                             .format(sample.num_metrics(), self.num_fields))
+        self.values.extend(sample._metrics)
+        self.timestamps.append(sample.get_timestamp_nanos())
+        self.tags.append(sample._tags)
+
+    def num_samples(self):
+        return len(self.timestamps)
+
+    def shape(self):
+        return self.num_samples(), self.num_fields
+
+    def row(self, index):
+        start = index * self.num_fields
+        return self.values[start:start + self.num_fields]
+
+    def column(self, index):
+        return self.values[index::self.num_fields]
+
+    def samples(self):
+        return [Sample(self.header, self.row(i).tolist(), timestamp=self.timestamps[i], tags=self.tags[i])
+                for i in range(self.num_samples())]
@@ -0,0 +1,155 @@
+import json
+import logging
+import threading
+import time
+from array import array
+
+# Bucket i counts durations d with d.bit_length() == i, i.e. 2^(i-1) <= d < 2^i nanoseconds
+NUM_BUCKETS = 64
+
+
+class LatencyHistogram:
+    """Histogram of durations in nanoseconds with exponentially growing (power of two) buckets.
+    Recording a duration only increments a few counters, percentiles are approximated by the bucket bounds."""
+
+    def __init__(self):
+        self.buckets = array('q', bytes(NUM_BUCKETS * 8))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, nanos, count=1):
+        """Record count durations of the given length"""
+        if nanos < 0:
+            nanos = 0
+        self.buckets[nanos.bit_length()] += count
+        self.count += count
+        self.total += nanos * count
+        if nanos > self.max:
+            self.max = nanos
+
+    def merge(self, other):
+        """Add the durations recorded by another histogram, e.g. one received from a worker process"""
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def percentile(self, p):
+        """Upper bound of the bucket containing the p-th percentile (0 <= p <= 100), in nanoseconds"""
+        if self.count == 0:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count > 0 and seen >= rank:
+                return min(1 << i, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_us": self.mean() / 1000,
+            "p50_us": self.percentile(50) / 1000,
+            "p99_us": self.percentile(99) / 1000,
+            "max_us": self.max / 1000,
+        }
+
+
+class Statistics:
+    """Runtime counters and latency histograms of a pipeline. The channel and the runner only record into this
+    object when it is passed to them, otherwise their hot paths are not instrumented at all.
+    Without a PipelinedSampleChannel, the step latency includes encoding the samples output by the step."""
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.samples_in = 0
+        self.samples_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.header_changes = 0
+        self.decode = LatencyHistogram()
+        self.step = LatencyHistogram()
+        self.encode = LatencyHistogram()
+
+    def timed(self, func, histogram):
+        """Wrap func, recording the duration of every call in the histogram"""
+        clock = time.perf_counter_ns
+
+        def timed_func(*args):
+            start = clock()
+            try:
+                return func(*args)
+            finally:
+                histogram.record(clock() - start)
+        return timed_func
+
+    def to_dict(self):
+        seconds = time.monotonic() - self.start_time
+        return {
+            "seconds": seconds,
+            "samples_in": self.samples_in,
+            "samples_out": self.samples_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "header_changes": self.header_changes,
+            "samples_in_per_second": self.samples_in / seconds if seconds > 0 else 0,
+            "decode": self.decode.to_dict(),
+            "step": self.step.to_dict(),
+            "encode": self.encode.to_dict(),
+        }
+
+    def __str__(self):
+        stats = self.to_dict()
+
+        def latency(name):
+            return "{} p50={:.1f}us p99={:.1f}us".format(name, stats[name]["p50_us"], stats[name]["p99_us"])
+
+        return "in: {} samples ({} bytes, {:.0f} samples/s), out: {} samples ({} bytes), {} headers, {}, {}, {}" \
+            .format(stats["samples_in"], stats["bytes_in"], stats["samples_in_per_second"], stats["samples_out"],
+                    stats["bytes_out"], stats["header_changes"], latency("decode"), latency("step"),
+                    latency("encode"))
+
+
+class StatsReporter:
+    """Reports the statistics every interval seconds from a background thread, and a final summary on stop().
+    The reports are logged, or appended as JSON lines to the given stats file.
+    With interval None, only the final summary is reported."""
+
+    def __init__(self, stats, interval=None, stats_file=None):
+        self.stats = stats
+        self.interval = interval
+        self.stats_file = stats_file
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval:
+            self.thread = threading.Thread(target=self.report_loop, name="bitflow-stats", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report(final=True)
+
+    def report_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self, final=False):
+        if self.stats_file is None:
+            logging.info("{}: {}".format("Final statistics" if final else "Statistics", self.stats))
+            return
+        report = self.stats.to_dict()
+        report["final"] = final
+        with open(self.stats_file, "a") as f:
+            f.write(json.dumps(report) + "\n")
@@ -1,7 +1,11 @@
 import logging
 import sys
 
+from bitflow.downsample import TimeBucket, LttbSelector, PerTagStep, AGGREGATIONS
+from bitflow.fork import ForkStep
+from bitflow.reorder import ReorderBuffer
 from bitflow.runner import ProcessingStep
+from bitflow.window import WindowStep
 
 
 class NoopStep(ProcessingStep):
@@ -66,3 +70,200 @@ class EchoStep(NoopStep):
         super().__init__()
         self.msg = msg
         print(self.msg, file=sys.stderr)
+
+
+class WindowMeanStep(WindowStep):
+    __description__ = "Replaces every metric with its mean over a sliding window of samples or seconds, optionally per tag value"
+    step_name = "window-mean"
+
+    def aggregate(self, window):
+        return window.means()
+
+
+class WindowStddevStep(WindowStep):
+    __description__ = "Replaces every metric with its standard deviation over a sliding window of samples or seconds, optionally per tag value"
+    step_name = "window-stddev"
+
+    def aggregate(self, window):
+        return window.stddevs()
+
+
+class WindowRateStep(WindowStep):
+    __description__ = "Replaces every metric with its change per second over a sliding window of samples or seconds, optionally per tag value"
+    step_name = "window-rate"
+
+    def aggregate(self, window):
+        return window.rates()
+
+
+class WindowMinMaxStep(WindowStep):
+    __description__ = "Replaces every metric with its minimum and maximum (metrics <name>_min and <name>_max) over a sliding window of samples or seconds, optionally per tag value"
+    step_name = "window-minmax"
+    track_minmax = True
+
+    def aggregate(self, window):
+        return window.mins() + window.maxs()
+
+    def output_header(self, header):
+        return self.suffixed_header(header, ("_min", "_max"))
+
+
+class ForkTagsStep(ForkStep):
+    __description__ = "Partitions the samples by the value of a tag and passes every partition to its own instance of the given step (or chain of steps), optionally spread across worker processes"
+    step_name = "fork-tags"
+
+    def __init__(self, tag: str, step: str, max_keys: int = 0, idle_seconds: float = 0, workers: int = 0,
+                 batch_size: int = 100):
+        super().__init__(step, max_keys=max_keys, idle_seconds=idle_seconds, workers=workers, batch_size=batch_size)
+        self.tag = tag
+
+    def partition_key(self, sample):
+        # Samples without the tag form their own partition
+        value = sample.get_tag(self.tag)
+        return "" if value is None else value
+
+
+class ReorderStep(ProcessingStep):
+    __description__ = "Buffers samples and outputs them ordered by timestamp once they are older than the newest sample by 'lateness' seconds, or when more than max_samples are buffered. Samples arriving too late are dropped, output with the tag late=true ('tag'), or output unchanged ('emit')"
+    step_name = "reorder"
+    late_policies = ("drop", "tag", "emit")
+    late_tag = "late"
+
+    def __init__(self, lateness: float = 1.0, max_samples: int = 10000, late: str = "drop"):
+        super().__init__()
+        if late not in self.late_policies:
+            raise ValueError("{}: late must be one of {}, got '{}'".format(self.get_step_name(), self.late_policies, late))
+        self.lateness = lateness
+        self.max_samples = max_samples
+        self.late = late
+        self.buffer = ReorderBuffer(int(lateness * 1e9), max_samples)
+        self.late_samples = 0
+
+    def __str__(self):
+        return "{}(lateness={}, max_samples={}, late={})".format(
+            self.get_step_name(), self.lateness, self.max_samples, self.late)
+
+    def handle_sample(self, sample):
+        released = self.buffer.push(sample.get_timestamp_nanos(), sample)
+        if released is None:
+            self.handle_late_sample(sample)
+            return
+        for released_sample in released:
+            self.output(released_sample)
+
+    def handle_late_sample(self, sample):
+        self.late_samples += 1
+        if self.late == "tag":
+            sample.set_tag(self.late_tag, "true")
+        if self.late != "drop":
+            self.output(sample)
+
+    def cleanup(self):
+        for sample in self.buffer.drain():
+            self.output(sample)
+        if self.late_samples > 0:
+            logging.info("{}: {} sample(s) arrived too late ({})".format(
+                self.get_step_name(), self.late_samples, self.late))
+
+
+class DecimateStep(PerTagStep):
+    __description__ = "Forwards only every n-th sample (starting with the first), optionally counting separately for every value of a tag (at most max_keys values, forgetting values without samples for idle_seconds)"
+    step_name = "decimate"
+
+    def __init__(self, n: int, tag: str = "", max_keys: int = 0, idle_seconds: float = 0):
+        super().__init__(tag, max_keys, idle_seconds)
+        if n < 1:
+            raise ValueError("{} needs n >= 1, got {}".format(self.get_step_name(), n))
+        self.n = n
+
+    def handle_sample(self, sample):
+        key = self.key(sample)
+        timestamp = sample.get_timestamp_nanos()
+        count = self.lookup(key, timestamp) or 0
+        self.store(key, (count + 1) % self.n, timestamp)
+        if count == 0:
+            self.output(sample)
+
+
+class DownsampleStep(PerTagStep):
+    __description__ = "Aggregates the metrics of all samples in time buckets of the given number of seconds (mean, min, max, last or sum) and outputs one sample per bucket, optionally per tag value (at most max_keys values, outputting the bucket of a value without samples for idle_seconds early)"
+    step_name = "downsample"
+
+    def __init__(self, seconds: float, aggregation: str = "mean", tag: str = "", max_keys: int = 0,
+                 idle_seconds: float = 0):
+        super().__init__(tag, max_keys, idle_seconds)
+        if seconds <= 0:
+            raise ValueError("{} needs seconds > 0, got {}".format(self.get_step_name(), seconds))
+        if aggregation not in AGGREGATIONS:
+            raise ValueError("{}: aggregation must be one of {}, got '{}'".format(
+                self.get_step_name(), ", ".join(AGGREGATIONS), aggregation))
+        self.seconds = seconds
+        self.nanos = int(seconds * 1e9)
+        self.aggregation = aggregation
+
+    def bucket(self, key, header, num_fields, timestamp):
+        """Return the bucket of the key for the given sample properties, outputting the previous bucket if necessary"""
+        start = timestamp - timestamp % self.nanos
+        bucket = self.lookup(key, timestamp)
+        if bucket is not None and (bucket.start != start or bucket.header is not header
+                                   or bucket.num_fields != num_fields):
+            self.output(bucket.result())
+            bucket = None
+        if bucket is None:
+            bucket = TimeBucket(header, num_fields, start, self.aggregation)
+            self.store(key, bucket, timestamp)
+        return bucket
+
+    def handle_sample(self, sample):
+        bucket = self.bucket(self.key(sample), sample.header, sample.num_metrics(), sample.get_timestamp_nanos())
+        bucket.add(sample.get_metrics(), sample.get_tags())
+
+    def handle_batch(self, batch):
+        if self.tag:
+            super().handle_batch(batch)
+            return
+        # Aggregate every run of consecutive rows in the same bucket at once
+        timestamps, num_fields, nanos = batch.timestamps, batch.num_fields, self.nanos
+        start = 0
+        while start < len(timestamps):
+            bucket = self.bucket(None, batch.header, num_fields, timestamps[start])
+            end = start + 1
+            while end < len(timestamps) and timestamps[end] - timestamps[end] % nanos == bucket.start:
+                end += 1
+            bucket.add_rows(batch.values[start * num_fields:end * num_fields], end - start, batch.tags[end - 1])
+            start = end
+
+    def finish_state(self, key, bucket):
+        self.output(bucket.result())
+
+
+class LttbStep(PerTagStep):
+    __description__ = "Downsamples by selecting one sample out of every bucket of consecutive samples with the largest-triangle-three-buckets algorithm, based on the given metric (default: the first metric), optionally per tag value (at most max_keys values, finishing the selection of a value without samples for idle_seconds early)"
+    step_name = "downsample-lttb"
+
+    def __init__(self, bucket: int = 10, metric: str = "", tag: str = "", max_keys: int = 0,
+                 idle_seconds: float = 0):
+        super().__init__(tag, max_keys, idle_seconds)
+        if bucket < 1:
+            raise ValueError("{} needs bucket >= 1, got {}".format(self.get_step_name(), bucket))
+        self.bucket = bucket
+        self.metric = metric
+
+    def handle_sample(self, sample):
+        key = self.key(sample)
+        timestamp = sample.get_timestamp_nanos()
+        state = self.lookup(key, timestamp)
+        if state is None or state[0] is not sample.header:
+            if state is not None:
+                self.output_all(state[1].finish())
+            metric_index = sample.header.index(self.metric) if self.metric else 0
+            state = (sample.header, LttbSelector(self.bucket, metric_index))
+            self.store(key, state, timestamp)
+        self.output_all(state[1].add(sample))
+
+    def output_all(self, samples):
+        for sample in samples:
+            self.output(sample)
+
+    def finish_state(self, key, state):
+        self.output_all(state[1].finish())
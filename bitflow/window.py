@@ -0,0 +1,261 @@
+import logging
+import math
+from array import array
+from collections import OrderedDict, deque
+
+from bitflow.runner import ProcessingStep
+from bitflow.sample import Header
+
+MIN_CAPACITY = 16
+
+
+class SampleWindow:
+    """Sliding window over the metric values of consecutive samples, stored in a preallocated ring buffer.
+    The window either holds the last 'size' samples, or the samples of the last 'seconds' seconds (relative to the
+    timestamp of the newest sample). Time-based windows grow their ring buffer when necessary.
+    Running sums and sums of squares give the mean and standard deviation of every metric without iterating the
+    window. With track_minmax, monotonic deques additionally give the minimum and maximum of every metric.
+    The sums are kept relative to a reference value per metric (initially the first value, later the mean), so that
+    metrics with a large offset, like counters or timestamps, do not lose their variance to cancellation.
+    To limit the floating point error of the running sums, they are recomputed after every 'capacity' removals,
+    which keeps the updates amortized O(1) per metric."""
+
+    def __init__(self, num_fields, size=None, seconds=None, track_minmax=False):
+        if (size is None) == (seconds is None):
+            raise ValueError("A window needs either a size or a duration in seconds")
+        if size is not None and size < 1:
+            raise ValueError("Window size must be at least 1, got {}".format(size))
+        if seconds is not None and seconds <= 0:
+            raise ValueError("Window duration must be positive, got {}".format(seconds))
+        self.num_fields = num_fields
+        self.size = size
+        self.nanos = int(seconds * 1e9) if seconds is not None else None
+        self.capacity = size if size is not None else MIN_CAPACITY
+        self.values = array('d', bytes(8 * self.capacity * num_fields))
+        self.timestamps = array('q', bytes(8 * self.capacity))
+        self.start = 0  # Slot of the oldest sample
+        self.count = 0
+        self.pushed = 0  # Sequence number of the next sample
+        self.removals = 0  # Removals since the running sums were last recomputed
+        self.references = array('d', bytes(8 * num_fields))
+        self.sums = array('d', bytes(8 * num_fields))  # Relative to the references
+        self.squares = array('d', bytes(8 * num_fields))
+        self.track_minmax = track_minmax
+        # Per metric: (sequence number, value) pairs with increasing (min) and decreasing (max) values
+        self.min_deques = [deque() for _ in range(num_fields)] if track_minmax else None
+        self.max_deques = [deque() for _ in range(num_fields)] if track_minmax else None
+
+    def __len__(self):
+        return self.count
+
+    def push(self, timestamp, values):
+        """Add the metric values of a sample with the given timestamp (nanoseconds), removing expired samples"""
+        if len(values) != self.num_fields:
+            raise ValueError("Cannot add {} values to window with {} fields".format(len(values), self.num_fields))
+        if self.nanos is not None:
+            while self.count > 0 and self.timestamps[self.start] <= timestamp - self.nanos:
+                self.remove_oldest()
+            if self.count == self.capacity:
+                self.grow()
+        elif self.count == self.capacity:
+            self.remove_oldest()
+
+        slot = (self.start + self.count) % self.capacity
+        offset = slot * self.num_fields
+        self.values[offset:offset + self.num_fields] = values if isinstance(values, array) else array('d', values)
+        self.timestamps[slot] = timestamp
+        if self.count == 0:
+            self.references = array('d', values)
+            self.sums = array('d', bytes(8 * self.num_fields))
+            self.squares = array('d', bytes(8 * self.num_fields))
+        self.count += 1
+        sums, squares, references = self.sums, self.squares, self.references
+        for i, value in enumerate(values):
+            value -= references[i]
+            sums[i] += value
+            squares[i] += value * value
+        if self.track_minmax:
+            seq = self.pushed
+            for value, min_deque, max_deque in zip(values, self.min_deques, self.max_deques):
+                while min_deque and min_deque[-1][1] >= value:
+                    min_deque.pop()
+                min_deque.append((seq, value))
+                while max_deque and max_deque[-1][1] <= value:
+                    max_deque.pop()
+                max_deque.append((seq, value))
+        self.pushed += 1
+
+    def remove_oldest(self):
+        offset = self.start * self.num_fields
+        sums, squares, references = self.sums, self.squares, self.references
+        for i, value in enumerate(self.values[offset:offset + self.num_fields]):
+            value -= references[i]
+            sums[i] -= value
+            squares[i] -= value * value
+        if self.track_minmax:
+            seq = self.pushed - self.count
+            for min_deque, max_deque in zip(self.min_deques, self.max_deques):
+                if min_deque[0][0] == seq:
+                    min_deque.popleft()
+                if max_deque[0][0] == seq:
+                    max_deque.popleft()
+        self.start = (self.start + 1) % self.capacity
+        self.count -= 1
+        self.removals += 1
+        if self.removals >= self.capacity:
+            self.recompute_sums()
+
+    def recompute_sums(self):
+        # Rebase the sums on the current means, following metrics that drift over time
+        self.removals = 0
+        if self.count > 0:
+            self.references = array('d', self.means())
+        references = self.references
+        sums = array('d', bytes(8 * self.num_fields))
+        squares = array('d', bytes(8 * self.num_fields))
+        for row in range(self.count):
+            offset = ((self.start + row) % self.capacity) * self.num_fields
+            for i, value in enumerate(self.values[offset:offset + self.num_fields]):
+                value -= references[i]
+                sums[i] += value
+                squares[i] += value * value
+        self.sums, self.squares = sums, squares
+
+    def grow(self):
+        # Copy the samples to a ring buffer of twice the capacity, starting at slot 0
+        values = array('d', bytes(8 * 2 * self.capacity * self.num_fields))
+        timestamps = array('q', bytes(8 * 2 * self.capacity))
+        for row in range(self.count):
+            slot = (self.start + row) % self.capacity
+            values[row * self.num_fields:(row + 1) * self.num_fields] = \
+                self.values[slot * self.num_fields:(slot + 1) * self.num_fields]
+            timestamps[row] = self.timestamps[slot]
+        self.values, self.timestamps = values, timestamps
+        self.start = 0
+        self.capacity *= 2
+
+    # ============
+    # Aggregations
+    # ============
+
+    def means(self):
+        if self.count == 0:
+            return [0.0] * self.num_fields
+        return [reference + total / self.count for reference, total in zip(self.references, self.sums)]
+
+    def stddevs(self):
+        """Population standard deviation of every metric"""
+        if self.count == 0:
+            return [0.0] * self.num_fields
+        n = self.count
+        return [math.sqrt(max(0.0, squares / n - (total / n) ** 2)) for total, squares in zip(self.sums, self.squares)]
+
+    def mins(self):
+        return [min_deque[0][1] for min_deque in self.min_deques] if self.count else [0.0] * self.num_fields
+
+    def maxs(self):
+        return [max_deque[0][1] for max_deque in self.max_deques] if self.count else [0.0] * self.num_fields
+
+    def oldest(self):
+        """Timestamp and values of the oldest sample in the window"""
+        offset = self.start * self.num_fields
+        return self.timestamps[self.start], self.values[offset:offset + self.num_fields]
+
+    def newest(self):
+        slot = (self.start + self.count - 1) % self.capacity
+        offset = slot * self.num_fields
+        return self.timestamps[slot], self.values[offset:offset + self.num_fields]
+
+    def rates(self):
+        """Change per second of every metric between the oldest and the newest sample"""
+        if self.count < 2:
+            return [0.0] * self.num_fields
+        (start_time, start_values), (end_time, end_values) = self.oldest(), self.newest()
+        seconds = (end_time - start_time) / 1e9
+        if seconds <= 0:
+            return [0.0] * self.num_fields
+        return [(end - start) / seconds for start, end in zip(start_values, end_values)]
+
+
+class WindowStep(ProcessingStep):
+    """Base class for steps aggregating the metrics over a sliding window of the last 'window' samples, or of the
+    last 'seconds' seconds. With 'tag', a separate window is kept for every value of that tag.
+    A window is restarted when the header of its samples changes. Every sample is output with its metric values
+    replaced by the aggregation over the window, including the sample itself.
+    Like in ForkStep, the per-tag windows are bounded by max_keys (removing the least recently used window when a
+    new tag value arrives) and idle_seconds (removing windows without samples for that long, in sample time).
+    A later sample with a removed tag value starts a new window."""
+    track_minmax = False
+
+    def __init__(self, window: int = 10, seconds: float = 0, tag: str = "", max_keys: int = 0,
+                 idle_seconds: float = 0):
+        super().__init__()
+        if seconds > 0:
+            window = None
+        elif window < 1:
+            raise ValueError("{} needs window >= 1 or seconds > 0".format(self.get_step_name()))
+        self.window = window
+        self.seconds = seconds if seconds > 0 else None
+        self.tag = tag
+        self.max_keys = max_keys
+        self.idle_nanos = int(idle_seconds * 1e9)
+        self.windows = OrderedDict()  # Key -> (header, window), least recently used first
+        self.newest_timestamp = None
+        self.evicted = 0
+        self.output_headers = {}
+
+    def handle_sample(self, sample):
+        key = sample.get_tag(self.tag) if self.tag else None
+        timestamp = sample.get_timestamp_nanos()
+        state = self.windows.get(key)
+        if state is None:
+            if 0 < self.max_keys <= len(self.windows):
+                self.evict(next(iter(self.windows)))
+        else:
+            self.windows.move_to_end(key)
+        if state is None or state[0] is not sample.header or state[1].num_fields != sample.num_metrics():
+            window = SampleWindow(sample.num_metrics(), size=self.window, seconds=self.seconds,
+                                  track_minmax=self.track_minmax)
+            state = self.windows[key] = (sample.header, window)
+        window = state[1]
+        window.push(timestamp, sample.get_metrics())
+        if self.newest_timestamp is None or timestamp > self.newest_timestamp:
+            self.newest_timestamp = timestamp
+        if self.idle_nanos > 0:
+            self.evict_idle()
+        sample.metrics = self.aggregate(window)
+        output_header = self.output_header(sample.header)
+        if output_header is not sample.header:
+            sample.header = output_header
+        self.output(sample)
+
+    def evict_idle(self):
+        limit = self.newest_timestamp - self.idle_nanos
+        while self.windows:
+            key, (_, window) = next(iter(self.windows.items()))
+            if window.newest()[0] > limit:
+                break
+            self.evict(key)
+
+    def evict(self, key):
+        del self.windows[key]
+        self.evicted += 1
+        logging.debug("{}: removed window of key '{}'".format(self.get_step_name(), key))
+
+    def cleanup(self):
+        if self.evicted > 0:
+            logging.info("{}: removed {} idle window(s)".format(self.get_step_name(), self.evicted))
+        super().cleanup()
+
+    def aggregate(self, window):
+        raise NotImplementedError()
+
+    def output_header(self, header):
+        return header
+
+    def suffixed_header(self, header, suffixes):
+        output_header = self.output_headers.get(header)
+        if output_header is None:
+            output_header = Header.intern([name + suffix for suffix in suffixes for name in header.metric_names])
+            self.output_headers[header] = output_header
+        return output_header
@@ -1,4 +1,5 @@
 import logging
+from array import array
 from bitflow.runner import ProcessingStep
 
 class MyCustomProcessingStep(ProcessingStep):
@@ -27,5 +28,14 @@ class MyCustomProcessingStep(ProcessingStep):
         if self.num_samples % 2 == 0:
             self.output(sample)
 
+    def handle_batch(self, batch):
+        # Scale all metrics of the batch in one pass over the contiguous value array
+        batch.values = array('d', [value * self.intArg for value in batch.values])
+        for sample in batch.samples():
+            self.num_samples += 1
+            sample.set_tag("hello", self.strArg)
+            if self.num_samples % 2 == 0:
+                self.output(sample)
+
     def cleanup(self):
         logging.info("Example processing step shutting down. Processed samples: {}.".format(self.num_samples))
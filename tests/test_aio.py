@@ -0,0 +1,159 @@
+import asyncio
+import io
+import os
+import threading
+import unittest
+
+from bitflow.aio import AsyncBitflowRunner, AsyncProcessingStep
+from bitflow.io import SampleChannel, PipelinedSampleChannel
+from bitflow.parallel import ParallelRunner
+from bitflow.runner import BitflowRunner, StepChain
+from bitflow.sample import Sample, Header
+from bitflow.steps import NoopStep, ForkTagsStep
+from tests.helpers import configure_logging
+
+
+class FakeService:
+    """Local TCP service answering "<value> <delay>" lines with the doubled value after the given delay"""
+
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, "localhost", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve(self, reader, writer):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        value, delay = (await reader.readline()).split()
+        await asyncio.sleep(float(delay))
+        writer.write(b"%f\n" % (float(value) * 2))
+        await writer.drain()
+        writer.close()
+        self.active -= 1
+
+
+class ServiceStep(AsyncProcessingStep):
+
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+        self.cleaned_up = False
+
+    async def handle_sample(self, sample):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        # Later samples are answered faster
+        writer.write(b"%f %f\n" % (sample.metrics[0], 0.05 / (sample.metrics[0] + 1)))
+        sample.metrics = [float(await reader.readline())]
+        writer.close()
+        self.output(sample)
+
+    async def cleanup(self):
+        self.cleaned_up = True
+
+
+class AsyncDoublingStep(AsyncProcessingStep):
+    step_name = "test-async-double"
+
+    async def handle_sample(self, sample):
+        await asyncio.sleep(0)
+        sample.metrics = [sample.metrics[0] * 2]
+        self.output(sample)
+
+    async def cleanup(self):
+        await asyncio.sleep(0)
+        self.output(Sample(Header(["a"]), [-1.0], timestamp=0))
+
+
+class TestAsyncRunner(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        data = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=data)
+        for i in range(20):
+            channel.output_sample(Sample(Header(["a"]), [float(i)], timestamp=i))
+        self.data = data.getvalue()
+
+    def run_service_step(self, runner, input_stream):
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=input_stream, output_stream=output)
+        service = FakeService()
+
+        async def run():
+            step = ServiceStep(await service.start())
+            await runner.run_async(step, channel)
+            service.server.close()
+            self.assertTrue(step.cleaned_up)
+        asyncio.run(run())
+        samples = list(iter(SampleChannel(input_stream=io.BytesIO(output.getvalue()),
+                                          output_stream=io.BytesIO()).read_sample, None))
+        return service, [sample.metrics[0] for sample in samples]
+
+    def test_ordered(self):
+        service, values = self.run_service_step(AsyncBitflowRunner(concurrency=5), io.BytesIO(self.data))
+        self.assertEqual(values, [i * 2.0 for i in range(20)])
+        self.assertEqual(service.max_active, 5)
+
+    def test_unordered(self):
+        service, values = self.run_service_step(AsyncBitflowRunner(concurrency=20, ordered=False),
+                                                io.BytesIO(self.data))
+        self.assertEqual(sorted(values), [i * 2.0 for i in range(20)])
+        self.assertNotEqual(values, sorted(values))
+        self.assertGreater(service.max_active, 1)
+
+    def test_pipe_input(self):
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            with os.fdopen(write_fd, "wb") as pipe:
+                pipe.write(self.data)
+        writer = threading.Thread(target=write)
+        writer.start()
+        with os.fdopen(read_fd, "rb") as pipe:
+            _, values = self.run_service_step(AsyncBitflowRunner(concurrency=3), pipe)
+        writer.join()
+        self.assertEqual(values, [i * 2.0 for i in range(20)])
+
+    def test_pipelined_channel(self):
+        output = io.BytesIO()
+        channel = PipelinedSampleChannel(SampleChannel(input_stream=io.BytesIO(self.data), output_stream=output))
+        AsyncBitflowRunner(concurrency=4).run(NoopStep(), channel)
+        self.assertEqual(self.data, output.getvalue())
+
+    def test_sync_step_and_errors(self):
+        output = io.BytesIO()
+        AsyncBitflowRunner().run(NoopStep(), SampleChannel(input_stream=io.BytesIO(self.data), output_stream=output))
+        self.assertEqual(self.data, output.getvalue())
+
+        class FailingStep(AsyncProcessingStep):
+            async def handle_sample(self, sample):
+                raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            AsyncBitflowRunner().run(FailingStep(), SampleChannel(input_stream=io.BytesIO(self.data),
+                                                                  output_stream=io.BytesIO()))
+
+    def test_async_step_in_chain(self):
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(self.data), output_stream=output)
+        AsyncBitflowRunner(concurrency=4).run(StepChain([AsyncDoublingStep(), NoopStep()]), channel)
+        samples = list(iter(SampleChannel(input_stream=io.BytesIO(output.getvalue()),
+                                          output_stream=io.BytesIO()).read_sample, None))
+        self.assertEqual([s.metrics[0] for s in samples], [i * 2.0 for i in range(20)] + [-1.0])
+        with self.assertRaises(ValueError):
+            StepChain([NoopStep(), AsyncDoublingStep()])
+
+    def test_async_step_with_sync_runners(self):
+        for runner in (BitflowRunner(), ParallelRunner(2)):
+            with self.assertRaises(ValueError):
+                runner.run(AsyncDoublingStep(), SampleChannel(input_stream=io.BytesIO(self.data),
+                                                              output_stream=io.BytesIO()))
+        with self.assertRaises(ValueError):
+            ForkTagsStep(tag="a", step="test-async-double").initialize(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import math
+import unittest
+
+from bitflow.downsample import LttbSelector
+from bitflow.runner import BitflowRunner
+from bitflow.sample import Sample, Header
+from bitflow.steps import DecimateStep, DownsampleStep, LttbStep
+from tests.helpers import configure_logging, SampleListChannel
+
+SECOND = 1000000000
+
+
+class TestDownsampling(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        self.header = Header(["a", "b"])
+
+    def make_samples(self, count, interval=SECOND // 10, keys=("x",)):
+        return [Sample(self.header, [float(i), float(-i)], timestamp=i * interval,
+                       tags={"host": keys[i % len(keys)], "i": str(i)}) for i in range(count)]
+
+    def run_step(self, step, samples, batch_size=1):
+        channel = SampleListChannel(samples)
+        BitflowRunner(batch_size=batch_size).run(step, channel)
+        self.assertTrue(channel.closed)
+        return channel.output
+
+    def test_decimate(self):
+        output = self.run_step(DecimateStep(n=3), self.make_samples(10))
+        self.assertEqual([s.get_tag("i") for s in output], ["0", "3", "6", "9"])
+        output = self.run_step(DecimateStep(n=2, tag="host"), self.make_samples(8, keys=("x", "y")))
+        self.assertEqual([s.get_tag("i") for s in output], ["0", "1", "4", "5"])
+
+    def test_aggregations(self):
+        # 25 samples, 10 per second
+        expected = {
+            "mean": [[4.5, -4.5], [14.5, -14.5], [22.0, -22.0]],
+            "sum": [[45.0, -45.0], [145.0, -145.0], [110.0, -110.0]],
+            "min": [[0.0, -9.0], [10.0, -19.0], [20.0, -24.0]],
+            "max": [[9.0, 0.0], [19.0, -10.0], [24.0, -20.0]],
+            "last": [[9.0, -9.0], [19.0, -19.0], [24.0, -24.0]],
+        }
+        for aggregation, metrics in expected.items():
+            for batch_size in (1, 7, 100):
+                output = self.run_step(DownsampleStep(seconds=1, aggregation=aggregation),
+                                       self.make_samples(25), batch_size)
+                self.assertEqual([s.get_metrics() for s in output], metrics, (aggregation, batch_size))
+                self.assertEqual([s.get_timestamp_nanos() for s in output], [0, SECOND, 2 * SECOND])
+                self.assertEqual([s.get_tag("i") for s in output], ["9", "19", "24"])
+
+    def test_downsample_per_tag(self):
+        output = self.run_step(DownsampleStep(seconds=1, aggregation="sum", tag="host"),
+                               self.make_samples(20, keys=("x", "y")), batch_size=5)
+        self.assertEqual([(s.get_tag("host"), s.get_metrics()[0]) for s in output],
+                         [("x", 20.0), ("y", 25.0), ("x", 70.0), ("y", 75.0)])
+
+    def test_downsample_header_change(self):
+        samples = self.make_samples(4)
+        other = Header(["c"])
+        samples.insert(2, Sample(other, [100.0], timestamp=samples[1].get_timestamp_nanos()))
+        output = self.run_step(DownsampleStep(seconds=10, aggregation="max"), samples)
+        self.assertEqual([s.get_metrics() for s in output], [[1.0, 0.0], [100.0], [3.0, -2.0]])
+
+    def test_per_tag_eviction(self):
+        def samples(keys):
+            return [Sample(self.header, [float(i), float(-i)], timestamp=i * SECOND, tags={"host": key, "i": str(i)})
+                    for i, key in enumerate(keys)]
+
+        step = DecimateStep(n=2, tag="host", max_keys=1)
+        output = self.run_step(step, samples(["x", "x", "y", "x"]))
+        # Adding "y" removes the counter of "x", so the next "x" sample is forwarded again
+        self.assertEqual([s.get_tag("i") for s in output], ["0", "2", "3"])
+        self.assertEqual(step.evicted, 2)
+
+        # The bucket of a removed tag value is output when it is removed
+        step = DownsampleStep(seconds=10, aggregation="sum", tag="host", max_keys=1)
+        output = self.run_step(step, samples(["x", "y", "x"]))
+        self.assertEqual([(s.get_tag("host"), s.get_metrics()[0]) for s in output],
+                         [("x", 0.0), ("y", 1.0), ("x", 2.0)])
+        step = DownsampleStep(seconds=10, aggregation="sum", tag="host", idle_seconds=2)
+        output = self.run_step(step, samples(["x", "y", "y", "y", "x"]))
+        self.assertEqual([(s.get_tag("host"), s.get_metrics()[0]) for s in output],
+                         [("x", 0.0), ("y", 6.0), ("x", 4.0)])
+        self.assertEqual(step.evicted, 1)
+        self.assertEqual(len(step.states), 0)
+
+        # The selection of a removed tag value is finished, including its last sample
+        step = LttbStep(bucket=2, tag="host", max_keys=1)
+        output = self.run_step(step, samples(["x"] * 5 + ["y"]))
+        self.assertEqual([s.get_tag("host") for s in output], ["x"] * 4 + ["y"])
+        self.assertEqual(output[3].get_tag("i"), "4")
+        self.assertEqual(step.evicted, 1)
+
+    def test_invalid_aggregation(self):
+        with self.assertRaises(ValueError):
+            DownsampleStep(seconds=1, aggregation="median")
+
+    def test_lttb_selects_peaks(self):
+        header = Header(["value"])
+        values = [math.sin(i / 5) for i in range(100)]
+        values[42] = 10.0
+        samples = [Sample(header, [value], timestamp=i * SECOND) for i, value in enumerate(values)]
+        output = self.run_step(LttbStep(bucket=10, metric="value"), samples)
+        timestamps = [s.get_timestamp_nanos() // SECOND for s in output]
+        self.assertEqual(len(output), 12)  # First, last and one per bucket of the 98 samples in between
+        self.assertEqual(timestamps[0], 0)
+        self.assertEqual(timestamps[-1], 99)
+        self.assertIn(42, timestamps)
+        self.assertEqual(timestamps, sorted(timestamps))
+        for i, timestamp in enumerate(timestamps[1:-1]):
+            self.assertTrue(1 + i * 10 <= timestamp < 1 + (i + 1) * 10)
+
+    def test_lttb_streaming(self):
+        header = Header(["value"])
+        selector = LttbSelector(3, 0)
+        samples = [Sample(header, [float(i % 4)], timestamp=i) for i in range(8)]
+        selected = []
+        for sample in samples:
+            selected.extend(selector.add(sample))
+        # The first sample and the first bucket are selected before the end of the input
+        self.assertEqual(len(selected), 2)
+        selected.extend(selector.finish())
+        self.assertEqual([s.get_timestamp_nanos() for s in selected], [0, 3, 4, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
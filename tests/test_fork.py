@@ -0,0 +1,131 @@
+import os
+import tempfile
+import textwrap
+import unittest
+
+from bitflow.registry import StepRegistry
+from bitflow.runner import BitflowRunner, ProcessingStep
+from bitflow.sample import Sample, Header
+from bitflow.steps import ForkTagsStep, WindowMeanStep
+from tests.helpers import configure_logging, SampleListChannel
+
+SECOND = 1000000000
+
+PLUGIN_SOURCE = textwrap.dedent("""
+    from bitflow.runner import ProcessingStep
+
+    class ForkPluginStep(ProcessingStep):
+        step_name = "fork-plugin-step"
+
+        def __init__(self, factor: float):
+            super().__init__()
+            self.factor = factor
+
+        def handle_sample(self, sample):
+            sample.metrics = [value * self.factor for value in sample.metrics]
+            self.output(sample)
+    """)
+
+
+class CountingStep(ProcessingStep):
+    """Tags every sample with the number of samples this instance received, outputs the count when cleaned up"""
+    step_name = "fork-test-counter"
+
+    def __init__(self, scale: float = 1):
+        super().__init__()
+        self.scale = scale
+        self.count = 0
+
+    def handle_sample(self, sample):
+        self.count += 1
+        sample.set_tag("count", str(self.count))
+        sample.metrics = [value * self.scale for value in sample.metrics]
+        self.output(sample)
+
+    def cleanup(self):
+        self.output(Sample(Header(["count"]), [float(self.count)], timestamp=0, tags={"cleanup": "true"}))
+
+
+class TestForkTags(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        self.header = Header(["value"])
+
+    def make_samples(self, keys):
+        return [Sample(self.header, [float(i)], timestamp=i * SECOND, tags={"host": key, "i": str(i)})
+                for i, key in enumerate(keys)]
+
+    def run_step(self, step, samples):
+        channel = SampleListChannel(list(samples))
+        BitflowRunner().run(step, channel)
+        self.assertTrue(channel.closed)
+        return channel.output
+
+    def split_output(self, output):
+        results = [s for s in output if not s.has_tag("cleanup")]
+        counts = [s.get_metrics()[0] for s in output if s.has_tag("cleanup")]
+        return results, counts
+
+    def test_partitions(self):
+        step = ForkTagsStep(tag="host", step="fork-test-counter(scale=2)")
+        output = self.run_step(step, self.make_samples(["a", "b", "a", "c", "a", "b"]))
+        results, counts = self.split_output(output)
+        self.assertEqual([s.get_tag("count") for s in results], ["1", "1", "2", "1", "3", "2"])
+        self.assertEqual([s.get_metrics()[0] for s in results], [0.0, 2.0, 4.0, 6.0, 8.0, 10.0])
+        self.assertEqual(sorted(counts), [1.0, 2.0, 3.0])
+        self.assertEqual(step.created, 3)
+
+    def test_chain_matches_tag_window(self):
+        samples = self.make_samples(["a", "b", "b", "a", "a", "b", "a"])
+        expected = self.run_step(WindowMeanStep(window=2, tag="host"), self.make_samples(["a", "b", "b", "a", "a", "b", "a"]))
+        output = self.run_step(ForkTagsStep(tag="host", step="window-mean(window=2) -> noop"), samples)
+        self.assertEqual([s.get_metrics() for s in output], [s.get_metrics() for s in expected])
+
+    def test_max_keys(self):
+        step = ForkTagsStep(tag="host", step="fork-test-counter", max_keys=2)
+        output = self.run_step(step, self.make_samples(["a", "b", "a", "c", "b", "a"]))
+        results, counts = self.split_output(output)
+        # "c" evicts "b" (least recently used), "b" evicts "a", "a" evicts "c"
+        self.assertEqual([s.get_tag("count") for s in results], ["1", "1", "2", "1", "1", "1"])
+        self.assertEqual(counts, [1.0, 2.0, 1.0, 1.0, 1.0])
+        self.assertEqual((step.created, step.evicted), (5, 3))
+
+    def test_idle_eviction(self):
+        samples = self.make_samples(["a", "b", "b", "b", "a", "b"])
+        step = ForkTagsStep(tag="host", step="fork-test-counter", idle_seconds=2.5)
+        results, counts = self.split_output(self.run_step(step, samples))
+        # "a" is idle for 3 seconds before its second sample
+        self.assertEqual([s.get_tag("count") for s in results], ["1", "1", "2", "3", "1", "4"])
+        self.assertEqual(step.evicted, 1)
+        self.assertEqual(sorted(counts), [1.0, 1.0, 4.0])
+
+    def test_workers(self):
+        keys = [str(i % 7) for i in range(300)]
+        step = ForkTagsStep(tag="host", step="fork-test-counter", workers=3, batch_size=16)
+        results, counts = self.split_output(self.run_step(step, self.make_samples(keys)))
+        self.assertEqual(sorted(int(s.get_tag("i")) for s in results), list(range(300)))
+        self.assertEqual(sorted(counts), sorted(float(keys.count(key)) for key in set(keys)))
+        # Within a key, the samples stay in order and are handled by a single instance
+        for key in set(keys):
+            self.assertEqual([int(s.get_tag("count")) for s in results if s.get_tag("host") == key],
+                             list(range(1, keys.count(key) + 1)))
+
+    def test_plugin_sub_step(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            plugin = os.path.join(tmp, "plugin.py")
+            with open(plugin, "w") as f:
+                f.write(PLUGIN_SOURCE)
+            # Resolve once with a cold and once with a warm manifest
+            for _ in range(2):
+                registry = StepRegistry(manifest_path=os.path.join(tmp, "steps.json"))
+                registry.add_file(plugin)
+                step = ForkTagsStep(tag="host", step="fork-plugin-step(factor=3) -> noop")
+                step.resolve_steps(registry.find_step_class)
+                output = self.run_step(step, self.make_samples(["a", "b", "a"]))
+                self.assertEqual([s.get_metrics()[0] for s in output], [0.0, 3.0, 6.0])
+                self.assertEqual(step.created, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import io
+import os
+import tempfile
+import unittest
+
+from bitflow.index import SampleIndex, IndexedFile, parse_time, INDEX_SUFFIX
+from bitflow.io import SampleChannel, open_input
+from bitflow.marshaller import BitflowProtocolError
+from bitflow.sample import Sample, Header
+from tests.helpers import configure_logging
+
+START_NANOS = 1586591392000000000
+STEP_NANOS = 1000000
+
+
+class TestSampleIndex(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data.bin")
+        # 250 samples, the header changes every 100 samples
+        self.samples = []
+        for i in range(250):
+            header = Header.intern(["a", "b"] if i // 100 % 2 == 0 else ["c"])
+            self.samples.append(Sample(header, [float(i)] * header.num_fields(),
+                                       timestamp=START_NANOS + i * STEP_NANOS, tags={"i": str(i % 3)}))
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+        for sample in self.samples:
+            channel.output_sample(sample)
+        with open(self.path, "wb") as f:
+            f.write(output.getvalue())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_samples(self, expected, samples):
+        samples = list(samples)
+        self.assertEqual(len(expected), len(samples))
+        for expected_sample, sample in zip(expected, samples):
+            self.assertTrue(expected_sample.equals(sample))
+
+    def test_build(self):
+        index = SampleIndex.load_or_build(self.path, interval=10)
+        self.assertEqual(index.num_samples, 250)
+        self.assertEqual(list(index.sample_numbers), list(range(0, 250, 10)))
+        self.assertEqual(index.timestamps[3], START_NANOS + 30 * STEP_NANOS)
+        self.assertTrue(os.path.exists(self.path + INDEX_SUFFIX))
+
+        loaded = SampleIndex.load(self.path + INDEX_SUFFIX)
+        for column in ("sample_numbers", "timestamps", "offsets", "header_offsets"):
+            self.assertEqual(getattr(index, column), getattr(loaded, column))
+        self.assertEqual(loaded.num_samples, 250)
+
+        # An outdated index is rebuilt
+        with open(self.path, "ab") as f:
+            f.write(b"X12345678\n")
+        with self.assertRaises(BitflowProtocolError):
+            SampleIndex.load_or_build(self.path, interval=10)
+
+    def test_seek(self):
+        indexed = IndexedFile(self.path, SampleIndex.load_or_build(self.path, interval=7))
+        self.assertEqual(indexed.num_samples(), 250)
+        self.assert_samples(self.samples, indexed.samples())
+        self.assert_samples(self.samples[95:105], indexed.samples(95, 105))
+        self.assert_samples(self.samples[249:], indexed.samples(249))
+        self.assert_samples(self.samples[120:180], indexed.samples_between(START_NANOS + 120 * STEP_NANOS,
+                                                                           START_NANOS + 180 * STEP_NANOS))
+        self.assert_samples(self.samples[:3], indexed.samples_between(to_nanos=START_NANOS + 3 * STEP_NANOS))
+        indexed.close()
+
+    def test_channel_time_range(self):
+        from_time = START_NANOS + 133 * STEP_NANOS
+        to_time = START_NANOS + 210 * STEP_NANOS
+        index = SampleIndex.load_or_build(self.path, interval=10)
+        for input_index in (index, None):
+            stream = open_input(self.path)
+            channel = SampleChannel(input_stream=stream, output_stream=io.BytesIO(), from_time=from_time,
+                                    to_time=to_time, input_index=input_index)
+            self.assert_samples(self.samples[133:210], iter(channel.read_sample, None))
+            stream.close()
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("1586591392828602123"), 1586591392828602123)
+        self.assertEqual(parse_time("2020-04-11 07:49:52.828602"), 1586591392828602000)
+        self.assertEqual(parse_time("2020-04-11 09:49:52.828602+02:00"), 1586591392828602000)
+        self.assertEqual(parse_time("2020-04-11T07:49:52.828602+00:00"), 1586591392828602000)
+        with self.assertRaises(ValueError):
+            parse_time("yesterday")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import io
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from bitflow.io import SampleChannel, FlushPolicy, PipelinedSampleChannel, open_input, open_output
+from bitflow.marshaller import BitflowProtocolError
+from bitflow.runner import BitflowRunner
+from bitflow.steps import NoopStep
+from bitflow.parameters import ParameterParseException
+from bitflow.sample import Sample, Header
+from tests.helpers import configure_logging
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+        self.flushes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+    def flush(self):
+        self.flushes += 1
+        super().flush()
+
+
+class TestFlushPolicy(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def output_samples(self, policy, num_samples):
+        output = CountingStream()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output, flush_policy=policy)
+        header = Header(["a", "b", "c"])
+        for i in range(num_samples):
+            channel.output_sample(Sample(header, [i, 2.0, 3.0], timestamp="2020-04-11 07:49:52.828602", tags={"x": "y"}))
+        return channel, output
+
+    def test_parse(self):
+        policy = FlushPolicy.parse("sample")
+        self.assertEqual((policy.max_samples, policy.max_millis), (1, None))
+        policy = FlushPolicy.parse("samples=100,millis=20")
+        self.assertEqual((policy.max_samples, policy.max_millis), (100, 20))
+        policy = FlushPolicy.parse("millis=5")
+        self.assertEqual((policy.max_samples, policy.max_millis), (None, 5))
+        for broken in ["", "abc", "samples=x", "samples=0", "bytes=5"]:
+            with self.assertRaises((ParameterParseException, ValueError)):
+                FlushPolicy.parse(broken)
+
+    def test_flush_every_sample(self):
+        channel, output = self.output_samples(FlushPolicy(), 10)
+        self.assertEqual(output.writes, 11)  # One header plus one write per sample
+        self.assertEqual(output.flushes, 10)
+
+    def test_flush_every_n_samples(self):
+        channel, output = self.output_samples(FlushPolicy(max_samples=4), 10)
+        self.assertEqual(output.flushes, 2)
+        channel.close()
+        self.assertEqual(output.flushes, 3)
+
+    def test_flush_on_empty_input(self):
+        channel, output = self.output_samples(FlushPolicy(max_samples=100), 10)
+        self.assertEqual(output.flushes, 0)
+        self.assertIsNone(channel.read_sample())
+        self.assertEqual(output.flushes, 1)
+
+    def test_buffered_output_is_identical(self):
+        _, expected = self.output_samples(FlushPolicy(), 10)
+        _, output = self.output_samples(FlushPolicy(max_samples=3, max_millis=1000), 10)
+        self.assertEqual(expected.getvalue(), output.getvalue())
+
+
+class TestPipelinedSampleChannel(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def read_file(self, filename):
+        with open(dir_path + "/test_data/" + filename, "rb") as f:
+            return f.read()
+
+    def test_forward(self):
+        data = self.read_file("in.bin")
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=output,
+                                flush_policy=FlushPolicy(max_samples=100))
+        BitflowRunner().run(NoopStep(), PipelinedSampleChannel(channel, queue_depth=10))
+        self.assertEqual(data, output.getvalue())
+
+    def test_read_error(self):
+        data = self.read_file("broken2.bin")
+        channel = PipelinedSampleChannel(SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)),
+                                                       output_stream=io.BytesIO()))
+        self.assertIsNotNone(channel.read_sample())
+        with self.assertRaises(BitflowProtocolError):
+            channel.read_sample()
+        self.assertIsNone(channel.read_sample())
+        channel.close()
+
+    def test_write_error(self):
+        class BrokenStream(io.BytesIO):
+            def write(self, data):
+                raise BrokenPipeError()
+
+        channel = PipelinedSampleChannel(SampleChannel(input_stream=io.BytesIO(), output_stream=BrokenStream()))
+        channel.output_sample(Sample(Header(["a"]), [1.0]))
+        with self.assertRaises(BrokenPipeError):
+            channel.close()
+
+
+class TestEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        with open(dir_path + "/test_data/in.bin", "rb") as f:
+            self.data = f.read()
+
+    def forward(self, input_stream, output_stream):
+        channel = SampleChannel(input_stream=input_stream, output_stream=output_stream,
+                                flush_policy=FlushPolicy(max_samples=100))
+        BitflowRunner().run(NoopStep(), channel)
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_stream = open_input(dir_path + "/test_data/in.bin")
+            output_stream = open_output(tmp + "/out.bin")
+            self.forward(input_stream, output_stream)
+            input_stream.close()
+            output_stream.close()
+            with open(tmp + "/out.bin", "rb") as f:
+                self.assertEqual(self.data, f.read())
+
+            input_stream = open_input(dir_path + "/test_data/empty.bin")
+            self.assertIsNone(SampleChannel(input_stream=input_stream, output_stream=io.BytesIO()).read_sample())
+
+    def test_named_pipe(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + "/in.fifo"
+            os.mkfifo(path)
+
+            def write():
+                with open(path, "wb") as pipe:
+                    pipe.write(self.data)
+            writer = threading.Thread(target=write)
+            writer.start()
+            input_stream = open_input(path)  # Blocks until the writer opened the pipe
+            output = io.BytesIO()
+            self.forward(input_stream, output)
+            input_stream.close()
+            writer.join()
+            self.assertEqual(self.data, output.getvalue())
+
+    def test_tcp_dial(self):
+        # Local socket standing in for a remote data source and a remote data sink
+        with socket.create_server(("localhost", 0)) as source, socket.create_server(("localhost", 0)) as sink:
+            received = []
+
+            def serve_source():
+                connection, _ = source.accept()
+                with connection:
+                    connection.sendall(self.data)
+
+            def serve_sink():
+                connection, _ = sink.accept()
+                with connection, connection.makefile("rb") as stream:
+                    received.append(stream.read())
+
+            threads = [threading.Thread(target=serve_source), threading.Thread(target=serve_sink)]
+            for thread in threads:
+                thread.start()
+            input_stream = open_input("tcp://localhost:{}".format(source.getsockname()[1]))
+            output_stream = open_output("tcp://localhost:{}".format(sink.getsockname()[1]))
+            self.forward(input_stream, output_stream)
+            input_stream.close()
+            output_stream.close()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([self.data], received)
+
+    def test_tcp_listen(self):
+        with socket.socket() as probe:
+            probe.bind(("localhost", 0))
+            port = probe.getsockname()[1]
+        result = []
+        thread = threading.Thread(target=lambda: result.append(open_input("tcp://:{}".format(port))))
+        thread.start()
+        for _ in range(100):
+            try:
+                client = socket.create_connection(("localhost", port))
+                break
+            except ConnectionRefusedError:
+                thread.join(0.01)
+        with client:
+            client.sendall(self.data)
+        thread.join()
+        output = io.BytesIO()
+        self.forward(result[0], output)
+        result[0].close()
+        self.assertEqual(self.data, output.getvalue())
+
+    def test_invalid_tcp_endpoint(self):
+        with self.assertRaises(ValueError):
+            open_input("tcp://localhost")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
 import unittest
 import os
 import io
-from bitflow.marshaller import BitflowProtocolError
+from bitflow.marshaller import BitflowProtocolError, FrameDecoder, CsvDecoder, CsvMarshaller
 from bitflow.io import SampleChannel
-from bitflow.sample import Sample, Header
+from bitflow.runner import BitflowRunner, ProcessingStep
+from bitflow.sample import Sample, CompactSample, Header
 from tests.helpers import configure_logging
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -143,5 +144,268 @@ class TestMarshalling(unittest.TestCase):
         })
         self.marshall(channel, output, samples)
 
+    def test_compact_samples(self):
+        data = self.read_file(dir_path + "/test_data/in.bin")
+        samples = []
+        for compact in [False, True]:
+            channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=io.BytesIO(),
+                                    compact_samples=compact)
+            samples.append(list(iter(channel.read_sample, None)))
+        self.assertEqual(len(samples[0]), 1222)
+        self.assertEqual(len(samples[0]), len(samples[1]))
+        for sample, compact_sample in zip(*samples):
+            self.assertIsInstance(compact_sample, CompactSample)
+            self.assertTrue(compact_sample.equals(sample))
+            self.assertTrue(sample.equals(compact_sample))
+            self.assertEqual(sample.get_timestamp(), compact_sample.get_timestamp())
+
+        # Marshalling the compact samples must reproduce the input bytes exactly
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+        for sample in samples[1]:
+            channel.output_sample(sample)
+        self.assertEqual(data, output.getvalue())
+
+    def test_nanosecond_timestamps(self):
+        # Timestamps with sub-microsecond precision must be forwarded unchanged
+        data = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=data)
+        channel.output_sample(Sample(Header(["a"]), [1.0], timestamp=1586591392828602123))
+        data = data.getvalue()
+
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=io.BytesIO())
+        sample = channel.read_sample()
+        self.assertEqual(sample.get_timestamp_nanos(), 1586591392828602123)
+        self.assertEqual(sample.get_timestamp_string(), "2020-04-11 07:49:52.828602")
+
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+        channel.output_sample(sample)
+        self.assertEqual(data, output.getvalue())
+
+        sample.timestamp = sample.get_timestamp()
+        self.assertEqual(sample.get_timestamp_nanos(), 1586591392828602000)
+
+    def test_forward_unmodified_samples(self):
+        data = self.read_file(dir_path + "/test_data/in_small.bin")
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=io.BytesIO())
+        samples = list(iter(channel.read_sample, None))
+        for sample in samples:
+            self.assertIsNotNone(sample.get_raw_bytes())
+        samples[0].get_tag("filter")
+        samples[0].get_metricvalue_by_name("bytes_in")
+        len(samples[0].metrics), samples[0].get_metrics(), samples[0].tags, samples[0].get_tags()
+        self.assertIsNotNone(samples[0].get_raw_bytes())
+
+        # Every kind of modification must invalidate the raw bytes
+        samples[1].set_tag("a", "b")
+        samples[2].set_metric(0, 42.0)
+        samples[3].set_timestamp(1586591392828602123)
+        samples[4].extend(1.0)
+        samples[4].header = Header(samples[4].header.metric_names + ["extra"])
+        for sample in samples[1:]:
+            self.assertIsNone(sample.get_raw_bytes())
+        others = list(iter(SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO()).read_sample, None))
+        others[0].remove_tag("filter")
+        others[1].metrics = list(others[1].metrics)
+        others[2].tags = {}
+        for sample in others[:3]:
+            self.assertIsNone(sample.get_raw_bytes())
+
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+        for sample in samples:
+            channel.output_sample(sample)
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(output.getvalue())),
+                                output_stream=io.BytesIO())
+        samples2 = list(iter(channel.read_sample, None))
+        self.assertEqual(len(samples), len(samples2))
+        for sample, sample2 in zip(samples, samples2):
+            self.assertTrue(sample.equals(sample2))
+
+    def test_forward_after_read_only_step(self):
+        class InspectingStep(ProcessingStep):
+            def handle_sample(self, sample):
+                self.total = sum(sample.get_metrics()) + len(sample.metrics)
+                self.tags = dict(sample.get_tags(), **sample.tags)
+                self.output(sample)
+
+        data = self.read_file(dir_path + "/test_data/in_small.bin")
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=output)
+        marshaller = channel.marshaller
+        marshaller.format_sample = None  # Fails if a sample is marshalled again instead of being forwarded
+        BitflowRunner().run(InspectingStep(), channel)
+        self.assertEqual(data, output.getvalue())
+
+    def test_forward_after_in_place_modification(self):
+        class ScalingStep(ProcessingStep):
+            def handle_sample(self, sample):
+                for i, value in enumerate(sample.metrics):
+                    sample.metrics[i] = value * 2
+                sample.tags["filter"] = "scaled"
+                self.output(sample)
+
+        class TaggingStep(ProcessingStep):
+            def handle_sample(self, sample):
+                sample.get_tags()["new"] = "tag"
+                self.output(sample)
+
+        data = self.read_file(dir_path + "/test_data/in_small.bin")
+        expected = list(iter(SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO()).read_sample, None))
+        for step in (ScalingStep(), TaggingStep()):
+            for compact_samples in (False, True):
+                output = io.BytesIO()
+                channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=output,
+                                        compact_samples=compact_samples)
+                BitflowRunner().run(step, channel)
+                samples = list(iter(SampleChannel(input_stream=io.BytesIO(output.getvalue()),
+                                                  output_stream=io.BytesIO()).read_sample, None))
+                self.assertEqual(len(samples), len(expected))
+                for sample, original in zip(samples, expected):
+                    if isinstance(step, ScalingStep):
+                        self.assertEqual(sample.get_metrics(), [value * 2 for value in original.get_metrics()])
+                        self.assertEqual(sample.get_tags(), {"filter": "scaled"})
+                    else:
+                        self.assertEqual(sample.get_metrics(), original.get_metrics())
+                        self.assertEqual(sample.get_tags(), dict(original.get_tags(), new="tag"))
+
+    def test_tag_caches(self):
+        data = self.read_file(dir_path + "/test_data/in_small.bin")
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=io.BytesIO(),
+                                keep_raw_samples=False)
+        samples = list(iter(channel.read_sample, None))
+        self.assertEqual(len(channel.marshaller.parsed_tags_cache), 1)
+        self.assertIsNot(samples[3].get_tags(), samples[4].get_tags())
+
+        samples[0].set_tag("new", "tag")
+        samples[1].metrics = [0.0] * samples[1].num_metrics()
+        samples[2].get_tags()["filter"] = "changed"  # Modified in place
+        self.assertEqual(samples[1].get_tag("new"), None)
+
+        output = io.BytesIO()
+        out_channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+        for sample in samples:
+            out_channel.output_sample(sample)
+        samples2 = list(iter(SampleChannel(input_stream=io.BytesIO(output.getvalue()),
+                                           output_stream=io.BytesIO()).read_sample, None))
+        self.assertDictEqual(samples2[0].get_tags(), {"filter": "port_1935", "new": "tag"})
+        self.assertDictEqual(samples2[1].get_tags(), {"filter": "port_1935"})
+        self.assertDictEqual(samples2[2].get_tags(), {"filter": "changed"})
+        self.assertEqual(len(out_channel.marshaller.formatted_tags_cache), 3)
+        self.assertEqual(samples2[1].get_metrics(), [0.0] * samples[1].num_metrics())
+
+        # Equal tags dictionaries share the cached formatted representation
+        sample = Sample(Header(["a"]), [1.0], tags={"new": "tag", "filter": "port_1935"})
+        formatted = out_channel.marshaller.format_tags_bytes(sample)
+        self.assertEqual(formatted, b"filter=port_1935 new=tag")
+        self.assertIs(formatted, out_channel.marshaller.format_tags_bytes(
+            Sample(Header(["a"]), [1.0], tags={"new": "tag", "filter": "port_1935"})))
+
+    def decode_chunks(self, data, chunk_size):
+        decoder = FrameDecoder()
+        results = []
+        for offset in range(0, len(data), chunk_size):
+            decoder.feed(data[offset:offset + chunk_size])
+            results.extend(iter(decoder.decode, None))
+        decoder.finish()
+        results.extend(iter(decoder.decode, None))
+        return [r for r in results if isinstance(r, Sample)]
+
+    def test_frame_decoder_chunks(self):
+        data = self.read_file(dir_path + "/test_data/in_small.bin")
+        data = data + data  # Repeated header
+        expected = self.decode_chunks(data, len(data))
+        self.assertEqual(len(expected), 10)
+        for chunk_size in [1, 7, 100, 1000]:
+            samples = self.decode_chunks(data, chunk_size)
+            self.assertEqual(len(samples), len(expected))
+            for sample, expected_sample in zip(samples, expected):
+                self.assertTrue(sample.equals(expected_sample))
+                self.assertEqual(sample.get_raw_bytes(), expected_sample.get_raw_bytes())
+
+    def test_frame_decoder_incomplete(self):
+        data = self.read_file(dir_path + "/test_data/in_small.bin")
+        decoder = FrameDecoder()
+        decoder.feed(data[:-10])
+        self.assertEqual(len(list(iter(decoder.decode, None))), 5)  # Header and 4 samples
+        decoder.finish()
+        with self.assertRaises(BitflowProtocolError):
+            decoder.decode()
+
+        decoder = FrameDecoder()
+        decoder.feed(b"X12345678\n")
+        with self.assertRaises(BitflowProtocolError):
+            decoder.decode()
+
+    def test_compact_sample_accessors(self):
+        header = Header(["a", "b"])
+        sample = CompactSample(header, [1, 2.5], timestamp="2020-04-11 07:49:52.828602", tags={"x": "y"})
+        self.assertEqual(sample.get_metricvalue_by_name("b"), 2.5)
+        self.assertEqual(sample.get_metricsindex_by_name("b"), 1)
+        self.assertEqual(sample.get_timestamp_string(), "2020-04-11 07:49:52.828602")
+        self.assertEqual(sample.get_timestamp_nanos(), 1586591392828602000)
+        sample.extend(3)
+        self.assertListEqual(sample.get_metrics().tolist(), [1.0, 2.5, 3.0])
+        sample.set_tag("z", "w")
+        self.assertTrue(sample.has_tag("z"))
+        self.assertIsNone(sample.get_tag("missing"))
+        self.assertFalse(hasattr(sample, "__dict__"))
+
+    def test_csv_round_trip(self):
+        data = self.read_file(dir_path + "/test_data/in_small.bin")
+        samples = list(iter(SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO()).read_sample, None))
+        samples.append(Sample(Header(["a"]), [1.5], timestamp=1586591392828602120, tags={"x": "y"}))
+
+        csv = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=csv, output_format="csv")
+        for sample in samples:
+            channel.output_sample(sample)
+        csv = csv.getvalue()
+        self.assertTrue(csv.startswith(b"time,tags,last_timestamp_in_pcap,"))
+        self.assertIn(b"\n2020-04-11 07:49:52.82860212,x=y,1.5\n", csv)
+
+        # The input format is detected automatically
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(csv)), output_stream=io.BytesIO())
+        samples2 = list(iter(channel.read_sample, None))
+        self.assertIsInstance(channel.decoder.marshaller(), CsvMarshaller)
+        self.assertEqual(len(samples), len(samples2))
+        for sample, sample2 in zip(samples, samples2):
+            self.assertTrue(sample.equals(sample2))
+            self.assertIsNone(sample2.get_raw_bytes())
+
+        # Converting back to the binary format reproduces the input
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+        for sample in samples2[:5]:
+            channel.output_sample(sample)
+        self.assertEqual(output.getvalue(), data)
+
+    def test_csv_decoder(self):
+        data = b"time,a,b\r\n2020-04-11 07:49:52,1,2\r\n\n2020-04-11 07:49:52.5,3,4e3\ntime,tags,c\n" \
+               b"2020-04-11 07:49:53.000000001,k=v,-1"
+        for chunk_size in [1, 5, len(data)]:
+            decoder = CsvDecoder()
+            results = []
+            for offset in range(0, len(data), chunk_size):
+                decoder.feed(data[offset:offset + chunk_size])
+                results.extend(iter(decoder.decode, None))
+            decoder.finish()
+            results.extend(iter(decoder.decode, None))
+            samples = [r for r in results if isinstance(r, Sample)]
+            self.assertEqual(len(results), 5)
+            self.assertEqual([s.metrics for s in samples], [[1.0, 2.0], [3.0, 4000.0], [-1.0]])
+            self.assertEqual([s.get_timestamp_nanos() for s in samples],
+                             [1586591392000000000, 1586591392500000000, 1586591393000000001])
+            self.assertDictEqual(samples[0].get_tags(), {})
+            self.assertDictEqual(samples[2].get_tags(), {"k": "v"})
+            self.assertListEqual(samples[2].header.metric_names, ["c"])
+
+        for broken in [b"2020-04-11 07:49:52,1\n", b"time,a\n2020-04-11 07:49:52,1,2\n", b"time,a\nxyz,1\n"]:
+            decoder = CsvDecoder()
+            decoder.feed(broken)
+            with self.assertRaises(BitflowProtocolError):
+                list(iter(decoder.decode, None))
+
 if __name__ == '__main__':
     unittest.main()
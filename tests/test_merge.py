@@ -0,0 +1,100 @@
+import io
+import unittest
+
+from bitflow.aio import AsyncBitflowRunner
+from bitflow.io import SampleChannel
+from bitflow.marshaller import BitflowProtocolError
+from bitflow.merge import MergedSampleChannel
+from bitflow.runner import BitflowRunner
+from bitflow.sample import Sample, Header
+from bitflow.steps import NoopStep
+from tests.helpers import configure_logging
+
+SECOND = 1000000000
+
+
+def marshal(samples):
+    output = io.BytesIO()
+    channel = SampleChannel(input_stream=io.BytesIO(), output_stream=output)
+    for sample in samples:
+        channel.output_sample(sample)
+    channel.close()
+    return output.getvalue()
+
+
+def read_all(channel):
+    return list(iter(channel.read_sample, None))
+
+
+class TestMergedSampleChannel(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def make_input(self, metric, timestamps, tags=None):
+        header = Header([metric])
+        data = marshal([Sample(header, [float(i)], timestamp=t, tags=dict(tags or {}, i=str(i)))
+                        for i, t in enumerate(timestamps)])
+        return SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO())
+
+    def test_merge_in_timestamp_order(self):
+        inputs = [self.make_input("a", [1, 4, 4, 9]), self.make_input("b", [2, 3, 4, 10, 11]),
+                  self.make_input("c", []), self.make_input("d", [0])]
+        channel = MergedSampleChannel(inputs, output_stream=io.BytesIO())
+        samples = read_all(channel)
+        self.assertEqual([s.get_timestamp_nanos() for s in samples], [0, 1, 2, 3, 4, 4, 4, 9, 10, 11])
+        # Equal timestamps are ordered by input
+        self.assertEqual([s.header.metric_names[0] for s in samples], ["d", "a", "b", "b", "a", "a", "b", "a", "b", "b"])
+        self.assertEqual([h and h.metric_names for h in channel.in_headers], [["a"], ["b"], None, ["d"]])
+        self.assertIsNone(channel.read_sample())
+
+    def test_merged_output(self):
+        inputs = [self.make_input("a", [1, 3]), self.make_input("b", [2, 4])]
+        output = io.BytesIO()
+        channel = MergedSampleChannel(inputs, output_stream=output)
+        BitflowRunner().run(NoopStep(), channel)
+        result = read_all(SampleChannel(input_stream=io.BytesIO(output.getvalue()), output_stream=io.BytesIO()))
+        self.assertEqual([(s.header.metric_names, s.get_timestamp_nanos()) for s in result],
+                         [(["a"], 1), (["b"], 2), (["a"], 3), (["b"], 4)])
+
+    def test_async_runner(self):
+        for join_tolerance in (None, 1):
+            inputs = [self.make_input("a", [1, 3]), self.make_input("b", [2, 4])]
+            output = io.BytesIO()
+            channel = MergedSampleChannel(inputs, output_stream=output, join_tolerance=join_tolerance)
+            AsyncBitflowRunner(concurrency=4).run(NoopStep(), channel)
+            result = read_all(SampleChannel(input_stream=io.BytesIO(output.getvalue()), output_stream=io.BytesIO()))
+            if join_tolerance is None:
+                self.assertEqual([s.get_timestamp_nanos() for s in result], [1, 2, 3, 4])
+            else:
+                self.assertEqual([(s.get_timestamp_nanos(), s.get_metrics()) for s in result],
+                                 [(2, [0.0, 0.0]), (4, [1.0, 1.0])])
+
+    def test_join(self):
+        inputs = [self.make_input("cpu", [0, SECOND, 2 * SECOND, 5 * SECOND], {"host": "x"}),
+                  self.make_input("net", [SECOND // 10, 2 * SECOND + 1, 3 * SECOND, 5 * SECOND], {"iface": "eth0"})]
+        channel = MergedSampleChannel(inputs, output_stream=io.BytesIO(), join_tolerance=SECOND // 2,
+                                      prefixes=["host/", "network/"])
+        samples = read_all(channel)
+        self.assertEqual([s.get_timestamp_nanos() for s in samples], [SECOND // 10, 2 * SECOND + 1, 5 * SECOND])
+        self.assertEqual([s.get_metrics() for s in samples], [[0.0, 0.0], [2.0, 1.0], [3.0, 3.0]])
+        self.assertEqual(samples[0].header.metric_names, ["host/cpu", "network/net"])
+        self.assertIs(samples[0].header, samples[1].header)
+        self.assertEqual(samples[0].get_tag("host"), "x")
+        self.assertEqual(samples[0].get_tag("iface"), "eth0")
+        self.assertEqual(channel.dropped_samples, 2)
+
+    def test_input_error(self):
+        broken = SampleChannel(input_stream=io.BytesIO(b"time,a\n2020-01-01 00:00:00,1\nbroken"),
+                               output_stream=io.BytesIO(), input_format="bin")
+        channel = MergedSampleChannel([self.make_input("a", [1]), broken], output_stream=io.BytesIO())
+        with self.assertRaises(BitflowProtocolError):
+            read_all(channel)
+
+    def test_invalid_prefixes(self):
+        with self.assertRaises(ValueError):
+            MergedSampleChannel([self.make_input("a", [1])], output_stream=io.BytesIO(), prefixes=["x/", "y/"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import io
+import os
+import unittest
+
+from bitflow.io import SampleChannel
+from bitflow.parallel import ParallelRunner, ParallelStepError
+from bitflow.runner import ProcessingStep
+from bitflow.steps import NoopStep
+from bitflow.sample import Sample, Header
+from tests.helpers import configure_logging, SampleListChannel
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+class ScaleStep(ProcessingStep):
+    def __init__(self):
+        super().__init__()
+        self.num_samples = 0
+
+    def handle_sample(self, sample):
+        self.num_samples += 1
+        sample.metrics = [value * 2 for value in sample.metrics]
+        sample.set_tag("pid", str(os.getpid()))
+        self.output(sample)
+
+    def cleanup(self):
+        self.output(Sample(Header(["count"]), [self.num_samples], timestamp=0))
+
+
+class FailingStep(ProcessingStep):
+    def handle_sample(self, sample):
+        raise ValueError("failed on purpose")
+
+
+class TestParallelRunner(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def make_samples(self, num):
+        header = Header(["index", "value"])
+        return [Sample(header, [i, i * 0.5], timestamp=i * 1000, tags={"i": str(i)}) for i in range(num)]
+
+    def run_parallel(self, samples, ordered):
+        channel = SampleListChannel(list(samples))
+        ParallelRunner(3, ordered=ordered, batch_size=7).run(ScaleStep(), channel)
+        self.assertTrue(channel.closed)
+        results = [s for s in channel.output if s.header.metric_names == ["index", "value"]]
+        counts = [s for s in channel.output if s.header.metric_names == ["count"]]
+        self.assertEqual(len(counts), 3)
+        self.assertEqual(sum(s.get_metrics()[0] for s in counts), len(samples))
+        self.assertEqual(channel.output[-3:], counts)  # Cleanup output comes last
+        return results
+
+    def test_ordered(self):
+        samples = self.make_samples(200)
+        results = self.run_parallel(samples, ordered=True)
+        self.assertEqual([s.get_tag("i") for s in results], [s.get_tag("i") for s in samples])
+        for sample, result in zip(samples, results):
+            self.assertListEqual(result.get_metrics(), [value * 2 for value in sample.get_metrics()])
+            self.assertEqual(result.get_timestamp_nanos(), sample.get_timestamp_nanos())
+
+    def test_unordered(self):
+        samples = self.make_samples(200)
+        results = self.run_parallel(samples, ordered=False)
+        self.assertEqual(sorted(int(s.get_tag("i")) for s in results), list(range(200)))
+
+    def test_sample_channel(self):
+        with open(dir_path + "/test_data/in.bin", "rb") as f:
+            data = f.read()
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=output)
+        ParallelRunner(2, batch_size=100).run(ScaleStep(), channel)
+
+        expected = list(iter(SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)),
+                                           output_stream=io.BytesIO()).read_sample, None))
+        results = list(iter(SampleChannel(input_stream=io.BufferedReader(io.BytesIO(output.getvalue())),
+                                          output_stream=io.BytesIO()).read_sample, None))
+        self.assertEqual(len(results), len(expected) + 2)
+        for sample, result in zip(expected, results):
+            self.assertListEqual(result.get_metrics(), [value * 2 for value in sample.get_metrics()])
+
+    def test_headers_written_once(self):
+        with open(dir_path + "/test_data/in.bin", "rb") as f:
+            data = f.read()
+        output = io.BytesIO()
+        ParallelRunner(2, batch_size=100).run(NoopStep(), SampleChannel(input_stream=io.BytesIO(data),
+                                                                         output_stream=output))
+        self.assertEqual(output.getvalue(), data)
+
+        # Header changes inside and between the batches are still written
+        first, second = Header(["a"]), Header(["b", "c"])
+        samples = [Sample(first if i // 5 % 2 == 0 else second, [i] * (1 if i // 5 % 2 == 0 else 2), timestamp=i)
+                   for i in range(40)]
+        input_data = io.BytesIO()
+        input_channel = SampleChannel(input_stream=io.BytesIO(), output_stream=input_data)
+        for sample in samples:
+            input_channel.output_sample(sample)
+        output = io.BytesIO()
+        ParallelRunner(2, batch_size=7).run(NoopStep(), SampleChannel(input_stream=io.BytesIO(input_data.getvalue()),
+                                                                       output_stream=output))
+        results = list(iter(SampleChannel(input_stream=io.BytesIO(output.getvalue()),
+                                          output_stream=io.BytesIO()).read_sample, None))
+        self.assertEqual(len(results), len(samples))
+        for sample, result in zip(samples, results):
+            self.assertTrue(sample.equals(result))
+
+    def test_worker_error(self):
+        channel = SampleListChannel(self.make_samples(10))
+        with self.assertRaises(ParallelStepError):
+            ParallelRunner(2, batch_size=3).run(FailingStep(), channel)
+        self.assertTrue(channel.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
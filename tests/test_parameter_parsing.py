@@ -1,9 +1,23 @@
+import importlib.machinery
+import importlib.util
+import os
+import tempfile
 import unittest
 import bitflow.steps # Make sure step classes are loaded
 from bitflow import parameters
-from bitflow.runner import ProcessingStep
+from bitflow.registry import StepRegistry
+from bitflow.runner import ProcessingStep, StepChain
 from tests.helpers import configure_logging
 
+
+def load_cli():
+    # The command line tool is a script without .py extension
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python-bitflow")
+    loader = importlib.machinery.SourceFileLoader("python_bitflow", path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
 class TestParameterParsing(unittest.TestCase):
 
     def setUp(self):
@@ -127,5 +141,28 @@ class TestParameterParsing(unittest.TestCase):
         self.assertEqual(step.b, "hello")
         self.assertEqual(step.c, "world")
 
+    def test_parse_step_chain(self):
+        self.assertEqual(parameters.parse_step_chain("noop"), [("noop", [])])
+        self.assertEqual(parameters.parse_step_chain(" a(x=1, y='u, v -> w') -> b() ->c(z=\"(q)\")"),
+                         [("a", ["x=1", "y=u, v -> w"]), ("b", []), ("c", ["z=(q)"])])
+        for broken in ["a -> ", "a(x=1", "a(x='1)", "(x=1) -> b"]:
+            with self.assertRaises(parameters.ParameterParseException):
+                parameters.parse_step_chain(broken)
+
+    def test_nested_step_arguments(self):
+        self.assertEqual(parameters.parse_string_dict(["step=window-mean(window=3, tag=x)", "a=b=c"]),
+                         {"step": "window-mean(window=3, tag=x)", "a": "b=c"})
+        cli = load_cli()
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = StepRegistry(manifest_path=os.path.join(tmp, "steps.json"))
+            for step_string, args in [("fork-tags(tag=filter, step='window-mean(window=3)')", None),
+                                      ("fork-tags", ["tag=filter", "step=window-mean(window=3)"]),
+                                      ("noop -> fork-tags(tag=filter, step=\"window-mean(window=3) -> noop\")", None)]:
+                step = cli.create_step(registry, step_string, args)
+                fork = step.steps[1] if isinstance(step, StepChain) else step
+                self.assertEqual(fork.tag, "filter")
+                self.assertEqual(fork.chain[0], ("window-mean", ["window=3"]))
+                self.assertEqual(fork.stages[0][0], bitflow.steps.WindowMeanStep)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,72 @@
+import io
+import sys
+import unittest
+
+from bitflow.io import SampleChannel
+from bitflow.merge import MergedSampleChannel
+from bitflow.profiler import SamplingProfiler
+from bitflow.runner import BitflowRunner, ProcessingStep
+from bitflow.sample import Sample, Header
+from tests.helpers import configure_logging
+
+
+class BusyStep(ProcessingStep):
+
+    def handle_sample(self, sample):
+        sample.metrics = [sum(i * i for i in range(2000))]
+        self.output(sample)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def test_phases(self):
+        profiler = SamplingProfiler()
+
+        def handle_sample():
+            profiler.record(sys._getframe())
+        handle_sample()
+        profiler.record(sys._getframe())
+        self.assertEqual(profiler.phases, {"step": 1, "other": 1})
+
+        output = io.StringIO()
+        profiler.write_collapsed(output)
+        lines = sorted(output.getvalue().splitlines())
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("other;"))
+        self.assertTrue(lines[1].endswith("test_profiler.py:test_phases;test_profiler.py:handle_sample 1"))
+
+    def test_merged_input_phase(self):
+        profiler = SamplingProfiler()
+
+        class RecordingInput:
+            in_header = None
+
+            def read_sample(self):
+                # Called by the reader thread of the merged channel
+                profiler.record(sys._getframe())
+                return None
+
+        channel = MergedSampleChannel([RecordingInput()], output_stream=io.BytesIO())
+        self.assertIsNone(channel.read_sample())
+        self.assertEqual(profiler.phases, {"decode": 1})
+
+    def test_profile_run(self):
+        data = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=data)
+        for i in range(300):
+            channel.output_sample(Sample(Header(["a"]), [1.0], timestamp=i))
+        channel = SampleChannel(input_stream=io.BytesIO(data.getvalue()), output_stream=io.BytesIO())
+
+        profiler = SamplingProfiler(interval=0.001).start()
+        BitflowRunner().run(BusyStep(), channel)
+        profiler.stop()
+        self.assertGreater(profiler.num_samples(), 0)
+        self.assertIn("step", profiler.phases)
+        self.assertIn("step", profiler.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from bitflow.parameters import UnknownProcessingStep
+from bitflow.registry import StepRegistry
+from bitflow.steps import DebugStep
+from tests.helpers import configure_logging
+
+PLUGIN_SOURCE = textwrap.dedent("""
+    from bitflow.runner import ProcessingStep
+    from bitflow.steps import NoopStep  # Imported steps are not listed for this module
+
+    class PluginStep(ProcessingStep):
+        __description__ = "Test plugin"
+        step_name = "plugin-step"
+
+        def __init__(self, factor: float, label="x"):
+            super().__init__()
+            self.factor = factor
+    """)
+
+
+class TestStepRegistry(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manifest = os.path.join(self.tmp.name, "cache", "steps.json")
+        self.plugin = os.path.join(self.tmp.name, "plugin.py")
+        with open(self.plugin, "w") as f:
+            f.write(PLUGIN_SOURCE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def registry(self):
+        registry = StepRegistry(manifest_path=self.manifest)
+        registry.add_file(self.plugin)
+        return registry
+
+    def test_find_step(self):
+        registry = self.registry()
+        self.assertIs(registry.find_step_class("DEBUG"), DebugStep)
+        self.assertEqual(registry.find_step_class("plugin-step").__name__, "PluginStep")
+        with self.assertRaises(UnknownProcessingStep):
+            registry.find_step_class("missing")
+
+    def test_capabilities(self):
+        capabilities = {step["name"]: step for step in self.registry().capabilities()}
+        self.assertEqual(list(capabilities)[-1], "plugin-step")
+        self.assertEqual(capabilities["noop"]["module"], "bitflow.steps")
+        self.assertEqual(capabilities["plugin-step"]["description"], "Test plugin")
+        self.assertEqual(capabilities["plugin-step"]["parameters"], [
+            {"name": "factor", "type": "float", "required": True},
+            {"name": "label", "type": "str", "required": False, "default": "'x'"}])
+
+    def test_manifest(self):
+        self.registry().capabilities()
+        self.assertTrue(os.path.isfile(self.manifest))
+
+        # With an up-to-date manifest, only the module of the selected step is imported
+        registry = self.registry()
+        self.assertEqual(registry.find_step_class("plugin-step").__name__, "PluginStep")
+        self.assertEqual(list(registry.loaded_modules), ["file:" + self.plugin])
+
+        # Changed modules are described again
+        with open(self.plugin, "a") as f:
+            f.write("\nclass OtherStep(PluginStep):\n    step_name = 'other-step'\n")
+        registry = self.registry()
+        self.assertEqual(registry.find_step_class("other-step").__name__, "OtherStep")
+        self.assertIn("other-step", [step["name"] for step in self.registry().capabilities()])
+
+    def test_manifest_base_class_changes(self):
+        base = os.path.join(self.tmp.name, "registry_test_base.py")
+
+        def write_base(parameters):
+            with open(base, "w") as f:
+                f.write(textwrap.dedent("""
+                    from bitflow.runner import ProcessingStep
+
+                    class BaseStep(ProcessingStep):
+                        def __init__(self, {}):
+                            super().__init__()
+                    """.format(parameters)))
+        write_base("a: int")
+        with open(self.plugin, "w") as f:
+            f.write("from registry_test_base import BaseStep\n\n"
+                    "class DerivedStep(BaseStep):\n    step_name = 'derived-step'\n")
+        sys.path.insert(0, self.tmp.name)
+        try:
+            steps = {step["name"]: step for step in self.registry().capabilities()}
+            self.assertEqual([p["name"] for p in steps["derived-step"]["parameters"]], ["a"])
+            # The inherited constructor changed, the unchanged plugin module is described again
+            write_base("a: int, max_keys: int = 0")
+            sys.modules.pop("registry_test_base")
+            steps = {step["name"]: step for step in self.registry().capabilities()}
+            self.assertEqual([p["name"] for p in steps["derived-step"]["parameters"]], ["a", "max_keys"])
+        finally:
+            sys.path.remove(self.tmp.name)
+            sys.modules.pop("registry_test_base", None)
+
+    def test_reexported_steps(self):
+        package = os.path.join(self.tmp.name, "reexport_test_pkg")
+        os.mkdir(package)
+        with open(os.path.join(package, "impl.py"), "w") as f:
+            f.write(PLUGIN_SOURCE)
+        with open(os.path.join(package, "__init__.py"), "w") as f:
+            f.write("from reexport_test_pkg.impl import PluginStep\n"
+                    "from reexport_test_pkg.impl import PluginStep as Alias\n")
+        with open(os.path.join(self.tmp.name, "reexport_test_all.py"), "w") as f:
+            f.write("from bitflow.steps import NoopStep, DebugStep\n__all__ = ['DebugStep']\n")
+        sys.path.insert(0, self.tmp.name)
+        try:
+            for module, expected in [("reexport_test_pkg", ["plugin-step"]), ("reexport_test_all", ["debug"])]:
+                registry = StepRegistry(manifest_path=self.manifest, modules=[module])
+                self.assertEqual([step["name"] for step in registry.capabilities()], expected)
+                # Look up the class with a warm manifest
+                registry = StepRegistry(manifest_path=self.manifest, modules=[module])
+                self.assertEqual(registry.find_step_class(expected[0]).get_step_name(), expected[0])
+        finally:
+            sys.path.remove(self.tmp.name)
+            for module in ["reexport_test_pkg", "reexport_test_pkg.impl", "reexport_test_all"]:
+                sys.modules.pop(module, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
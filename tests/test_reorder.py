@@ -0,0 +1,87 @@
+import random
+import unittest
+
+from bitflow.reorder import ReorderBuffer
+from bitflow.runner import BitflowRunner
+from bitflow.sample import Sample, Header
+from bitflow.steps import ReorderStep
+from tests.helpers import configure_logging, SampleListChannel
+
+SECOND = 1000000000
+
+
+class TestReorderBuffer(unittest.TestCase):
+
+    def test_lateness(self):
+        buffer = ReorderBuffer(2 * SECOND)
+        self.assertEqual(buffer.push(3 * SECOND, "c"), [])
+        self.assertEqual(buffer.push(2 * SECOND, "b"), [])
+        self.assertEqual(buffer.push(4 * SECOND, "d"), ["b"])
+        self.assertIsNone(buffer.push(1 * SECOND, "late"))
+        self.assertEqual(buffer.push(3 * SECOND, "c2"), [])
+        self.assertEqual(buffer.push(6 * SECOND, "e"), ["c", "c2", "d"])
+        self.assertEqual(buffer.drain(), ["e"])
+        self.assertEqual(len(buffer), 0)
+
+    def test_max_samples(self):
+        buffer = ReorderBuffer(100 * SECOND, max_samples=3)
+        released = []
+        for timestamp, name in [(5, "e"), (2, "b"), (4, "d"), (3, "c"), (6, "f"), (1, "a")]:
+            result = buffer.push(timestamp * SECOND, name)
+            if result is not None:
+                released.extend(result)
+        # "a" arrives after "b" was released to keep at most 3 samples buffered
+        self.assertEqual(released + buffer.drain(), ["b", "c", "d", "e", "f"])
+
+    def test_equal_timestamps_keep_order(self):
+        buffer = ReorderBuffer(0)
+        self.assertEqual(buffer.push(SECOND, "a"), ["a"])
+        self.assertEqual(buffer.push(SECOND, "b"), ["b"])
+        buffer = ReorderBuffer(SECOND)
+        for name in "abc":
+            buffer.push(SECOND, name)
+        self.assertEqual(buffer.drain(), ["a", "b", "c"])
+
+
+class TestReorderStep(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        self.header = Header(["value"])
+
+    def run_step(self, step, timestamps):
+        samples = [Sample(self.header, [float(i)], timestamp=t, tags={"i": str(i)}) for i, t in enumerate(timestamps)]
+        channel = SampleListChannel(samples)
+        BitflowRunner().run(step, channel)
+        self.assertTrue(channel.closed)
+        return channel.output
+
+    def test_sorts_bounded_disorder(self):
+        rnd = random.Random(1)
+        timestamps = [i * SECOND // 10 + rnd.randint(0, SECOND // 2) for i in range(1000)]
+        output = self.run_step(ReorderStep(lateness=0.5), timestamps)
+        self.assertEqual([s.get_timestamp_nanos() for s in output], sorted(timestamps))
+        self.assertEqual(len({s.get_tag("i") for s in output}), len(timestamps))
+
+    def test_late_policies(self):
+        timestamps = [1 * SECOND, 5 * SECOND, 9 * SECOND, 2 * SECOND, 10 * SECOND]
+        output = self.run_step(ReorderStep(lateness=3, late="drop"), timestamps)
+        self.assertEqual([s.get_tag("i") for s in output], ["0", "1", "2", "4"])
+
+        step = ReorderStep(lateness=3, late="tag")
+        output = self.run_step(step, timestamps)
+        self.assertEqual([s.get_tag("i") for s in output], ["0", "1", "3", "2", "4"])
+        self.assertEqual([s.get_tag("late") for s in output], [None, None, "true", None, None])
+        self.assertEqual(step.late_samples, 1)
+
+        output = self.run_step(ReorderStep(lateness=3, late="emit"), timestamps)
+        self.assertEqual([s.get_tag("i") for s in output], ["0", "1", "3", "2", "4"])
+        self.assertFalse(any(s.has_tag("late") for s in output))
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            ReorderStep(late="keep")
+
+
+if __name__ == '__main__':
+    unittest.main()
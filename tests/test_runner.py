@@ -1,7 +1,8 @@
 import unittest
+from array import array
 
-from bitflow.runner import BitflowRunner, ProcessingStep
-from bitflow.sample import Sample
+from bitflow.runner import BitflowRunner, ProcessingStep, StepChain
+from bitflow.sample import Sample, Header
 from tests.helpers import configure_logging, SampleListChannel
 
 
@@ -59,6 +60,76 @@ class TestRunner(unittest.TestCase):
     def test_runner_many(self):
         self.perform_test([Sample(None, []) for _ in range(10000)])
 
+    class BatchStep(ProcessingStep):
+        def __init__(self):
+            super().__init__()
+            self.batch_sizes = []
+
+        def handle_batch(self, batch):
+            self.batch_sizes.append(batch.num_samples())
+            batch.values = array('d', [value * 2 for value in batch.values])
+            self.output_batch(batch)
+
+    def test_runner_batches(self):
+        header1 = Header(["a", "b"])
+        header2 = Header(["a", "b", "c"])
+        samples = [Sample(header1, [i, i + 1], tags={"i": str(i)}) for i in range(5)] + \
+                  [Sample(header2, [i, i + 1, i + 2]) for i in range(3)]
+        step = self.BatchStep()
+        channel = SampleListChannel(list(samples))
+        BitflowRunner(batch_size=2).run(step, channel)
+
+        self.assertListEqual(step.batch_sizes, [2, 2, 1, 2, 1])
+        self.assertEqual(len(channel.output), len(samples))
+        for expected, sample in zip(samples, channel.output):
+            self.assertIs(expected.header, sample.header)
+            self.assertListEqual([value * 2 for value in expected.metrics], sample.metrics)
+            self.assertEqual(expected.get_timestamp(), sample.get_timestamp())
+            self.assertDictEqual(expected.get_tags(), sample.get_tags())
+
+    def test_runner_batches_default_handler(self):
+        step = self.MockStep(self)
+        channel = SampleListChannel([Sample(None, []) for _ in range(10)])
+        self.assertFalse(step.handles_batches())
+        BitflowRunner(batch_size=4).run(step, channel)
+        self.assertEqual(len(channel.output), 10)
+
+    class ScaleStep(ProcessingStep):
+        def __init__(self, factor):
+            super().__init__()
+            self.factor = factor
+            self.buffered = []
+
+        def handle_sample(self, sample):
+            sample.metrics = [value * self.factor for value in sample.metrics]
+            self.buffered.append(sample)
+            if len(self.buffered) == 2:
+                for buffered in self.buffered:
+                    self.output(buffered)
+                self.buffered = []
+
+        def cleanup(self):
+            for buffered in self.buffered:
+                self.output(buffered)
+
+    def test_step_chain(self):
+        samples = [Sample(None, [float(i)]) for i in range(5)]
+        channel = SampleListChannel(list(samples))
+        first, second = self.ScaleStep(2), self.ScaleStep(10)
+        BitflowRunner().run(StepChain([first, self.MockStep(self), second]), channel)
+        self.assertTrue(channel.closed)
+        self.assertEqual([sample.metrics for sample in channel.output], [[i * 20.0] for i in range(5)])
+        self.assertIs(channel.output[0], samples[0])  # Samples are passed between the steps without copying
+
+    def test_step_chain_batches(self):
+        header = Header(["a"])
+        channel = SampleListChannel([Sample(header, [float(i)]) for i in range(5)])
+        step = StepChain([self.BatchStep(), self.ScaleStep(3)])
+        self.assertTrue(step.handles_batches())
+        BitflowRunner(batch_size=2).run(step, channel)
+        self.assertListEqual(step.steps[0].batch_sizes, [2, 2, 1])
+        self.assertEqual([sample.metrics for sample in channel.output], [[i * 6.0] for i in range(5)])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,65 @@
+import datetime
+import unittest
+
+from bitflow.sample import Sample, CompactSample, Header, EPOCH
+from tests.helpers import configure_logging
+
+
+class TestHeader(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def test_intern(self):
+        header = Header.intern(["a", "b", "c"])
+        self.assertIs(header, Header.intern(["a", "b", "c"]))
+        self.assertIsNot(header, Header.intern(["a", "b"]))
+        self.assertFalse(header.has_changed(Header.intern(("a", "b", "c"))))
+        self.assertFalse(header.has_changed(Header(["a", "b", "c"])))
+        self.assertTrue(header.has_changed(Header(["a", "b", "x"])))
+        self.assertTrue(header.has_changed(Header(["a", "b"])))
+
+    def test_extend_interned(self):
+        header = Header.intern(["x", "y"])
+        header.extend("z")
+        self.assertEqual(header.index("z"), 2)
+        other = Header.intern(["x", "y"])
+        self.assertIsNot(header, other)
+        self.assertEqual(other.metric_names, ["x", "y"])
+        self.assertTrue(header.has_changed(other))
+
+    def test_index(self):
+        header = Header(["a", "b", "a", "c"])
+        sample = Sample(header, [1, 2, 3, 4])
+        self.assertEqual(sample.get_metricsindex_by_name("a"), 0)
+        self.assertEqual(sample.get_metricsindex_by_name("c"), 3)
+        self.assertEqual(sample.get_metricvalue_by_name("b"), 2)
+        with self.assertRaises(ValueError):
+            sample.get_metricvalue_by_name("missing")
+
+        header.metric_names[3] = "d"
+        header.changed()
+        self.assertEqual(header.index("d"), 3)
+        self.assertTrue(header.has_changed(Header(["a", "b", "a", "c"])))
+
+
+class TestSampleTimestamp(unittest.TestCase):
+
+    def test_set_timestamp(self):
+        header = Header(["a"])
+        for sample_type in (Sample, CompactSample):
+            sample = sample_type(header, [1.0], timestamp=0)
+            self.assertEqual(sample.get_timestamp_nanos(), 0)
+            self.assertEqual(sample.get_timestamp(), EPOCH)
+            sample.set_timestamp(1586591392828602123)
+            self.assertEqual(sample.get_timestamp_nanos(), 1586591392828602123)
+            sample.set_timestamp("2020-04-11 07:49:52.828602")
+            self.assertEqual(sample.get_timestamp_nanos(), 1586591392828602000)
+            before = datetime.datetime.utcnow()
+            for now in (None, ""):
+                sample.set_timestamp(now)
+                self.assertTrue(before <= sample.get_timestamp() <= datetime.datetime.utcnow())
+
+
+if __name__ == '__main__':
+    unittest.main()
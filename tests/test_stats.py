@@ -0,0 +1,128 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from bitflow.aio import AsyncBitflowRunner
+from bitflow.index import SampleIndex
+from bitflow.io import SampleChannel, FlushPolicy, open_input
+from bitflow.parallel import ParallelRunner
+from bitflow.runner import BitflowRunner
+from bitflow.stats import LatencyHistogram, Statistics, StatsReporter
+from bitflow.steps import NoopStep
+from tests.helpers import configure_logging
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+class TestStatistics(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(50), 0)
+        for nanos in [100] * 90 + [5000] * 9 + [1000000]:
+            histogram.record(nanos)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 1000000)
+        self.assertEqual(histogram.percentile(50), 128)
+        self.assertEqual(histogram.percentile(99), 8192)
+        self.assertEqual(histogram.percentile(100), 1000000)
+        self.assertAlmostEqual(histogram.mean(), (9000 + 45000 + 1000000) / 100)
+
+    def test_instrumented_pipeline(self):
+        with open(dir_path + "/test_data/in.bin", "rb") as f:
+            data = f.read()
+        stats = Statistics()
+        output = io.BytesIO()
+        channel = SampleChannel(input_stream=io.BufferedReader(io.BytesIO(data)), output_stream=output,
+                                flush_policy=FlushPolicy(max_samples=100))
+        channel.enable_statistics(stats)
+        BitflowRunner(stats=stats).run(NoopStep(), channel)
+        self.assertEqual(data, output.getvalue())
+        self.assertEqual(stats.samples_in, 1222)
+        self.assertEqual(stats.samples_out, 1222)
+        self.assertEqual(stats.bytes_in, len(data))
+        self.assertEqual(stats.bytes_out, len(data))
+        self.assertEqual(stats.header_changes, 1)
+        self.assertEqual(stats.step.count, 1222)
+        self.assertEqual(stats.encode.count, 1222)
+        self.assertEqual(stats.decode.count, 1224)  # Header, samples and end of input
+
+        with tempfile.TemporaryDirectory() as tmp:
+            stats_file = os.path.join(tmp, "stats.json")
+            StatsReporter(stats, stats_file=stats_file).start().stop()
+            with open(stats_file) as f:
+                report = json.loads(f.readline())
+            self.assertTrue(report["final"])
+            self.assertEqual(report["samples_in"], 1222)
+            self.assertEqual(report["step"]["count"], 1222)
+
+    def test_mapped_input_bytes(self):
+        path = dir_path + "/test_data/in.bin"
+        with open(path, "rb") as f:
+            samples = list(iter(SampleChannel(input_stream=io.BytesIO(f.read()), output_stream=io.BytesIO())
+                                .read_sample, None))
+        to_time = samples[100].get_timestamp_nanos()
+        stats = Statistics()
+        stream = open_input(path)
+        try:
+            channel = SampleChannel(input_stream=stream, output_stream=io.BytesIO(), to_time=to_time)
+            channel.enable_statistics(stats)
+            read = list(iter(channel.read_sample, None))
+        finally:
+            stream.close()
+        # Only the header and the samples up to the end of the time range were consumed
+        self.assertEqual(stats.samples_in, 101)
+        self.assertEqual(len(read), 100)
+        self.assertGreater(stats.bytes_in, 0)
+        self.assertLess(stats.bytes_in, os.path.getsize(path) // 5)
+
+    def test_indexed_input_header(self):
+        path = dir_path + "/test_data/in.bin"
+        with open(path, "rb") as f:
+            data = f.read()
+        samples = list(iter(SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO()).read_sample,
+                            None))
+        from_time = samples[500].get_timestamp_nanos()
+        index = SampleIndex.build(data, interval=10)
+        for input_index in (index, None):
+            stats = Statistics()
+            stream = open_input(path)
+            try:
+                channel = SampleChannel(input_stream=stream, output_stream=io.BytesIO(), from_time=from_time,
+                                        input_index=input_index)
+                channel.enable_statistics(stats)
+                read = list(iter(channel.read_sample, None))
+            finally:
+                stream.close()
+            self.assertEqual(len(read), len(samples) - 500)
+            self.assertEqual(stats.header_changes, 1, input_index)
+
+    def test_parallel_and_async_step_latency(self):
+        with open(dir_path + "/test_data/in.bin", "rb") as f:
+            data = f.read()
+        for runner_type in (ParallelRunner, AsyncBitflowRunner):
+            for output_format in ("bin", "csv"):
+                stats = Statistics()
+                runner = runner_type(2, stats=stats)
+                channel = SampleChannel(input_stream=io.BytesIO(data), output_stream=io.BytesIO(),
+                                        output_format=output_format)
+                channel.enable_statistics(stats)
+                runner.run(NoopStep(), channel)
+                self.assertEqual(stats.step.count, 1222, runner_type)
+                # The ParallelRunner writes blocks of marshalled samples, which are counted as well
+                self.assertEqual(stats.samples_out, 1222, runner_type)
+                self.assertEqual(stats.encode.count, 1222, runner_type)
+
+    def test_disabled(self):
+        channel = SampleChannel(input_stream=io.BytesIO(), output_stream=io.BytesIO())
+        self.assertNotIn("output_sample", vars(channel))
+        self.assertNotIn("read", vars(channel.decoder))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import math
+import random
+import unittest
+
+from bitflow.sample import Sample, Header
+from bitflow.steps import WindowMeanStep, WindowMinMaxStep, WindowRateStep, WindowStddevStep
+from bitflow.window import SampleWindow
+from tests.helpers import configure_logging, SampleListChannel
+
+SECOND = 1000000000
+
+
+class TestSampleWindow(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+        rnd = random.Random(1)
+        self.rows = [[rnd.uniform(-100, 100) for _ in range(3)] for _ in range(500)]
+        # Irregular timestamps, sometimes several samples with the same timestamp
+        self.timestamps = []
+        timestamp = 0
+        for _ in self.rows:
+            timestamp += rnd.choice([0, SECOND // 10, SECOND // 2, 2 * SECOND])
+            self.timestamps.append(timestamp)
+
+    def check_window(self, window, expected_rows, expected_timestamps):
+        self.assertEqual(len(window), len(expected_rows))
+        columns = list(zip(*expected_rows))
+        n = len(expected_rows)
+        means = [sum(column) / n for column in columns]
+        for actual, expected in zip(window.means(), means):
+            self.assertAlmostEqual(actual, expected, places=7)
+        for actual, column, mean in zip(window.stddevs(), columns, means):
+            self.assertAlmostEqual(actual, math.sqrt(sum((v - mean) ** 2 for v in column) / n), places=6)
+        if window.track_minmax:
+            self.assertEqual(window.mins(), [min(column) for column in columns])
+            self.assertEqual(window.maxs(), [max(column) for column in columns])
+        seconds = (expected_timestamps[-1] - expected_timestamps[0]) / SECOND
+        for actual, column in zip(window.rates(), columns):
+            expected = (column[-1] - column[0]) / seconds if seconds > 0 else 0.0
+            self.assertAlmostEqual(actual, expected, places=7)
+
+    def test_count_window(self):
+        window = SampleWindow(3, size=7, track_minmax=True)
+        for i, (timestamp, row) in enumerate(zip(self.timestamps, self.rows)):
+            window.push(timestamp, row)
+            start = max(0, i - 6)
+            self.check_window(window, self.rows[start:i + 1], self.timestamps[start:i + 1])
+
+    def test_time_window(self):
+        window = SampleWindow(3, seconds=5, track_minmax=True)
+        for i, (timestamp, row) in enumerate(zip(self.timestamps, self.rows)):
+            window.push(timestamp, row)
+            start = min(j for j in range(i + 1) if self.timestamps[j] > timestamp - 5 * SECOND)
+            self.check_window(window, self.rows[start:i + 1], self.timestamps[start:i + 1])
+        self.assertGreater(window.capacity, 16)
+
+    def test_large_offset(self):
+        window = SampleWindow(1, size=5)
+        for i in range(1, 6):
+            window.push(i, [1e9 + i])
+        self.assertAlmostEqual(window.stddevs()[0], math.sqrt(2), places=9)
+        self.assertEqual(window.means(), [1e9 + 3])
+
+        # A growing counter, the sums are rebased while the window moves. The standard deviation does not depend
+        # on the offset, so the expected values are computed without it.
+        values = [1000 * i + row[0] for i, row in enumerate(self.rows)]
+        window = SampleWindow(1, size=7)
+        for i, value in enumerate(values):
+            window.push(i, [1e12 + value])
+            expected = values[max(0, i - 6):i + 1]
+            mean = sum(expected) / len(expected)
+            self.assertAlmostEqual(window.means()[0], 1e12 + mean, delta=1e-3)
+            self.assertAlmostEqual(window.stddevs()[0],
+                                   math.sqrt(sum((v - mean) ** 2 for v in expected) / len(expected)), delta=1e-3)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            SampleWindow(1)
+        with self.assertRaises(ValueError):
+            SampleWindow(1, size=0)
+        with self.assertRaises(ValueError):
+            SampleWindow(2, size=3).push(0, [1.0])
+
+
+class TestWindowSteps(unittest.TestCase):
+
+    def setUp(self):
+        configure_logging()
+
+    def run_step(self, step, samples):
+        channel = SampleListChannel(samples)
+        step.initialize(channel)
+        for sample in list(samples):
+            step.handle_sample(sample)
+        return channel.output
+
+    def test_window_steps(self):
+        header = Header(["a", "b"])
+
+        def samples():
+            return [Sample(header, [float(i), float(i * i)], timestamp=i * SECOND, tags={"k": str(i % 2)})
+                    for i in range(6)]
+
+        output = self.run_step(WindowMeanStep(window=3), samples())
+        self.assertEqual([s.metrics for s in output][-1], [4.0, (9 + 16 + 25) / 3])
+        output = self.run_step(WindowMeanStep(window=2, tag="k"), samples())
+        self.assertEqual(output[-1].metrics, [4.0, (9 + 25) / 2])
+        output = self.run_step(WindowRateStep(seconds=2.5), samples())
+        self.assertEqual(output[-1].metrics, [1.0, 8.0])
+        output = self.run_step(WindowStddevStep(window=2), samples())
+        self.assertEqual(output[-1].metrics, [0.5, 4.5])
+
+        output = self.run_step(WindowMinMaxStep(window=3), samples())
+        self.assertEqual(output[-1].header.metric_names, ["a_min", "b_min", "a_max", "b_max"])
+        self.assertIs(output[-1].header, output[-2].header)
+        self.assertEqual(output[-1].metrics, [3.0, 9.0, 5.0, 25.0])
+
+    def test_header_change(self):
+        header = Header(["a"])
+        output = self.run_step(WindowMeanStep(window=5), [Sample(header, [1.0], timestamp=0),
+                                                          Sample(header, [3.0], timestamp=1),
+                                                          Sample(Header(["b", "c"]), [10.0, 20.0], timestamp=2),
+                                                          Sample(header, [5.0], timestamp=3)])
+        self.assertEqual([s.metrics for s in output], [[1.0], [2.0], [10.0, 20.0], [5.0]])
+
+    def test_window_eviction(self):
+        header = Header(["a"])
+
+        def samples(keys):
+            return [Sample(header, [float(i)], timestamp=i * SECOND, tags={"k": key}) for i, key in enumerate(keys)]
+
+        step = WindowMeanStep(window=10, tag="k", max_keys=2)
+        output = self.run_step(step, samples(["x", "y", "x", "z", "x", "y"]))
+        # Adding "z" removes "y", the least recently used window, so the second "y" starts a new window
+        self.assertEqual([s.metrics[0] for s in output], [0.0, 1.0, 1.0, 3.0, 2.0, 5.0])
+        self.assertEqual(list(step.windows), ["x", "y"])
+        self.assertEqual(step.evicted, 2)
+
+        step = WindowMeanStep(window=10, tag="k", idle_seconds=2)
+        output = self.run_step(step, samples(["x", "y", "y", "y", "x"]))
+        self.assertEqual([s.metrics[0] for s in output], [0.0, 1.0, 1.5, 2.0, 4.0])
+        self.assertEqual(list(step.windows), ["y", "x"])
+        self.assertEqual(step.evicted, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()